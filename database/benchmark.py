@@ -0,0 +1,149 @@
+"""
+Benchmarks for the DatabaseManager.
+
+They run against the configured (test) database and overwrite the stats of the prefilled sample player.
+Run from the project root:
+    python -m database.benchmark ingest [rounds]
+    python -m database.benchmark prepared [rounds]
+    python -m database.benchmark parse [rounds] [scale]
+"""
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from . import databaseManagerV2
+from .databaseManagerV2 import DatabaseManager
+
+SAMPLE_UUID = "4ebe5f6f-c231-4315-9d60-097c48cc6d30"
+SAMPLE_SERVER_ID = 1
+SAMPLE_STATS_FILE = f"sampleData/{SAMPLE_UUID}.json"
+
+
+def load_sample_payloads(rounds, offset=0):
+    """
+    Returns `rounds` stats payloads based on the sample file. Every payload has different values so each one is written.
+    """
+    with open(SAMPLE_STATS_FILE, "r") as stats_file:
+        sample = json.load(stats_file)
+    payloads = []
+    for i in range(offset, offset + rounds):
+        stats = {category: {item: value + i + 1 for item, value in items.items()}
+                 for category, items in sample["stats"].items()}
+        payloads.append(json.dumps({"stats": stats, "DataVersion": sample["DataVersion"]}))
+    return payloads
+
+
+def benchmark_ingest(rounds=20):
+    """
+    Compares the python ingest path with the ingest_player_stats() postgres function.
+    """
+    db = DatabaseManager()
+    player_id = db.get_player_id_from_mojang_uuid_and_server_id(SAMPLE_UUID, SAMPLE_SERVER_ID)
+    modes = [("python", False), ("postgres", True)]
+    for index, (mode, server_side) in enumerate(modes):
+        databaseManagerV2.SERVER_SIDE_STATS_INGEST = server_side
+        payloads = load_sample_payloads(rounds, offset=index * rounds)
+        start = time.perf_counter()
+        for payload in payloads:
+            db.update_player_stats(player_id, payload, SAMPLE_SERVER_ID)
+        elapsed = time.perf_counter() - start
+        print(f"{mode:>10}: {elapsed / rounds * 1000:8.2f} ms per payload ({rounds} payloads)")
+
+
+def run_query_mix(db, player_id, payload):
+    """
+    One round of the statements the socket and the web app issue most often.
+    """
+    db.get_player_id_from_mojang_uuid_and_server_id(SAMPLE_UUID, SAMPLE_SERVER_ID)
+    db.update_player_status_from_mojang_uuid_and_server_id(SAMPLE_UUID, SAMPLE_SERVER_ID, "online")
+    db.get_online_status_by_player_id(player_id)
+    for object in ("minecraft:deaths", "minecraft:time_since_death", "minecraft:play_time"):
+        db.get_value_from_unique_object_from_action_table_with_player_id(object, player_id)
+    db.update_player_stats(player_id, payload, SAMPLE_SERVER_ID)
+
+
+def benchmark_prepared(rounds=20):
+    """
+    Runs the query mix with plain statements and with server side prepared statements.
+    """
+    db = DatabaseManager()
+    player_id = db.get_player_id_from_mojang_uuid_and_server_id(SAMPLE_UUID, SAMPLE_SERVER_ID)
+    modes = [("plain", False), ("prepared", True)]
+    for index, (mode, prepared) in enumerate(modes):
+        databaseManagerV2.USE_PREPARED_STATEMENTS = prepared
+        payloads = load_sample_payloads(rounds, offset=index * rounds)
+        start = time.perf_counter()
+        for payload in payloads:
+            run_query_mix(db, player_id, payload)
+        elapsed = time.perf_counter() - start
+        print(f"{mode:>10}: {elapsed / rounds * 1000:8.2f} ms per query mix ({rounds} rounds)")
+
+
+def parse_stats_rows(db, player_id, payload):
+    """
+    The row based parsing the python ingest used before parse_stats_columns, kept for comparison.
+    """
+    rows = {}
+    for item in db.split_items_from_json(payload):
+        if item[2] != 0:
+            rows[(item[0], item[1])] = (player_id, item[0], item[1], item[2])
+    return [row[1] for row in rows.values()], [row[2] for row in rows.values()], [row[3] for row in rows.values()]
+
+
+def scale_payload(payload, scale):
+    """
+    Adds `scale` - 1 copies of every stat under a new name, for payloads of modded servers with many more keys.
+    """
+    data = json.loads(payload)
+    data["stats"] = {category: {f"{item}_{copy}" if copy else item: value
+                                for item, value in items.items() for copy in range(scale)}
+                     for category, items in data["stats"].items()}
+    return json.dumps(data)
+
+
+def benchmark_parse(rounds=20, scale=1):
+    """
+    Compares the row based and the columnar parsing of stats payloads: time, peak memory and garbage collector
+    time per payload. The classification is cached by the first (untimed) round, so only the parsing is measured.
+    """
+    db = DatabaseManager()
+    player_id = db.get_player_id_from_mojang_uuid_and_server_id(SAMPLE_UUID, SAMPLE_SERVER_ID)
+    payloads = [scale_payload(payload, scale) for payload in load_sample_payloads(rounds)]
+    parsers = [("rows", lambda payload: parse_stats_rows(db, player_id, payload)), ("columns", db.parse_stats_columns)]
+    assert parsers[0][1](payloads[0]) == parsers[1][1](payloads[0])
+    gc_time = [0.0, None]
+
+    def track_gc(phase, info):
+        if phase == "start":
+            gc_time[1] = time.perf_counter()
+        elif gc_time[1] is not None:
+            gc_time[0] += time.perf_counter() - gc_time[1]
+
+    gc.callbacks.append(track_gc)
+    try:
+        for mode, parse in parsers:
+            gc.collect()
+            gc_time[0] = 0.0
+            start = time.perf_counter()
+            for payload in payloads:
+                parse(payload)
+            elapsed = time.perf_counter() - start
+            measured_gc = gc_time[0]
+            tracemalloc.start()
+            parse(payloads[0])
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{mode:>10}: {elapsed / rounds * 1000:8.2f} ms, {peak / 1024:8.0f} KiB peak, "
+                  f"{measured_gc / rounds * 1000:6.2f} ms gc per payload ({rounds} payloads)")
+    finally:
+        gc.callbacks.remove(track_gc)
+
+
+if __name__ == "__main__":
+    benchmarks = {"ingest": benchmark_ingest, "prepared": benchmark_prepared, "parse": benchmark_parse}
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(f"usage: python -m database.benchmark [{'|'.join(benchmarks)}] [rounds]")
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
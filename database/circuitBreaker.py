@@ -0,0 +1,115 @@
+import collections
+import threading
+import time
+
+from colorlogx import get_logger
+import logging
+
+CIRCUIT_WINDOW = 30  # seconds of calls the failure rate is computed over
+CIRCUIT_MIN_CALLS = 10  # calls in the window before the breaker may open
+CIRCUIT_FAILURE_RATE = 0.5  # share of failed or slow calls that opens the breaker
+CIRCUIT_SLOW_CALL = 2  # seconds after which a call counts as failed
+CIRCUIT_SLOW_BULK_CALL = 30  # seconds after which a bulk write (batches, rebuilds, migrations) counts as failed
+CIRCUIT_OPEN_DURATION = 10  # seconds calls are refused before one probe call is let through
+DB_LOCK_TIMEOUT = 5  # seconds a call waits for the connection of a DatabaseManager before it is shed
+
+logger = get_logger("circuitBreaker", logging.DEBUG)
+
+
+class DatabaseUnavailableError(Exception):
+    """
+    Raised instead of calling the database while the circuit breaker is open or the connection is busy for too long.
+    """
+
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        self.retry_after = retry_after  # seconds until the next call may be let through
+
+
+class CircuitBreaker:
+    """
+    Tracks the failures and latency of the calls to one database connection.
+    closed: every call is let through. Opens when at least CIRCUIT_FAILURE_RATE of the calls of the last
+    CIRCUIT_WINDOW seconds failed or took longer than CIRCUIT_SLOW_CALL.
+    open: every call is refused with DatabaseUnavailableError for CIRCUIT_OPEN_DURATION.
+    half open: one probe call is let through; it closes the breaker if it succeeds and opens it again otherwise.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.counters = {"opened": 0, "rejected": 0, "failed": 0, "slow": 0}
+        self._calls = collections.deque()  # (finished at, failed or slow)
+        self._bad_calls = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def available(self):
+        """
+        Tells if a call would be let through right now, without letting it through.
+        """
+        with self._lock:
+            return self.state == self.CLOSED or (not self._probing and self._retry_after() == 0)
+
+    def before_call(self):
+        """
+        Raises DatabaseUnavailableError if the call has to be refused.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and self._retry_after() == 0:
+                self.state = self.HALF_OPEN
+                logger.info(f"Circuit breaker of {self.name} is half open, probing the database")
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.counters["rejected"] += 1
+            raise DatabaseUnavailableError(f"Database of {self.name} is unavailable", max(self._retry_after(), 1))
+
+    def record(self, duration, failed, slow_call=CIRCUIT_SLOW_CALL):
+        """
+        Records the outcome of a call. slow_call is the duration after which the call counts as failed,
+        bulk writes pass CIRCUIT_SLOW_BULK_CALL because they are expected to take longer than a single row.
+        """
+        now = time.monotonic()
+        slow = duration >= slow_call
+        bad = failed or slow
+        with self._lock:
+            self.counters["failed"] += 1 if failed else 0
+            self.counters["slow"] += 1 if slow else 0
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if bad:
+                    self._open(now)
+                else:
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                    self._bad_calls = 0
+                    logger.info(f"Circuit breaker of {self.name} closed")
+                return
+            if self.state == self.OPEN:  # a call that was let through before the breaker opened
+                return
+            self._calls.append((now, bad))
+            self._bad_calls += bad
+            while self._calls and self._calls[0][0] < now - CIRCUIT_WINDOW:
+                self._bad_calls -= self._calls.popleft()[1]
+            if len(self._calls) >= CIRCUIT_MIN_CALLS and self._bad_calls >= CIRCUIT_FAILURE_RATE * len(self._calls):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.counters["opened"] += 1
+        self._calls.clear()
+        self._bad_calls = 0
+        logger.error(f"Circuit breaker of {self.name} opened, refusing database calls for {CIRCUIT_OPEN_DURATION} seconds")
+
+    def _retry_after(self):
+        if self.state != self.OPEN:
+            return 0
+        return max(0, self.opened_at + CIRCUIT_OPEN_DURATION - time.monotonic())
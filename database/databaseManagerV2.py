@@ -1,7 +1,9 @@
 import ast
+import collections
 from datetime import datetime, timedelta
 import html
 import json
+import os
 import re
 import secrets
 import string
@@ -11,17 +13,66 @@ import traceback
 import uuid
 import argon2
 import psycopg2
+from psycopg2.extras import execute_values
 import functools
+import hashlib
+import weakref
 
 from colorlogx import get_logger
 import logging
 from .minecraft import Minecraft
+from .circuitBreaker import CircuitBreaker, DatabaseUnavailableError, DB_LOCK_TIMEOUT, CIRCUIT_SLOW_CALL, CIRCUIT_SLOW_BULK_CALL
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 RESET_DATABASE = False
 PREFILL_DATABASE = True
+STATS_HISTORY_ENABLED = False  # append every stat change to the partitioned actions_history table
+STATS_HISTORY_PARTITIONS_AHEAD = 1  # months after the current one whose actions_history partitions are created in advance
+SERVER_SIDE_STATS_INGEST = False  # send the raw stats json to the ingest_player_stats() function instead of parsing it here
+USE_PREPARED_STATEMENTS = True  # execute the statements in PREPARED_STATEMENTS as server side prepared statements
+MIGRATIONS_DIR = "database/queries/migrations"
+SCHEMA_LOCK_ID = 7412001  # postgres advisory lock held while a process checks and migrates the schema
+DB_CONNECTION_PARAMS = {
+    "database": "mcConnect-TestDB-1",
+    "host": "localhost",
+    "user": "admin",
+    "password": "admin",
+    "port": "5432",
+}
+ONLINE_PLAYERS_CHANNEL = "online_players"  # NOTIFY channel for online status changes
+SOCKET_COMMANDS_CHANNEL = "socket_commands"  # NOTIFY channel for messages to the socket worker holding a server
+
+LEADERBOARD_SIZE = 10
+PLAYER_ID_CACHE_SIZE = 10000  # (server_id, mojang_uuid) -> player_id entries kept in memory
+STAT_CATEGORY_CACHE_SIZE = 50000  # (json category, object) -> database category entries kept in memory
+ALL_OBJECTS = "*"  # object name of the per category totals
+LEADERBOARDS = {
+    "top_miners": (17, ALL_OBJECTS),
+    "most_deaths": (21, "minecraft:deaths"),
+    "longest_playtime": (21, "minecraft:play_time"),
+}
+# ----> Layout.txt
+STATS_CATEGORIES = ["minecraft:broken", "minecraft:mined", "minecraft:dropped", "minecraft:used", "minecraft:killed", "minecraft:crafted", "minecraft:killed_by", "minecraft:custom", "minecraft:picked_up"]
+TOOLS_SUBSTRINGS = ["axe", "shovel", "hoe", "sword", "pickaxe", "shield", "flint_and_steel", "bow", "crossbow", "brush", "trident", "shears", "fishing_rod", "mace"]
+ARMOR_SUBSTRINGS = ["boots", "leggings", "chestplate", "helmet"]
+# item group -> json category -> database category. "any" applies to every item group.
+# Also copied into the stats_category_mapping table for the server side ingest.
+DB_CATEGORY_MAPPING = {
+    "tool": {"minecraft:broken": 15, "minecraft:dropped": 10, "minecraft:used": 20, "minecraft:crafted": 0, "minecraft:picked_up": 6},
+    "armor": {"minecraft:broken": 16, "minecraft:dropped": 9, "minecraft:used": 19, "minecraft:crafted": 1, "minecraft:picked_up": 5},
+    "block": {"minecraft:mined": 17, "minecraft:dropped": 7, "minecraft:used": 13, "minecraft:crafted": 2, "minecraft:picked_up": 3},
+    "item": {"minecraft:dropped": 14, "minecraft:used": 18, "minecraft:crafted": 4, "minecraft:picked_up": 8},
+    "any": {"minecraft:killed": 12, "minecraft:killed_by": 11, "minecraft:custom": 21},
+}
+
+SERVER_TOTALS = {
+    "blocks_mined": (17, ALL_OBJECTS),
+    "mobs_killed": (12, ALL_OBJECTS),
+    "deaths": (21, "minecraft:deaths"),
+    "play_time": (21, "minecraft:play_time"),
+}
 
 TABLE_COUNT = 12
 LOWEST_WEB_ACCESS_LEVEL = 0
@@ -33,6 +84,132 @@ BAN_REASONS = [
     ["other", 7],
 ]
 
+# name -> (parameter types, statement)
+# The hot statements are prepared once per connection on their first use and afterwards only executed by name.
+PREPARED_STATEMENTS = {
+    "player_id_by_uuid_and_server_id": ("uuid, integer", "SELECT player_id FROM player_server_info WHERE mojang_uuid = $1 AND server_id = $2"),
+    "server_id_by_player_id": ("uuid", "SELECT server_id FROM player_server_info WHERE player_id = $1"),
+    "server_id_by_auth_key": ("text", "SELECT id FROM servers WHERE server_key = $1"),
+    "update_player_status": ("boolean, uuid, integer", "UPDATE player_server_info SET online = $1 WHERE mojang_uuid = $2 AND server_id = $3"),
+    "online_status_by_player_id": ("uuid", "SELECT online FROM player_server_info WHERE player_id = $1"),
+    "online_player_count_by_subdomain": ("text", "SELECT COUNT(*) FROM player_server_info WHERE server_id IN (SELECT id FROM servers WHERE subdomain = $1) AND online = true"),
+    "first_seen_by_player_id": ("uuid", "SELECT first_seen FROM player_server_info WHERE player_id = $1"),
+    "last_seen_by_player_id": ("uuid", "SELECT last_seen FROM player_server_info WHERE player_id = $1"),
+    "action_value_by_object_and_player_id": ("text, uuid", "SELECT value FROM actions WHERE object = $1 and player_id = $2"),
+    "block_exists": ("text", "SELECT EXISTS (SELECT 1 FROM block_lookup WHERE blocks = $1)"),
+    "item_exists": ("text", "SELECT EXISTS (SELECT 1 FROM item_lookup WHERE items = $1)"),
+    "swap_stats_digest": ("uuid, text", """
+        UPDATE player_server_info psi SET stats_digest = $2, stats_synced_at = NOW()
+        FROM (SELECT player_id, stats_digest FROM player_server_info WHERE player_id = $1 FOR UPDATE) previous
+        WHERE psi.player_id = previous.player_id
+        RETURNING previous.stats_digest"""),
+    "ingest_player_stats": ("uuid, jsonb", "SELECT * FROM ingest_player_stats($1::uuid, $2::jsonb)"),
+    "upsert_player_stats": ("uuid, text[], integer[], integer[]", """
+        WITH incoming AS (
+            SELECT $1::uuid AS player_id, object, category, value
+            FROM unnest($2::text[], $3::integer[], $4::integer[]) AS t (object, category, value)
+        ),
+        previous AS (
+            SELECT a.object, a.category, a.value
+            FROM actions a
+            JOIN incoming i USING (player_id, object, category)
+        ),
+        changed AS (
+            INSERT INTO actions (player_id, object, category, value)
+            SELECT player_id, object, category, value FROM incoming
+            ON CONFLICT (player_id, object, category)
+            DO UPDATE SET
+            "value" = EXCLUDED.value
+            WHERE actions.value IS DISTINCT FROM EXCLUDED.value
+            RETURNING object, category, value
+        )
+        SELECT c.object, c.category, c.value, c.value - COALESCE(p.value, 0)
+        FROM changed c
+        LEFT JOIN previous p USING (object, category)"""),
+}
+
+# name -> query of the DatabaseManager method with the same name, also explained by database/explainHarness.py
+QUERIES = {
+    "get_player_id_from_mojang_uuid_and_subdomain": """
+        SELECT psi.player_id
+        FROM player_server_info psi
+        JOIN servers s ON psi.server_id = s.id
+        WHERE psi.mojang_uuid = %s AND s.subdomain = %s""",
+    "get_mojang_uuid_from_player_id": "SELECT mojang_uuid FROM player_server_info WHERE player_id = %s",
+    "get_mojang_uuid_from_player_name": "SELECT uuid FROM player WHERE name = %s",
+    "get_player_name_from_mojang_uuid": "SELECT name FROM player WHERE uuid = %s",
+    "get_player_name_from_player_id": """
+        SELECT p.name
+        FROM player p
+        JOIN player_server_info psi ON p.uuid = psi.mojang_uuid
+        WHERE psi.player_id = %s""",
+    "get_prefix_id_by_player_id": "SELECT prefix FROM player_server_info WHERE player_id=%s",
+    "get_ban_reason_from_player_id": """
+        SELECT br.reason FROM ban_reasons br
+        JOIN banned_players bp ON br.id = bp.ban_reason_id
+        WHERE bp.banned_player_id = %s""",
+    "get_server_id_from_subdomain": "SELECT id FROM servers WHERE subdomain = %s",
+    "get_all_player_ids_from_subdomain": "SELECT player_id FROM player_server_info WHERE server_id IN (SELECT id FROM servers WHERE subdomain = %s)",
+    "get_all_mojang_uuids_from_subdomain": "SELECT mojang_uuid FROM player_server_info WHERE server_id IN (SELECT id FROM servers WHERE subdomain = %s)",
+    "get_online_status_by_player_uuid_and_subdomain": """
+        SELECT psi.online
+        FROM player_server_info psi
+        JOIN servers s ON psi.server_id = s.id
+        WHERE psi.mojang_uuid = %s AND s.subdomain = %s""",
+    "get_ban_start_and_ban_end_by_player_id": """
+        SELECT ban_start, ban_end
+        FROM banned_players
+        WHERE banned_player_id = %s""",
+    "get_web_access_permission_from_player_id": """
+        SELECT web_access_permissions
+        FROM player_server_info
+        WHERE player_id = %s""",
+    "get_server_information_dict": "SELECT * FROM servers WHERE LOWER(subdomain) = %s",
+    "get_all_armor_stats": """
+        SELECT jsonb_agg(category_objects) AS grouped_objects
+        FROM (
+            SELECT category, jsonb_agg(jsonb_build_object('object', object, 'value', value)) AS category_objects
+            FROM actions
+            WHERE category IN (19, 16, 9, 5, 1) AND player_id = %s
+            GROUP BY category
+            ORDER BY category DESC
+        ) subquery""",
+    "get_all_custom_stats": """
+        SELECT jsonb_agg(category_objects) AS grouped_objects
+        FROM (
+            SELECT category, jsonb_agg(jsonb_build_object('object', object, 'value', value)) AS category_objects
+            FROM actions
+            WHERE category = 21 AND player_id = %s
+            GROUP BY category
+            ORDER BY category DESC
+        ) subquery""",
+    "verify_player_login": "SELECT pin, timestamp FROM login WHERE player_id = %s",
+    "get_leaderboard": """
+        SELECT l.player_id, p.name, l.value
+        FROM leaderboards l
+        JOIN player_server_info psi ON psi.player_id = l.player_id
+        JOIN player p ON p.uuid = psi.mojang_uuid
+        WHERE l.server_id = %s AND l.category = %s AND l.object = %s
+        ORDER BY l.value DESC, l.player_id
+        LIMIT %s""",
+    "get_server_stat_totals": """
+        SELECT category, object, total FROM server_stat_totals
+        WHERE server_id = %s
+        AND (category, object) IN (SELECT * FROM unnest(%s::integer[], %s::text[]))""",
+    "get_stats_sync_state": "SELECT mojang_uuid, stats_synced_at FROM player_server_info WHERE server_id = %s",
+    "get_daily_playtime": """
+        SELECT day, seconds FROM daily_playtime
+        WHERE player_id = %s AND day >= %s AND day < %s
+        ORDER BY day""",
+    "get_player_sessions": """
+        SELECT session_start, session_end FROM sessions
+        WHERE player_id = %s AND session_start >= %s AND session_start < %s
+        ORDER BY session_start""",
+}
+
+_schema_lock = threading.Lock()
+_schema_ready = False  # the schema was checked and migrated by this process
+
 ph = argon2.PasswordHasher()
 logger = get_logger("databaseManager",logging.DEBUG)
 minecraft = Minecraft()
@@ -45,47 +222,108 @@ def generate_secure_token(length=64):
     characters = string.ascii_letters + string.digits
     return ''.join(secrets.choice(characters) for _ in range(length))
 
-def db_error_handler(method):
+def db_error_handler(method, slow_call=CIRCUIT_SLOW_CALL):
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
+        outermost = not getattr(self._local, "depth", 0)  # only the outermost call is tracked by the circuit breaker
+        if outermost:
+            self._breaker.before_call()
+        # the connection and cursor are shared by all threads using this manager
+        if not self._lock.acquire(timeout=DB_LOCK_TIMEOUT):
+            self._breaker.record(DB_LOCK_TIMEOUT, failed=True)
+            raise DatabaseUnavailableError(f"Database connection busy for {DB_LOCK_TIMEOUT} seconds, shedding {method.__name__}")
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+        started = time.monotonic()
+        failed = False
         try:
+            if outermost and self.conn.closed:
+                self._reconnect()
             return method(self, *args, **kwargs)
         except Exception as e:
             logger.error(f"Database error in {method.__name__}: {e}")
-            if self.conn:
+            failed = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))  # not the errors of bad data
+            if self.conn and not self.conn.closed:
                 self.conn.rollback()
             raise
+        finally:
+            self._local.depth -= 1
+            self._lock.release()
+            if outermost:
+                self._breaker.record(time.monotonic() - started, failed, slow_call)
     return wrapper
 
 def decorate_all_db_methods(cls):
-    blacklist = [""]
+    blacklist = ["", "is_available", "get_circuit_state", "format_time",  # do not need the connection
+                 "add_players", "update_player_stats_batch"]  # look up usernames before taking the connection
+    bulk = ["_prepare_schema", "_insert_players", "_write_player_stats_batch", "update_player_statuses",
+            "rebuild_leaderboards", "reconcile_server_stat_totals", "drop_stats_history_partitions_before",
+            "compact_stats_history_partition"]  # may take longer than a single row without the database being slow
     for attr_name, attr_value in cls.__dict__.items():
         if callable(attr_value) and not attr_name.startswith("__") and attr_name not in blacklist:
-            setattr(cls, attr_name, db_error_handler(attr_value))
+            slow_call = CIRCUIT_SLOW_BULK_CALL if attr_name in bulk else CIRCUIT_SLOW_CALL
+            setattr(cls, attr_name, db_error_handler(attr_value, slow_call))
     return cls
 
 @decorate_all_db_methods
 class DatabaseManager:
     def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()  # nesting depth of the decorated calls per thread
+        self._breaker = CircuitBreaker(f"DatabaseManager {id(self):x}")
         self.CURRENT_DOMAIN = open("DOMAIN.txt", "r").readline().strip()
         logger.debug("Initializing database manager")
-        self.conn = psycopg2.connect(
-            database="mcConnect-TestDB-1",
-            host="localhost",
-            user="admin",
-            password="admin",
-            port="5432",
-        )
+        self.conn = psycopg2.connect(**DB_CONNECTION_PARAMS)
         logger.info("Established connection to the database")
         self.cursor = self.conn.cursor()
-
-        if (not self._check_database_integrity()) or RESET_DATABASE:
-            print("RESET DATABASE")
-            print(self._check_database_integrity())
-            self._reset_database()
-            self._prefill_database()
+        self._prepared_statements = weakref.WeakKeyDictionary()  # connection -> names of the prepared statements
+        self._player_ids = collections.OrderedDict()  # (server_id, mojang_uuid) -> player_id, least recently used first
+        self._stat_categories = {category: {} for category in STATS_CATEGORIES}  # json category -> {object: database category}
+        self._stat_categories_size = 0
+        self._stats_history_partitions = set()
+        self._prepare_schema()
 
     ################################ DB INIT FUNCTIONS ###################################
+
+    def _prepare_schema(self):
+        """
+        Checks, resets and migrates the schema once per process. Further managers of the process (ingest shards,
+        reconciler) skip it, and the advisory lock keeps other processes from migrating at the same time.
+        """
+        global _schema_ready
+        with _schema_lock:
+            if _schema_ready:
+                return
+            self.cursor.execute("SELECT pg_advisory_lock(%s);", (SCHEMA_LOCK_ID,))
+            try:
+                if (not self._check_database_integrity()) or RESET_DATABASE:
+                    print("RESET DATABASE")
+                    print(self._check_database_integrity())
+                    self._reset_database()
+                    self._prefill_database()
+                self._apply_migrations()
+                self._sync_stats_category_mapping()
+                if STATS_HISTORY_ENABLED:
+                    self.ensure_stats_history_partitions()
+            finally:
+                self.conn.rollback()  # a failed step leaves the transaction aborted; the session lock survives
+                self.cursor.execute("SELECT pg_advisory_unlock(%s);", (SCHEMA_LOCK_ID,))
+                self.conn.commit()
+            _schema_ready = True
+
+    def _reconnect(self):
+        logger.warning("Database connection is closed, reconnecting")
+        self.conn = psycopg2.connect(**DB_CONNECTION_PARAMS)
+        self.cursor = self.conn.cursor()
+
+    def is_available(self):
+        """
+        Tells if database calls are let through by the circuit breaker. Callers that can degrade
+        (defer writes, serve cached data) check this before they call the database.
+        """
+        return self._breaker.available()
+
+    def get_circuit_state(self):
+        return {"state": self._breaker.state, **self._breaker.counters}
     
     def _check_database_integrity(self):
         """
@@ -159,6 +397,63 @@ class DatabaseManager:
         self.conn.commit()
         logger.info(f"Tables initiated successfully")
 
+    def _apply_migrations(self):
+        """
+        Executes all sql files from the migrations folder in alphabetical order.
+        Every migration has to be idempotent because they are run on every start.
+        """
+        logger.debug("apply_migrations is called")
+        for file_name in sorted(os.listdir(MIGRATIONS_DIR)):
+            if not file_name.endswith(".sql"):
+                continue
+            logger.debug(f"applying migration: {file_name}")
+            self.cursor.execute(read_sql_file(os.path.join(MIGRATIONS_DIR, file_name)))
+        self.conn.commit()
+        logger.info("Migrations applied successfully")
+
+    def _sync_stats_category_mapping(self):
+        """
+        Copies DB_CATEGORY_MAPPING and the tool/armor substrings into the lookup tables used by ingest_player_stats().
+        """
+        logger.debug("sync_stats_category_mapping is called")
+        self.cursor.execute("DELETE FROM stats_category_mapping; DELETE FROM item_group_patterns;")
+        mapping = [(item_group, json_category, category)
+                   for item_group, categories in DB_CATEGORY_MAPPING.items()
+                   for json_category, category in categories.items()]
+        execute_values(self.cursor, "INSERT INTO stats_category_mapping (item_group, json_category, category) VALUES %s", mapping)
+        patterns = [(pattern, "tool") for pattern in TOOLS_SUBSTRINGS] + [(pattern, "armor") for pattern in ARMOR_SUBSTRINGS]
+        execute_values(self.cursor, "INSERT INTO item_group_patterns (pattern, item_group) VALUES %s", patterns)
+        self.conn.commit()
+
+    ################################ PREPARED STATEMENTS ###################################
+
+    def _execute_prepared(self, name, data, cursor=None):
+        """
+        Executes a statement from PREPARED_STATEMENTS. The statement is prepared on the first use per connection,
+        so it works the same way for the own connection and for any other (e.g. pooled) connection.
+
+        Parameters:
+        name (str): The key of the statement in PREPARED_STATEMENTS.
+        data (tuple): The parameters in the order of $1, $2, ...
+        cursor (cursor, optional): The cursor to execute on. Defaults to self.cursor.
+
+        Returns:
+        cursor: The cursor the statement was executed on, ready to fetch.
+        """
+        cursor = cursor or self.cursor
+        parameter_types, statement = PREPARED_STATEMENTS[name]
+        if not USE_PREPARED_STATEMENTS:  # bind by $n, the placeholders may be out of order or repeated
+            parameters = [data[int(index) - 1] for index in re.findall(r"\$(\d+)", statement)]
+            cursor.execute(re.sub(r"\$\d+", "%s", statement), parameters)
+            return cursor
+        prepared = self._prepared_statements.setdefault(cursor.connection, set())
+        if name not in prepared:
+            logger.debug(f"preparing statement: {name}")
+            cursor.execute(f"PREPARE {name} ({parameter_types}) AS {statement}")
+            prepared.add(name)
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(data))})", data)
+        return cursor
+
     ################################ PREFILL FUNCTIONS ###################################
     
     def _prefill_database(self):
@@ -243,11 +538,62 @@ class DatabaseManager:
         Returns:
         String: The ID of the added player server info.
         """
-        query = "INSERT INTO player_server_info (mojang_uuid, server_id, web_access_permissions) VALUES (%s, %s, %s)"
+        query = "INSERT INTO player_server_info (mojang_uuid, server_id, web_access_permissions) VALUES (%s, %s, %s) RETURNING player_id"
         data = (mojang_uuid, server_id, web_access_permissions)
         self.cursor.execute(query, data)
+        player_id = self.cursor.fetchone()[0]
         self.conn.commit()
+        self._cache_player_ids(server_id, {mojang_uuid: player_id})
+        return player_id
+
+    def add_players(self, server_id, mojang_uuids, web_access_permissions=DEFAULT_WEB_ACCESS_LEVEL):
+        """
+        Adds many players and their server information in one transaction, e.g. for a newly onboarded server.
+        The usernames are looked up in parallel before the connection is taken, so no transaction waits for the
+        player api.
+
+        Parameters:
+        server_id (int): The ID of the server.
+        mojang_uuids (list): The UUIDs of the players.
+        web_access_permissions (int, optional): The web access permissions of the players. Defaults to DEFAULT_WEB_ACCESS_LEVEL.
+
+        Returns:
+        dict: {mojang_uuid: player_id} of the added players, lowercase uuids
+        """
+        logger.debug("add_players is called")
+        names = minecraft.get_player_names_from_mojang_uuids_online(mojang_uuids)
+        return self._insert_players(server_id, names, web_access_permissions)
+
+    def _insert_players(self, server_id, names, web_access_permissions=DEFAULT_WEB_ACCESS_LEVEL):
+        player_ids = self._add_players_to_server(server_id, names, web_access_permissions)
+        self.conn.commit()
+        self._cache_player_ids(server_id, player_ids)
+        logger.info(f'Added {len(player_ids)} of {len(names)} players to server: "{server_id}"')
+        return player_ids
     
+    def _add_players_to_server(self, server_id, names, web_access_permissions=DEFAULT_WEB_ACCESS_LEVEL):
+        """
+        Adds many players and their server information with one statement per table. Does not commit and does not
+        fill the player id cache, because the ids are only valid once the caller committed.
+
+        Parameters:
+        names (dict): {mojang_uuid: username} looked up before the call, -1 for failed lookups
+
+        Returns:
+        dict: {mojang_uuid: player_id} of the added players, lowercase uuids
+        """
+        logger.debug(f"Adding {len(names)} players to server: {server_id}")
+        players = [(mojang_uuid, str(name)) for mojang_uuid, name in names.items()]
+        query = """ INSERT INTO player (uuid, name) VALUES %s
+                    ON CONFLICT (uuid) DO NOTHING;"""
+        execute_values(self.cursor, query, players, template="(%s::uuid, %s)", page_size=len(players))
+        query = """ INSERT INTO player_server_info (mojang_uuid, server_id, web_access_permissions) VALUES %s
+                    ON CONFLICT DO NOTHING
+                    RETURNING mojang_uuid, player_id;"""
+        data = [(mojang_uuid, server_id, web_access_permissions) for mojang_uuid in names]
+        result = execute_values(self.cursor, query, data, template="(%s::uuid, %s, %s)", page_size=len(data), fetch=True)
+        return {str(mojang_uuid).lower(): player_id for mojang_uuid, player_id in result}
+
     def add_player(self, mojang_uuid):
         """
         Adds mojang_uuid and minecraft_username to the database.
@@ -425,72 +771,504 @@ class DatabaseManager:
 
         return updated_rows > 0
 
-    def update_player_stats(self, player_id, stats):
+    def update_player_stats(self, player_id, stats, server_id=None):
+        """
+        Upserts the stats of a player into the actions table and updates the leaderboards and totals of the server.
+        If STATS_HISTORY_ENABLED is set, every changed value is additionally appended to actions_history.
+        Stats that are identical to the last ones of the player are only marked as synced.
+
+        Parameters:
+        player_id (str): The ID of the player.
+        stats (str | bytes): The raw stats json sent by the plugin.
+        server_id (int, optional): The ID of the server. Looked up from the player id if not provided.
+
+        Returns:
+        bool: True if the stats were written.
+        """
         logger.info("update_player_stats is called")
-        items = self.split_items_from_json(stats)
-        query = """ INSERT INTO actions (player_id, object, category, value)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (player_id, object, category)
-                    DO UPDATE SET
-                    "value" = EXCLUDED.value
-                    WHERE actions.value IS DISTINCT FROM EXCLUDED.value;"""
-        data = [(player_id, item[0], item[1], item[2]) for item in items if item[2] != 0]
-
-        logger.debug(f"Executing SQL query: {query}")
-        logger.debug(f"With following data: {data}")
-        
-        #start_time = time.time()
-        self.cursor.executemany(query, data)
+        recorded_at = datetime.now()
+        changed = self._write_player_stats(player_id, stats, recorded_at)
+        if changed:
+            self._apply_rollups(server_id or self.get_server_id_from_player_id(player_id), {player_id: changed})
         self.conn.commit()
-        #end_time = time.time()
-    
-        #elapsed_time = end_time - start_time
-        logger.info(f'Updated player: "{player_id}" stats with {self.cursor.rowcount} items.')
-        self.conn.commit()
-        #logger.info(f'Updated player: "{player_id}" stats with {self.cursor.rowcount} items in {elapsed_time} seconds.')
+        if changed is None:
+            logger.info(f'Stats of player: "{player_id}" are unchanged')
+        else:
+            logger.info(f'Updated player: "{player_id}" stats with {len(changed)} changed items.')
 
         return True
 
+    def update_player_stats_batch(self, server_id, stats_by_uuid):
+        """
+        Writes the stats of many players of one server in a single transaction.
+        The player ids are resolved with one query, unknown players are created in bulk.
+        The ingest calls it once per shard, so the players of one !STATSBATCH may be committed in
+        several independent transactions. Their usernames are
+        looked up before the connection is taken, so the transaction never waits for the player api.
+
+        Parameters:
+        server_id (int): The ID of the server.
+        stats_by_uuid (dict): {mojang_uuid: raw stats json}
+
+        Returns:
+        int: The number of players whose stats changed.
+        """
+        logger.info("update_player_stats_batch is called")
+        unknown = self._get_unknown_players(server_id, list(stats_by_uuid))
+        names = minecraft.get_player_names_from_mojang_uuids_online(unknown) if unknown else {}
+        return self._write_player_stats_batch(server_id, stats_by_uuid, names)
+
+    def _get_unknown_players(self, server_id, mojang_uuids):
+        player_ids = self.get_player_ids_from_mojang_uuids_and_server_id(mojang_uuids, server_id)
+        self.conn.commit()  # do not keep the read transaction open while the usernames are looked up
+        return [mojang_uuid for mojang_uuid in mojang_uuids if mojang_uuid.lower() not in player_ids]
+
+    def _write_player_stats_batch(self, server_id, stats_by_uuid, names):
+        player_ids = self.get_player_ids_from_mojang_uuids_and_server_id(list(stats_by_uuid), server_id)
+        missing = {mojang_uuid: name for mojang_uuid, name in names.items() if mojang_uuid.lower() not in player_ids}
+        added = self._add_players_to_server(server_id, missing) if missing else {}
+        player_ids.update(added)
+
+        recorded_at = datetime.now()
+        changed_players = 0
+        changed_by_player = {}
+        for mojang_uuid, stats in stats_by_uuid.items():
+            player_id = player_ids.get(mojang_uuid.lower())
+            if player_id is None:
+                logger.warning(f'Skipping stats of uuid: "{mojang_uuid}", it could not be added to server: "{server_id}"')
+                continue
+            changed = self._write_player_stats(player_id, stats, recorded_at)
+            if changed is not None:
+                changed_players += 1
+            if changed:
+                changed_by_player[player_id] = changed
+        if changed_by_player:
+            self._apply_rollups(server_id, changed_by_player)
+        self.conn.commit()
+        self._cache_player_ids(server_id, added)
+        logger.info(f'Updated stats of {changed_players} of {len(stats_by_uuid)} players of server: "{server_id}"')
+        return changed_players
+
+    def _write_player_stats(self, player_id, stats, recorded_at):
+        """
+        Writes the stats and the history of one player, the caller applies the rollups with _apply_rollups.
+        Does not commit.
+
+        Returns:
+        list: [(object, category, value, delta),] of all changed counters, None if the stats are unchanged.
+        """
+        digest = hashlib.sha1(stats if isinstance(stats, bytes) else stats.encode("utf-8")).hexdigest()
+        previous = self._execute_prepared("swap_stats_digest", (player_id, digest)).fetchone()
+        if previous and previous[0] == digest:
+            return None
+        if SERVER_SIDE_STATS_INGEST:
+            changed = self._ingest_player_stats_server_side(player_id, stats)
+        else:
+            changed = self._upsert_player_stats(player_id, stats)
+
+        if STATS_HISTORY_ENABLED and changed:
+            self._append_stats_history(player_id, changed, recorded_at)
+        return changed
+
+    def _apply_rollups(self, server_id, changed_by_player):
+        """
+        Updates the leaderboards and totals of the server once for all players of a transaction, at its end.
+        The rows of the server are shared by every ingest shard, so they are written in one statement each,
+        sorted by (category, object), which makes concurrent batches lock them in the same order. Does not commit.
+
+        Parameters:
+        server_id (int): The ID of the server.
+        changed_by_player (dict): {player_id: [(object, category, value, delta),]} as returned by the actions upsert.
+        """
+        self._update_leaderboards(server_id, changed_by_player)
+        self._apply_server_stat_totals(server_id, [row for rows in changed_by_player.values() for row in rows])
+
+    def _upsert_player_stats(self, player_id, stats):
+        """
+        Parses and classifies the stats in python and upserts them in one statement. Does not commit.
+
+        Returns:
+        list: [(object, category, value, delta),] of all changed counters
+        """
+        objects, categories, values = self.parse_stats_columns(stats)
+        if not objects:
+            return []
+        logger.debug(f"Upserting {len(objects)} stats for player: {player_id}")
+        return self._execute_prepared("upsert_player_stats", (player_id, objects, categories, values)).fetchall()
+
+    def _ingest_player_stats_server_side(self, player_id, stats):
+        """
+        Sends the raw stats json to ingest_player_stats() which parses, classifies and upserts it in one round trip.
+        Does not commit.
+
+        Returns:
+        list: [(object, category, value, delta),] of all changed counters
+        """
+        stats = stats.decode("utf-8") if isinstance(stats, bytes) else stats  # bytes would be sent as bytea
+        return self._execute_prepared("ingest_player_stats", (player_id, stats)).fetchall()
+
     def update_player_status_from_mojang_uuid_and_server_id(self, mojang_uuid, server_id, status):
         logger.info("update_player_status_from_mojang_uuid_and_server_id is called")
-        query = """
-                UPDATE player_server_info
-                SET online = %s
-                WHERE mojang_uuid = %s
-                AND server_id = %s
-                """
         data = (True if status == "online"  else False, mojang_uuid, server_id)
-
-        logger.debug(f"Executing SQL query: {query}")
         logger.debug(f"With following data: {data}")
+        updated = self._execute_prepared("update_player_status", data).rowcount
+        if updated:  # unknown players are not announced as online
+            self._notify_online_players({"server_id": server_id, "uuid": mojang_uuid, "online": data[0]})
+        self.conn.commit()
+        return True
+
+    def update_player_statuses(self, changes, sessions=()):
+        """
+        Writes many online status changes with one statement and publishes the changes of the updated rows
+        on ONLINE_PLAYERS_CHANNEL.
+        first_seen is set on the first change of a player, last_seen on every change.
+        The closed sessions are stored in the same transaction.
+
+        Parameters:
+        changes (list): [(server_id, mojang_uuid, online, seen_at),] with at most one entry per player and server.
+        sessions (list, optional): [(server_id, mojang_uuid, session_start, session_end),] of closed sessions.
+        """
+        logger.info("update_player_statuses is called")
+        if sessions:
+            self._add_sessions(sessions)
+        if not changes:
+            self.conn.commit()
+            return
+        query = """ UPDATE player_server_info psi
+                    SET online = v.online,
+                    first_seen = COALESCE(psi.first_seen, v.seen_at),
+                    last_seen = v.seen_at
+                    FROM (VALUES %s) AS v (server_id, mojang_uuid, online, seen_at)
+                    WHERE psi.server_id = v.server_id AND psi.mojang_uuid = v.mojang_uuid
+                    RETURNING psi.server_id, psi.mojang_uuid, psi.online;"""
+        logger.debug(f"With following data: {changes}")
+        updated = execute_values(self.cursor, query, changes, template="(%s, %s::uuid, %s, %s::timestamp)",
+                                 page_size=len(changes), fetch=True)
+        payloads = [json.dumps({"server_id": server_id, "uuid": str(mojang_uuid), "online": online})
+                    for server_id, mojang_uuid, online in updated]
+        if payloads:  # rows of unknown players were not updated and are not announced
+            self.cursor.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload;", (ONLINE_PLAYERS_CHANNEL, payloads))
+        self.conn.commit()
+        logger.info(f"Updated the online status of {len(updated)} of {len(changes)} players")
+
+    def _add_sessions(self, sessions):
+        """
+        Inserts closed sessions and adds their playtime to daily_playtime, split at midnight. Does not commit.
+        Sessions of players without a player_server_info row are dropped.
+
+        Parameters:
+        sessions (list): [(server_id, mojang_uuid, session_start, session_end),]
+        """
+        query = """ WITH inserted AS (
+                        INSERT INTO sessions (player_id, server_id, session_start, session_end)
+                        SELECT psi.player_id, psi.server_id, v.session_start, v.session_end
+                        FROM (VALUES %s) AS v (server_id, mojang_uuid, session_start, session_end)
+                        JOIN player_server_info psi ON psi.server_id = v.server_id AND psi.mojang_uuid = v.mojang_uuid
+                        WHERE v.session_end > v.session_start
+                        RETURNING player_id, server_id, session_start, session_end
+                    )
+                    INSERT INTO daily_playtime (player_id, day, server_id, seconds)
+                    SELECT i.player_id, d.day::date, i.server_id,
+                    SUM(EXTRACT(EPOCH FROM LEAST(i.session_end, d.day + INTERVAL '1 day') - GREATEST(i.session_start, d.day)))::integer
+                    FROM inserted i
+                    CROSS JOIN LATERAL generate_series(date_trunc('day', i.session_start), i.session_end, INTERVAL '1 day') AS d (day)
+                    GROUP BY i.player_id, d.day, i.server_id
+                    ON CONFLICT (player_id, day)
+                    DO UPDATE SET seconds = daily_playtime.seconds + EXCLUDED.seconds;"""
+        logger.debug(f"Adding {len(sessions)} sessions")
+        execute_values(self.cursor, query, sessions, template="(%s, %s::uuid, %s::timestamp, %s::timestamp)", page_size=len(sessions))
+
+    def get_daily_playtime(self, player_id, start, end=None):
+        """
+        Returns the playtime of a player per day from the daily_playtime rollup.
+
+        Parameters:
+        player_id (str): The ID of the player.
+        start (date): The first day.
+        end (date, optional): The day after the last day. Defaults to tomorrow.
+
+        Returns:
+        list: [(day, seconds),] sorted by day, days without playtime are missing
+        """
+        logger.debug("get_daily_playtime is called")
+        end = end or (datetime.now() + timedelta(days=1)).date()
+        query = QUERIES["get_daily_playtime"]
+        data = (player_id, start, end)
+        logger.debug(f"with following data: {data}")
+        self.cursor.execute(query, data)
+        result = self.cursor.fetchall()
+        logger.info(f'Found playtime of {len(result)} days for player id: "{player_id}"')
+        return result
+
+    def get_player_sessions(self, player_id, start, end=None):
+        """
+        Returns the sessions of a player that started in [start, end).
+
+        Returns:
+        list: [(session_start, session_end),] sorted by start
+        """
+        logger.debug("get_player_sessions is called")
+        end = end or datetime.now()
+        query = QUERIES["get_player_sessions"]
+        data = (player_id, start, end)
+        logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
+        result = self.cursor.fetchall()
+        logger.info(f'Found {len(result)} sessions for player id: "{player_id}"')
+        return result
+
+    def set_all_players_offline_by_server_id(self, server_id):
+        """
+        Marks every player of a server as offline, e.g. after the server disconnected from the socket.
+        """
+        logger.info("set_all_players_offline_by_server_id is called")
+        query = """ UPDATE player_server_info
+                    SET online = false
+                    WHERE server_id = %s AND online;"""
+        self.cursor.execute(query, (server_id,))
+        self._notify_online_players({"server_id": server_id, "reset": True})
         self.conn.commit()
+        logger.info(f'Set {self.cursor.rowcount} players of server: "{server_id}" offline')
+
+    def set_all_players_offline(self):
+        """
+        Marks every player as offline. Called when the socket starts, because no server is connected at that point.
+        """
+        logger.info("set_all_players_offline is called")
+        self.cursor.execute("UPDATE player_server_info SET online = false WHERE online;")
+        self._notify_online_players({"reset": True})
+        self.conn.commit()
+        logger.info(f"Set {self.cursor.rowcount} players offline")
+
+    def _notify_online_players(self, payload):
+        """
+        Publishes an online status change on ONLINE_PLAYERS_CHANNEL. Delivered to the listeners on commit.
+        """
+        self.cursor.execute("SELECT pg_notify(%s, %s);", (ONLINE_PLAYERS_CHANNEL, json.dumps(payload)))
+
+    def get_stats_sync_state(self, server_id):
+        """
+        Returns when the stats of every player of a server were received last, for the resync after a reconnect.
+
+        Returns:
+        list: [(mojang_uuid, stats_synced_at),] stats_synced_at is None if no stats were received yet
+        """
+        logger.debug("get_stats_sync_state is called")
+        query = QUERIES["get_stats_sync_state"]
+        data = (server_id,)
+        logger.debug(f"with following data: {data}")
+        self.cursor.execute(query, data)
+        result = self.cursor.fetchall()
+        logger.info(f'Found the sync state of {len(result)} players for server: "{server_id}"')
+        return result
+
+    def get_all_online_players(self):
+        """
+        Returns: [(server_id, mojang_uuid),] of every online player
+        """
+        logger.debug("get_all_online_players is called")
+        self.cursor.execute("SELECT server_id, mojang_uuid FROM player_server_info WHERE online;")
+        return self.cursor.fetchall()
         
 
+    ############################## CONNECTION REGISTRY ################################
+
+    def register_connection(self, server_id, node_id, worker_pid):
+        """
+        Records that a socket worker holds the connection of a server. A newer connection replaces the old entry.
+        """
+        logger.debug("register_connection is called")
+        query = """ INSERT INTO connection_registry (server_id, node_id, worker_pid, connected_at, heartbeat)
+                    VALUES (%s, %s, %s, NOW(), NOW())
+                    ON CONFLICT (server_id)
+                    DO UPDATE SET node_id = EXCLUDED.node_id, worker_pid = EXCLUDED.worker_pid,
+                    connected_at = EXCLUDED.connected_at, heartbeat = EXCLUDED.heartbeat;"""
+        data = (server_id, node_id, worker_pid)
+        logger.debug(f"with following data: {data}")
+        self.cursor.execute(query, data)
+        self.conn.commit()
+
+    def unregister_connection(self, server_id, node_id, worker_pid):
+        """
+        Removes the entry of a server if it still belongs to the given worker.
+
+        Returns:
+        bool: False if the server already reconnected to another worker.
+        """
+        logger.debug("unregister_connection is called")
+        query = "DELETE FROM connection_registry WHERE server_id = %s AND node_id = %s AND worker_pid = %s;"
+        data = (server_id, node_id, worker_pid)
+        logger.debug(f"with following data: {data}")
+        self.cursor.execute(query, data)
+        removed = self.cursor.rowcount > 0
+        self.conn.commit()
+        return removed
+
+    def remove_connections_of_worker(self, node_id, worker_pid=None):
+        """
+        Removes the entries of a crashed worker, or of all workers of a node if worker_pid is None.
+
+        Returns:
+        list: The server ids whose entries were removed.
+        """
+        logger.debug("remove_connections_of_worker is called")
+        query = """ DELETE FROM connection_registry
+                    WHERE node_id = %s AND (%s IS NULL OR worker_pid = %s)
+                    RETURNING server_id;"""
+        data = (node_id, worker_pid, worker_pid)
+        logger.debug(f"with following data: {data}")
+        self.cursor.execute(query, data)
+        server_ids = [row[0] for row in self.cursor.fetchall()]
+        self.conn.commit()
+        logger.info(f'Removed {len(server_ids)} connections of node: "{node_id}" (worker: {worker_pid})')
+        return server_ids
+
+    def refresh_connections(self, node_id, worker_pid):
+        """
+        Refreshes the heartbeat of all registry entries of a worker.
+
+        Returns:
+        list: The server ids that still have an entry of this worker.
+        """
+        logger.debug("refresh_connections is called")
+        query = """ UPDATE connection_registry SET heartbeat = NOW()
+                    WHERE node_id = %s AND worker_pid = %s
+                    RETURNING server_id;"""
+        self.cursor.execute(query, (node_id, worker_pid))
+        server_ids = [row[0] for row in self.cursor.fetchall()]
+        self.conn.commit()
+        return server_ids
+
+    def reap_stale_connections(self, max_age):
+        """
+        Removes the registry entries whose heartbeat is older than max_age seconds, e.g. of a node that died,
+        and sets the players of every server without an entry offline.
+
+        Returns:
+        list: The server ids whose players were set offline.
+        """
+        logger.debug("reap_stale_connections is called")
+        query = """ DELETE FROM connection_registry
+                    WHERE heartbeat < NOW() - make_interval(secs => %s)
+                    RETURNING server_id, node_id;"""
+        self.cursor.execute(query, (max_age,))
+        for server_id, node_id in self.cursor.fetchall():
+            logger.warning(f'Reaped stale connection of server: "{server_id}" on node: "{node_id}"')
+        query = """ SELECT DISTINCT psi.server_id FROM player_server_info psi
+                    WHERE psi.online
+                    AND NOT EXISTS (SELECT 1 FROM connection_registry cr WHERE cr.server_id = psi.server_id);"""
+        self.cursor.execute(query)
+        server_ids = [row[0] for row in self.cursor.fetchall()]
+        self.conn.commit()
+        for server_id in server_ids:
+            self.set_all_players_offline_by_server_id(server_id)
+        return server_ids
+
+    def send_command_to_server(self, server_id, message=None, action="send"):
+        """
+        Publishes a command for a server on SOCKET_COMMANDS_CHANNEL. The socket worker holding the connection of
+        the server executes it, no matter on which node it runs.
+
+        Parameters:
+        server_id (int): The ID of the server.
+        message (str, optional): The message to send to the server for action "send".
+        action (str, optional): "send" or "resync". Defaults to "send".
+
+        Returns:
+        bool: False if the server is not connected to any socket worker.
+        """
+        logger.debug("send_command_to_server is called")
+        owner = self.get_connection_owner(server_id)
+        if owner is None:
+            logger.warning(f'Server: "{server_id}" is not connected, dropping command')
+            return False
+        payload = {"server_id": server_id, "node_id": owner[0], "worker_pid": owner[1], "action": action, "message": message}
+        self.cursor.execute("SELECT pg_notify(%s, %s);", (SOCKET_COMMANDS_CHANNEL, json.dumps(payload)))
+        self.conn.commit()
+        return True
+
+    def get_connected_servers(self):
+        """
+        Returns:
+        list: [(server_id, node_id, worker_pid, connected_at, heartbeat),] of all connected servers
+        """
+        logger.debug("get_connected_servers is called")
+        self.cursor.execute("SELECT server_id, node_id, worker_pid, connected_at, heartbeat FROM connection_registry ORDER BY server_id;")
+        return self.cursor.fetchall()
+
+    def get_connection_owner(self, server_id):
+        """
+        Returns:
+        tuple: (node_id, worker_pid) of the worker holding the connection of the server, None if it is not connected.
+        """
+        logger.debug("get_connection_owner is called")
+        self.cursor.execute("SELECT node_id, worker_pid FROM connection_registry WHERE server_id = %s;", (server_id,))
+        return self.cursor.fetchone()
+
     ################################ GET FUNCTIONS ####################################
 
     ###----------------------------- PLAYER IDs ------------------------------------###
+    def _cache_player_ids(self, server_id, player_ids):
+        """
+        Remembers committed {mojang_uuid: player_id} of a server, evicting the least recently used entries.
+        """
+        for mojang_uuid, player_id in player_ids.items():
+            key = (server_id, str(mojang_uuid).lower())
+            self._player_ids[key] = player_id
+            self._player_ids.move_to_end(key)
+        while len(self._player_ids) > PLAYER_ID_CACHE_SIZE:
+            self._player_ids.popitem(last=False)
+
+    def _get_cached_player_id(self, server_id, mojang_uuid):
+        key = (server_id, str(mojang_uuid).lower())
+        player_id = self._player_ids.get(key)
+        if player_id is not None:
+            self._player_ids.move_to_end(key)
+        return player_id
+
     def get_player_id_from_mojang_uuid_and_server_id(self, mojang_uuid, server_id):
         logger.debug("get_player_id_from_mojang_uuid_and_server_id is called")
-        query = "SELECT player_id FROM player_server_info WHERE mojang_uuid = %s AND server_id = %s"
-        logger.debug(f"executing SQL query: {query}")
+        player_id = self._get_cached_player_id(server_id, mojang_uuid)
+        if player_id is not None:
+            return player_id
         data = (mojang_uuid, server_id)
         logger.debug(f"with following data: {data}")
-        self.cursor.execute(query, data)
-        result = self.cursor.fetchone()
+        result = self._execute_prepared("player_id_by_uuid_and_server_id", data).fetchone()
         if result is None:
             logger.warning(f'No player found for uuid: "{mojang_uuid}" and server: "{server_id}"')
             return None
         player_id = result[0]
+        self._cache_player_ids(server_id, {mojang_uuid: player_id})
         logger.info(f'Found player id: "{player_id}" for uuid: "{mojang_uuid}" and server: "{server_id}"')
         return player_id
 
+    def get_player_ids_from_mojang_uuids_and_server_id(self, mojang_uuids, server_id):
+        """
+        Returns:
+        dict: {mojang_uuid: player_id} of the players that exist on the server, lowercase uuids
+        """
+        logger.debug("get_player_ids_from_mojang_uuids_and_server_id is called")
+        result = {}
+        for mojang_uuid in mojang_uuids:
+            player_id = self._get_cached_player_id(server_id, mojang_uuid)
+            if player_id is not None:
+                result[mojang_uuid.lower()] = player_id
+        uncached = [mojang_uuid for mojang_uuid in mojang_uuids if mojang_uuid.lower() not in result]
+        if uncached:
+            query = """ SELECT mojang_uuid, player_id FROM player_server_info
+                        WHERE server_id = %s AND mojang_uuid = ANY(%s::uuid[]);"""
+            data = (server_id, uncached)
+            logger.debug(f"with following data: {data}")
+            self.cursor.execute(query, data)
+            found = {str(mojang_uuid).lower(): player_id for mojang_uuid, player_id in self.cursor.fetchall()}
+            self._cache_player_ids(server_id, found)
+            result.update(found)
+        logger.info(f'Found {len(result)} of {len(mojang_uuids)} player ids for server: "{server_id}"')
+        return result
+
     def get_player_id_from_mojang_uuid_and_subdomain(self, mojang_uuid, subdomain):
         logger.debug("get_player_id_from_mojang_uuid_and_subdomain is called")
-        query = """SELECT psi.id
-                FROM player_server_info psi
-                JOIN servers s ON psi.server_id = s.id
-                WHERE psi.mojang_uuid = %s AND s.subdomain = %s;"""
+        query = QUERIES["get_player_id_from_mojang_uuid_and_subdomain"]
         data = (mojang_uuid, subdomain,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -504,7 +1282,7 @@ class DatabaseManager:
 
     def get_mojang_uuid_from_player_id(self, player_id):
         logger.debug("get_mojang_uuid_from_player_id is called")
-        query = """SELECT mojang_uuid FROM player_server_info WHERE player_id = %s"""
+        query = QUERIES["get_mojang_uuid_from_player_id"]
         data = (player_id,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -518,14 +1296,8 @@ class DatabaseManager:
 
     def get_server_id_from_player_id(self, player_id):
         logger.info("get_server_id_from_player_id is called")
-        query = """
-                SELECT server_id 
-                FROM player_server_info
-                WHERE player_id = %s
-        """
         data = (player_id, )
-        self.cursor.execute(query, data)
-        result = self.cursor.fetchone()
+        result = self._execute_prepared("server_id_by_player_id", data).fetchone()
         if result is None:
             logger.warning(f'No server id found for player id: "{player_id}"')
             return None
@@ -534,7 +1306,7 @@ class DatabaseManager:
 
     def get_mojang_uuid_from_player_name(self, player_name):
         logger.debug("get_mojang_uuid_from_player_name is called")
-        query = """SELECT mojang_uuid FROM player WHERE name = %s"""
+        query = QUERIES["get_mojang_uuid_from_player_name"]
         data = (player_name,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -548,7 +1320,7 @@ class DatabaseManager:
 
     def get_player_name_from_mojang_uuid(self, mojang_uuid):
         logger.debug("get_player_name_from_mojang_uuid is called")
-        query = """SELECT name FROM player WHERE mojang_uuid = %s"""
+        query = QUERIES["get_player_name_from_mojang_uuid"]
         data = (mojang_uuid,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -562,10 +1334,7 @@ class DatabaseManager:
 
     def get_player_name_from_player_id(self, player_id):
         logger.debug("get_player_name_from_player_id is called")
-        query = """SELECT p.name
-                FROM player p
-                JOIN player_server_info psi ON p.uuid = psi.mojang_uuid
-                WHERE psi.player_id = %s"""
+        query = QUERIES["get_player_name_from_player_id"]
         data = (player_id,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -579,7 +1348,7 @@ class DatabaseManager:
 
     def get_prefix_id_by_player_id(self, player_id):
         logger.debug("get_prefix_id_by_player_id is called")
-        query = """ SELECT prefix FROM player_server_info WHERE player_id=%s"""
+        query = QUERIES["get_prefix_id_by_player_id"]
         data = (player_id,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -604,9 +1373,7 @@ class DatabaseManager:
     
     def get_ban_reason_from_player_id(self, player_id):
         logger.debug("get_ban_reason_from_player_id is called")
-        query = """SELECT br.reason FROM ban_reasons br
-                    JOIN banned_players bp ON br.id = bp.ban_reason_id
-                    WHERE bp.banned_player_id = %s"""
+        query = QUERIES["get_ban_reason_from_player_id"]
         data = (player_id,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -620,7 +1387,7 @@ class DatabaseManager:
     
     def get_server_id_from_subdomain(self, subdomain):
         logger.debug("get_server_id_from_subdomain is called")
-        query = "SELECT id FROM servers WHERE subdomain = %s"
+        query = QUERIES["get_server_id_from_subdomain"]
         data = (subdomain,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -647,7 +1414,7 @@ class DatabaseManager:
 
     def get_all_player_ids_from_subdomain(self, subdomain):
         logger.debug("get_all_player_ids_from_subdomain is called")
-        query = """SELECT player_id FROM player_server_info WHERE server_id IN (SELECT id FROM servers WHERE subdomain = %s)"""
+        query = QUERIES["get_all_player_ids_from_subdomain"]
         data = (subdomain,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -657,49 +1424,47 @@ class DatabaseManager:
    
     def get_online_player_count_from_subdomain(self, subdomain):
         logger.debug("get_online_player_count_from_subdomain is called")
-        query = """SELECT COUNT(*) FROM player_server_info WHERE server_id IN (SELECT id FROM servers WHERE subdomain = %s) AND online = true"""
         data = (subdomain,)
         logger.debug(f"with following data: {data}")
-        self.cursor.execute(query, data)
-        result = self.cursor.fetchone()
+        result = self._execute_prepared("online_player_count_by_subdomain", data).fetchone()
         logger.info(f'Found online player count: "{result[0]}" for subdomain: "{subdomain}"')        
         return result[0]
    
     def get_first_seen_by_player_id(self, player_id):
         logger.debug("get_first_seen_by_player_id is called")
-        query = """SELECT first_seen FROM player_server_info WHERE player_id = %s"""
         data = (player_id,)
         logger.debug(f"with following data: {data}")
-        self.cursor.execute(query, data)
-        result = self.cursor.fetchone()
+        result = self._execute_prepared("first_seen_by_player_id", data).fetchone()
         logger.info(f'Found first seen timestamp: "{result[0]}" for player id: "{player_id}"')
         return result[0]
    
     def get_last_seen_by_player_id(self, player_id):
         logger.debug("get_last_seen_by_player_id is called")
-        query = """SELECT last_seen FROM player_server_info WHERE player_id = %s"""
         data = (player_id,)
         logger.debug(f"with following data: {data}")
-        self.cursor.execute(query, data)
-        result = self.cursor.fetchone()
+        result = self._execute_prepared("last_seen_by_player_id", data).fetchone()
         logger.info(f'Found last seen timestamp: "{result[0]}" for player id: "{player_id}"')
         return result[0]
    
     def get_server_id_by_auth_key(self, auth_key):
         logger.debug("get_server_id_by_auth_key is called")
-        query = """ SELECT id FROM servers WHERE server_key = %s; """
         data = (auth_key,)
         logger.debug(f"with following data: {data}")
-        self.cursor.execute(query, data)
-        result = self.cursor.fetchone()
+        result = self._execute_prepared("server_id_by_auth_key", data).fetchone()
         result = result[0] if result else None
         logger.info(f'Found server id: "{result}" for auth_key: "{auth_key}"')
         return result
     
 
+    def get_license_type_from_server_id(self, server_id):
+        logger.debug("get_license_type_from_server_id is called")
+        self.cursor.execute("SELECT license_type FROM servers WHERE id = %s", (server_id,))
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
     def get_all_mojang_uuids_from_subdomain(self, subdomain):
         logger.debug("get_all_mojang_uuids_from_subdomain is called")
-        query = """SELECT mojang_uuid FROM player_server_info WHERE server_id IN (SELECT id FROM servers WHERE subdomain = %s)"""
+        query = QUERIES["get_all_mojang_uuids_from_subdomain"]
         data = (subdomain,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -711,12 +1476,7 @@ class DatabaseManager:
     
     def get_online_status_by_player_uuid_and_subdomain(self, uuid, subdomain):
         logger.debug("get_online_status_by_player_uuid_and_subdomain is called")
-        query = """
-                SELECT psi.online
-                FROM player_server_info psi
-                JOIN servers s ON psi.server_id = s.id
-                WHERE psi.player_uuid = %s AND s.subdomain = %s;
-                """
+        query = QUERIES["get_online_status_by_player_uuid_and_subdomain"]
         data = (uuid, subdomain)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -730,11 +1490,9 @@ class DatabaseManager:
     
     def get_online_status_by_player_id(self, player_id):
         logger.debug("get_online_status_by_player_id is called")
-        query = """ SELECT online FROM player_server_info WHERE player_id=%s"""
         data = (player_id,)
         logger.debug(f"with following data: {data}")
-        self.cursor.execute(query, data)
-        result = self.cursor.fetchone()
+        result = self._execute_prepared("online_status_by_player_id", data).fetchone()
         if result is None:
             logger.debug(f'No online status found for player id: "{player_id}"')
             return None
@@ -744,9 +1502,7 @@ class DatabaseManager:
 
     def get_ban_start_and_ban_end_by_player_id(self, player_id):
         logger.debug("get_ban_time_by_player_id is called")
-        query = """ SELECT ban_start, ban_end
-                    FROM banned_players
-                    WHERE banned_player_id = %s"""
+        query = QUERIES["get_ban_start_and_ban_end_by_player_id"]
         data = (player_id,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -761,9 +1517,7 @@ class DatabaseManager:
 
     def get_web_access_permission_from_player_id(self, player_id):
         logger.debug("get_web_access_permission_from_player_id is called")
-        query = """ SELECT web_access_permissions
-                    FROM player_server_info
-                    WHERE player_id = %s"""
+        query = QUERIES["get_web_access_permission_from_player_id"]
         data = (player_id,)
         logger.debug(f"with following data: {data}")
         self.cursor.execute(query, data)
@@ -777,7 +1531,7 @@ class DatabaseManager:
 
     def get_server_information_dict(self, subdomain):
         logger.debug("getting_server_information_dict is called")
-        query = "SELECT * FROM servers WHERE LOWER(subdomain) = %s;"
+        query = QUERIES["get_server_information_dict"]
         data = (subdomain.lower(),)
         logger.debug(f"executing SQL query: {query}")
         logger.debug(f"with following data: {data}")
@@ -895,12 +1649,9 @@ class DatabaseManager:
         value (str): The value associated with the unique object. If the object is not found, it returns None.
         """
         logger.debug(f"get_value_from_unique_object_from_action_table_with_player_id is called with object: {object}")
-        query = """SELECT value FROM actions WHERE object = %s and player_id = %s"""
         data = (object,player_id)
-        logger.debug(f"executing SQL query: {query}")
         logger.debug(f"with following data: {data}")
-        self.cursor.execute(query, data)
-        result = self.cursor.fetchone()
+        result = self._execute_prepared("action_value_by_object_and_player_id", data).fetchone()
         result = result[0] if result else None
         logger.debug(f"Found value: {result} for object: {object}")
         return result
@@ -911,15 +1662,7 @@ class DatabaseManager:
         ----> Layout.txt
         '''
         logger.debug("getting_all_armor_stats is called")
-        query = """ SELECT jsonb_agg(category_objects) AS grouped_objects
-                    FROM (
-                        SELECT category, jsonb_agg(jsonb_build_object('object', object, 'value', value)) AS category_objects
-                        FROM actions
-                        WHERE category IN (19, 16, 9, 5, 1) AND player_id = %s
-                        GROUP BY category
-                        ORDER BY category DESC
-                    ) subquery;
-                """     
+        query = QUERIES["get_all_armor_stats"]
         data = (player_id,)
         logger.debug(f"executing SQL query: {query}")
         logger.debug(f"with following data: {data}")
@@ -1053,15 +1796,7 @@ class DatabaseManager:
             custom: 21
         '''
         logger.debug("getting_all_custom_stats is called")
-        query = """ SELECT jsonb_agg(category_objects) AS grouped_objects
-                    FROM (
-                        SELECT category, jsonb_agg(jsonb_build_object('object', object, 'value', value)) AS category_objects
-                        FROM actions
-                        WHERE category = 21 AND player_id = %s
-                        GROUP BY category
-                        ORDER BY category DESC
-                    ) subquery;
-                """     
+        query = QUERIES["get_all_custom_stats"]
         data = (player_id,)
         logger.debug(f"executing SQL query: {query}")
         logger.debug(f"with following data: {data}")
@@ -1076,11 +1811,384 @@ class DatabaseManager:
             logger.error(f"Error in getting_all_custom_stats: {e}")
             return None
     
+    ################################# Stats History #######################################
+
+    def ensure_stats_history_partitions(self, months_ahead=STATS_HISTORY_PARTITIONS_AHEAD):
+        """
+        Creates the monthly actions_history partitions of the current month and the months_ahead following ones
+        if they do not exist yet. Called at startup and by the rollup reconciler, never by the stats writes,
+        because the creation is committed right away and must not split the transaction of a batch.
+        """
+        now = datetime.now()
+        for offset in range(months_ahead + 1):
+            year, month = now.year + (now.month - 1 + offset) // 12, (now.month - 1 + offset) % 12 + 1
+            if (year, month) in self._stats_history_partitions:
+                continue
+            start = datetime(year, month, 1)
+            end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+            partition_name = f"actions_history_y{start.year:04d}m{start.month:02d}"
+            query = f"""CREATE TABLE IF NOT EXISTS public.{partition_name}
+                        PARTITION OF public.actions_history
+                        FOR VALUES FROM (%s) TO (%s);"""
+            logger.debug(f"executing SQL query: {query}")
+            self.cursor.execute(query, (start, end))
+            self.conn.commit()
+            self._stats_history_partitions.add((year, month))
+            logger.info(f"Stats history partition {partition_name} is ready")
+
+    def _append_stats_history(self, player_id, changed_rows, recorded_at):
+        """
+        Appends changed stats to the history table. Does not commit.
+
+        Parameters:
+        player_id (str): The ID of the player.
+        changed_rows (list): [(object, category, value, delta),] as returned by the actions upsert.
+        recorded_at (datetime): The timestamp of the sync.
+        """
+        query = """INSERT INTO actions_history (player_id, object, category, value, delta, recorded_at) VALUES %s"""
+        data = [(player_id, row[0], row[1], row[2], row[3], recorded_at) for row in changed_rows]
+        execute_values(self.cursor, query, data, page_size=len(data))
+        logger.debug(f'Appended {len(data)} history rows for player: "{player_id}"')
+
+    def _get_stats_history_partitions(self):
+        """
+        Returns: [(partition_name, first day of the month),] sorted by month
+        """
+        query = """ SELECT c.relname
+                    FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    JOIN pg_class p ON p.oid = i.inhparent
+                    WHERE p.relname = 'actions_history';"""
+        self.cursor.execute(query)
+        partitions = []
+        for (partition_name,) in self.cursor.fetchall():
+            match = re.fullmatch(r"actions_history_y(\d{4})m(\d{2})", partition_name)
+            if match:
+                partitions.append((partition_name, datetime(int(match.group(1)), int(match.group(2)), 1)))
+        return sorted(partitions, key=lambda partition: partition[1])
+
+    def drop_stats_history_partitions_before(self, cutoff):
+        """
+        Drops all history partitions that only contain data older than the cutoff.
+
+        Parameters:
+        cutoff (datetime): Partitions whose month ends before or at this timestamp are dropped.
+
+        Returns:
+        list: The names of the dropped partitions.
+        """
+        logger.debug("drop_stats_history_partitions_before is called")
+        dropped = []
+        for partition_name, month_start in self._get_stats_history_partitions():
+            month_end = datetime(month_start.year + 1, 1, 1) if month_start.month == 12 else datetime(month_start.year, month_start.month + 1, 1)
+            if month_end > cutoff:
+                continue
+            self.cursor.execute(f"DROP TABLE public.{partition_name};")
+            self._stats_history_partitions.discard((month_start.year, month_start.month))
+            dropped.append(partition_name)
+        self.conn.commit()
+        logger.info(f"Dropped stats history partitions: {dropped}")
+        return dropped
+
+    def compact_stats_history_partition(self, year, month):
+        """
+        Compresses a history partition by merging all rows of a player, object and category into one row per day
+        with the sum of the deltas and the last value of the day.
+        Meant for old months that are kept for charts but no longer need the resolution of every sync.
+
+        Returns:
+        int: The number of rows left in the partition.
+        """
+        logger.debug("compact_stats_history_partition is called")
+        partition_name = f"actions_history_y{year:04d}m{month:02d}"
+        query = f""" WITH removed AS (
+                        DELETE FROM public.{partition_name}
+                        RETURNING player_id, category, object, delta, value, recorded_at
+                    )
+                    INSERT INTO public.{partition_name} (player_id, category, object, delta, value, recorded_at)
+                    SELECT player_id, category, object, SUM(delta),
+                    (array_agg(value ORDER BY recorded_at DESC))[1],  -- the value at the end of the day, counters can go down
+                    date_trunc('day', recorded_at)
+                    FROM removed
+                    GROUP BY player_id, category, object, date_trunc('day', recorded_at);"""
+        logger.debug(f"executing SQL query: {query}")
+        self.cursor.execute(query)
+        row_count = self.cursor.rowcount
+        self.conn.commit()
+        logger.info(f"Compacted stats history partition {partition_name} to {row_count} rows")
+        return row_count
+
+    def get_player_stat_history(self, player_id, object, start, end=None, category=None):
+        """
+        Returns the values of one counter of a player over time.
+        The range on recorded_at lets postgres prune all partitions outside of [start, end).
+
+        Parameters:
+        player_id (str): The ID of the player.
+        object (str): The object of the counter, e.g. "minecraft:play_time".
+        start (datetime): The beginning of the time range.
+        end (datetime, optional): The end of the time range. Defaults to now.
+        category (int, optional): Restricts the result to one category.
+
+        Returns:
+        list: [(recorded_at, value, delta),] sorted by time
+        """
+        logger.debug("get_player_stat_history is called")
+        end = end or datetime.now()
+        query = """ SELECT recorded_at, value, delta
+                    FROM actions_history
+                    WHERE player_id = %s AND object = %s
+                    AND recorded_at >= %s AND recorded_at < %s
+                    AND (%s IS NULL OR category = %s)
+                    ORDER BY recorded_at;"""
+        data = (player_id, object, start, end, category, category)
+        logger.debug(f"with following data: {data}")
+        self.cursor.execute(query, data)
+        result = self.cursor.fetchall()
+        logger.info(f'Found {len(result)} history entries for object: "{object}" and player id: "{player_id}"')
+        return result
+
+    ################################# Leaderboards #######################################
+
+    def _update_leaderboards(self, server_id, changed_by_player):
+        """
+        Puts the changed counters of the players on the leaderboards of the server if they can reach the top
+        LEADERBOARD_SIZE. Only the boards of the changed objects (and the totals of their categories) are touched.
+        Does not commit.
+
+        Parameters:
+        server_id (int): The ID of the server.
+        changed_by_player (dict): {player_id: [(object, category, value, delta),]} as returned by the actions upsert.
+        """
+        categories = {player_id: {row[1] for row in rows} for player_id, rows in changed_by_player.items()}
+        query = """ SELECT player_id, category, SUM(value) FROM actions
+                    WHERE player_id = ANY(%s::uuid[]) AND category = ANY(%s)
+                    GROUP BY player_id, category;"""
+        self.cursor.execute(query, (list(changed_by_player), list(set().union(*categories.values()))))
+        candidates = [(server_id, player_id, row[1], row[0], row[2])
+                      for player_id, rows in changed_by_player.items() for row in rows]
+        candidates += [(server_id, player_id, category, ALL_OBJECTS, total)
+                       for player_id, category, total in self.cursor.fetchall() if category in categories[player_id]]
+        candidates.sort(key=lambda candidate: (candidate[2], candidate[3], candidate[1]))
+
+        # a counter qualifies if the player is already on the board or beats the current last place
+        query = f""" INSERT INTO leaderboards (server_id, player_id, category, object, value)
+                    SELECT c.server_id, c.player_id, c.category, c.object, c.value
+                    FROM (VALUES %s) AS c (server_id, player_id, category, object, value)
+                    WHERE EXISTS (
+                        SELECT 1 FROM leaderboards l
+                        WHERE l.server_id = c.server_id AND l.category = c.category
+                        AND l.object = c.object AND l.player_id = c.player_id
+                    )
+                    OR c.value > COALESCE((
+                        SELECT l.value FROM leaderboards l
+                        WHERE l.server_id = c.server_id AND l.category = c.category AND l.object = c.object
+                        ORDER BY l.value DESC
+                        OFFSET {LEADERBOARD_SIZE - 1} LIMIT 1
+                    ), -1)
+                    ORDER BY c.category, c.object, c.player_id
+                    ON CONFLICT (server_id, category, object, player_id)
+                    DO UPDATE SET "value" = EXCLUDED.value
+                    RETURNING category, object;"""
+        entered = execute_values(self.cursor, query, candidates, template="(%s, %s::uuid, %s::integer, %s, %s::bigint)",
+                                 page_size=len(candidates), fetch=True)
+        if not entered:
+            return
+
+        query = f""" DELETE FROM leaderboards l
+                    USING (
+                        SELECT server_id, category, object, player_id,
+                        row_number() OVER (PARTITION BY category, object ORDER BY value DESC, player_id) AS rank
+                        FROM leaderboards
+                        WHERE server_id = %s
+                        AND (category, object) IN (SELECT * FROM unnest(%s::integer[], %s::text[]))
+                    ) ranked
+                    WHERE l.server_id = ranked.server_id AND l.category = ranked.category
+                    AND l.object = ranked.object AND l.player_id = ranked.player_id
+                    AND ranked.rank > {LEADERBOARD_SIZE};"""
+        boards = sorted({tuple(row) for row in entered})
+        self.cursor.execute(query, (server_id, [board[0] for board in boards], [board[1] for board in boards]))
+        logger.debug(f'Updated {len(entered)} leaderboard entries of {len(changed_by_player)} players of server: "{server_id}"')
+
+    def get_leaderboard(self, server_id, category, object=ALL_OBJECTS, limit=LEADERBOARD_SIZE):
+        """
+        Returns one leaderboard of a server. Only reads the stored top entries.
+
+        Parameters:
+        server_id (int): The ID of the server.
+        category (int): The database category, see layout.txt.
+        object (str, optional): The object of the board. Defaults to the total of the category.
+        limit (int, optional): The number of places. Can not be bigger than LEADERBOARD_SIZE.
+
+        Returns:
+        list: [(player_id, player_name, value),] sorted by the value
+        """
+        logger.debug("get_leaderboard is called")
+        query = QUERIES["get_leaderboard"]
+        data = (server_id, category, object, min(limit, LEADERBOARD_SIZE))
+        logger.debug(f"with following data: {data}")
+        self.cursor.execute(query, data)
+        result = self.cursor.fetchall()
+        logger.info(f'Found {len(result)} leaderboard entries for server: "{server_id}", category: "{category}" and object: "{object}"')
+        return result
+
+    def get_named_leaderboard(self, server_id, name, limit=LEADERBOARD_SIZE):
+        """
+        Returns one of the boards defined in LEADERBOARDS, e.g. "top_miners".
+        """
+        category, object = LEADERBOARDS[name]
+        return self.get_leaderboard(server_id, category, object, limit)
+
+    def rebuild_leaderboards(self, server_id=None):
+        """
+        Recomputes the leaderboards from the actions table and replaces the stored ones.
+
+        Parameters:
+        server_id (int, optional): Only rebuild the boards of this server. Defaults to all servers.
+
+        Returns:
+        int: The number of entries that differed from the incrementally maintained boards.
+        """
+        logger.debug("rebuild_leaderboards is called")
+        query = f""" CREATE TEMP TABLE expected_leaderboards ON COMMIT DROP AS
+                    SELECT server_id, category, object, player_id, value
+                    FROM (
+                        SELECT server_id, category, object, player_id, value,
+                        row_number() OVER (PARTITION BY server_id, category, object ORDER BY value DESC, player_id) AS rank
+                        FROM (
+                            SELECT psi.server_id, a.category, a.object, a.player_id, a.value::bigint AS value
+                            FROM actions a
+                            JOIN player_server_info psi ON psi.player_id = a.player_id
+                            WHERE %(server_id)s IS NULL OR psi.server_id = %(server_id)s
+                            UNION ALL
+                            SELECT psi.server_id, a.category, %(all_objects)s, a.player_id, SUM(a.value)
+                            FROM actions a
+                            JOIN player_server_info psi ON psi.player_id = a.player_id
+                            WHERE %(server_id)s IS NULL OR psi.server_id = %(server_id)s
+                            GROUP BY psi.server_id, a.category, a.player_id
+                        ) counters
+                    ) ranked
+                    WHERE rank <= {LEADERBOARD_SIZE};"""
+        data = {"server_id": server_id, "all_objects": ALL_OBJECTS}
+        logger.debug(f"executing SQL query: {query}")
+        self.cursor.execute(query, data)
+
+        query = """ SELECT COUNT(*) FROM (
+                        (SELECT server_id, category, object, player_id, value FROM leaderboards
+                         WHERE %(server_id)s IS NULL OR server_id = %(server_id)s
+                         EXCEPT SELECT * FROM expected_leaderboards)
+                        UNION ALL
+                        (SELECT * FROM expected_leaderboards
+                         EXCEPT SELECT server_id, category, object, player_id, value FROM leaderboards
+                         WHERE %(server_id)s IS NULL OR server_id = %(server_id)s)
+                    ) drift;"""
+        self.cursor.execute(query, data)
+        drift = self.cursor.fetchone()[0]
+
+        self.cursor.execute("DELETE FROM leaderboards WHERE %(server_id)s IS NULL OR server_id = %(server_id)s;", data)
+        self.cursor.execute("INSERT INTO leaderboards SELECT * FROM expected_leaderboards;")
+        self.conn.commit()
+        if drift:
+            logger.warning(f"Rebuilt leaderboards with {drift} differing entries (server: {server_id})")
+        else:
+            logger.info(f"Rebuilt leaderboards, no differences found (server: {server_id})")
+        return drift
+
+    ################################# Server Totals #######################################
+
+    def _apply_server_stat_totals(self, server_id, changed_rows):
+        """
+        Adds the deltas of the changed counters of one or more players to the totals of the server. Does not commit.
+
+        Parameters:
+        server_id (int): The ID of the server.
+        changed_rows (list): [(object, category, value, delta),] as returned by the actions upsert.
+        """
+        deltas = {}
+        for object, category, _, delta in changed_rows:
+            deltas[(category, object)] = deltas.get((category, object), 0) + delta
+            deltas[(category, ALL_OBJECTS)] = deltas.get((category, ALL_OBJECTS), 0) + delta
+        # summed over the whole transaction and sorted, so concurrent ingests lock the rows once and in the same order
+        data = [(server_id, category, object, delta) for (category, object), delta in sorted(deltas.items()) if delta]
+        if not data:
+            return
+        query = """ INSERT INTO server_stat_totals (server_id, category, object, total) VALUES %s
+                    ON CONFLICT (server_id, category, object)
+                    DO UPDATE SET total = server_stat_totals.total + EXCLUDED.total;"""
+        execute_values(self.cursor, query, data, page_size=len(data))
+        logger.debug(f'Applied {len(data)} total deltas for server: "{server_id}"')
+
+    def get_server_stat_totals(self, server_id):
+        """
+        Returns the totals defined in SERVER_TOTALS for the landing page of a server.
+
+        Returns:
+        dict: {name: total}, missing totals are 0
+        """
+        logger.debug("get_server_stat_totals is called")
+        query = QUERIES["get_server_stat_totals"]
+        data = (server_id, [total[0] for total in SERVER_TOTALS.values()], [total[1] for total in SERVER_TOTALS.values()])
+        logger.debug(f"with following data: {data}")
+        self.cursor.execute(query, data)
+        found = {(category, object): total for category, object, total in self.cursor.fetchall()}
+        result = {name: found.get(key, 0) for name, key in SERVER_TOTALS.items()}
+        logger.info(f'Found server totals: {result} for server: "{server_id}"')
+        return result
+
+    def reconcile_server_stat_totals(self, server_id=None):
+        """
+        Compares the stored totals with the sums of the actions table and repairs every total that drifted.
+        The drift is added to the current total in the same statement, so increments committed by
+        concurrent ingests while the check runs are kept instead of being overwritten.
+
+        Parameters:
+        server_id (int, optional): Only check the totals of this server. Defaults to all servers.
+
+        Returns:
+        int: The number of repaired totals.
+        """
+        logger.debug("reconcile_server_stat_totals is called")
+        query = """ WITH expected AS (
+                        SELECT psi.server_id, a.category, a.object, SUM(a.value) AS total
+                        FROM actions a
+                        JOIN player_server_info psi ON psi.player_id = a.player_id
+                        WHERE %(server_id)s IS NULL OR psi.server_id = %(server_id)s
+                        GROUP BY psi.server_id, a.category, a.object
+                        UNION ALL
+                        SELECT psi.server_id, a.category, %(all_objects)s, SUM(a.value)
+                        FROM actions a
+                        JOIN player_server_info psi ON psi.player_id = a.player_id
+                        WHERE %(server_id)s IS NULL OR psi.server_id = %(server_id)s
+                        GROUP BY psi.server_id, a.category
+                    ),
+                    stored AS (
+                        SELECT server_id, category, object, total FROM server_stat_totals
+                        WHERE %(server_id)s IS NULL OR server_id = %(server_id)s
+                    )
+                    INSERT INTO server_stat_totals (server_id, category, object, total)
+                    SELECT COALESCE(e.server_id, s.server_id), COALESCE(e.category, s.category),
+                    COALESCE(e.object, s.object), COALESCE(e.total, 0) - COALESCE(s.total, 0)
+                    FROM expected e
+                    FULL OUTER JOIN stored s USING (server_id, category, object)
+                    WHERE COALESCE(e.total, 0) IS DISTINCT FROM COALESCE(s.total, 0)
+                    ON CONFLICT (server_id, category, object)
+                    DO UPDATE SET total = server_stat_totals.total + EXCLUDED.total;"""
+        data = {"server_id": server_id, "all_objects": ALL_OBJECTS}
+        logger.debug(f"executing SQL query: {query}")
+        self.cursor.execute(query, data)
+        repaired = self.cursor.rowcount
+        if repaired:
+            logger.warning(f"Repaired {repaired} drifted server totals (server: {server_id})")
+        else:
+            logger.info(f"Server totals are consistent (server: {server_id})")
+        self.conn.commit()
+        return repaired
+
     ################################# Verify Functions #######################################
 
     def verify_player_login(self, player_id, pin):
         logger.debug("verify_player_login is called")
-        query = "SELECT pin, timestamp FROM login WHERE player_id = %s;"
+        query = QUERIES["verify_player_login"]
         data = (player_id,)
         logger.debug(f"executing SQL query: {query}")
         logger.debug(f"with following data: {data}")
@@ -1181,12 +2289,10 @@ class DatabaseManager:
         Return: [[object/item, category, value],]
         '''
         return_list = []
-        stats_categorys = ["minecraft:broken", "minecraft:mined","minecraft:dropped","minecraft:used","minecraft:killed","minecraft:crafted","minecraft:killed_by","minecraft:custom","minecraft:picked_up"]
         all_data = json.loads(items)["stats"]
-        for category in stats_categorys:
+        for category in STATS_CATEGORIES:
             try:
                 data = all_data[category]
-                # if category == "minecraft:broken":
                 for item_name, item_data in data.items():
                     db_category = self.get_db_category_from_item_and_json_category(item_name, category)
                     return_list.append([item_name, db_category, item_data])
@@ -1195,19 +2301,55 @@ class DatabaseManager:
 
         return return_list
     
+    def parse_stats_columns(self, stats):
+        '''
+        Parses and classifies a stats json in one pass into the parallel columns the upsert takes,
+        without building a row per stat. Stats with a value of 0 are skipped; if two stats end up in the same
+        (object, database category) the last value wins.
+
+        Return: ([object,], [database category,], [value,])
+        '''
+        objects, categories, values = [], [], []
+        positions = {}  # database category -> {object: index in the columns}
+        all_data = json.loads(stats)["stats"]
+        for category in STATS_CATEGORIES:
+            data = all_data.get(category)
+            if not data:
+                continue
+            cached_categories = self._stat_categories[category]
+            for item_name, item_data in data.items():
+                if item_data == 0:
+                    continue
+                db_category = cached_categories.get(item_name)
+                if db_category is None:
+                    db_category = self.get_db_category_from_item_and_json_category(item_name, category)
+                category_positions = positions.get(db_category)
+                if category_positions is None:
+                    category_positions = positions[db_category] = {}
+                position = category_positions.get(item_name)
+                if position is None:
+                    category_positions[item_name] = len(objects)
+                    objects.append(item_name)
+                    categories.append(db_category)
+                    values.append(item_data)
+                else:
+                    values[position] = item_data
+        return objects, categories, values
+
     def get_db_category_from_item_and_json_category(self, item, category):
         '''
         categorys = ["minecraft:broken", "minecraft:mined","minecraft:dropped","minecraft:used","minecraft:killed","minecraft:killed_by","minecraft:crafted","minecraft:picked_up","minecraft:custom"]
 
-        ----> Layout.txt
+        ----> Layout.txt, DB_CATEGORY_MAPPING
         Return: database category name
         '''
-        tools_substrings = ["axe", "shovel", "hoe", "sword", "pickaxe", "shield", "flint_and_steel", "bow", "crossbow", "brush", "trident", "shears", "fishing_rod", "mace"]
-        armor_substrings = ["boots", "leggings", "chestplate", "helmet"]
+        cached = self._stat_categories.get(category, {}).get(item)
+        if cached is not None:
+            return cached
         recognized_item_group = ""
-        if any(substring in item for substring in tools_substrings):
+        if any(substring in item for substring in TOOLS_SUBSTRINGS):
             recognized_item_group = "tool"
-        elif any(substring in item for substring in armor_substrings):
+        elif any(substring in item for substring in ARMOR_SUBSTRINGS):
             recognized_item_group = "armor"
         elif self.check_item_for_block(item):
             recognized_item_group = "block"
@@ -1216,74 +2358,24 @@ class DatabaseManager:
         else:
             recognized_item_group = "unknown"
 
-        if recognized_item_group == "tool":
-            if category == "minecraft:broken":
-                return 15
-            elif category == "minecraft:dropped":
-                return 10
-            elif category == "minecraft:used":
-                return 20
-            elif category == "minecraft:crafted":
-                return 0
-            elif category == "minecraft:picked_up":
-                return 6
-
-        elif recognized_item_group == "armor":
-            if category == "minecraft:broken":
-                return 16
-            elif category == "minecraft:dropped":
-                return 9
-            elif category == "minecraft:used":
-                return 19
-            elif category == "minecraft:crafted":
-                return 1
-            elif category == "minecraft:picked_up":
-                return 5
-
-        elif recognized_item_group == "block":
-            if category == "minecraft:mined":
-                return 17
-            elif category == "minecraft:dropped":
-                return 7
-            elif category == "minecraft:used":
-                return 13
-            elif category == "minecraft:crafted":
-                return 2
-            elif category == "minecraft:picked_up":
-                return 3
-
-        elif recognized_item_group == "item":
-            if category == "minecraft:dropped":
-                return 14
-            elif category == "minecraft:used":
-                return 18
-            elif category == "minecraft:crafted":
-                return 4
-            elif category == "minecraft:picked_up":
-                return 8
-
-        if category == "minecraft:killed":
-            return 12
-        elif category == "minecraft:killed_by":
-            return 11
-        elif category == "minecraft:custom":
-            return 21
-        else:
-            return -1  # Return an invalid value if no match is found
+        db_category = DB_CATEGORY_MAPPING.get(recognized_item_group, {}).get(category)
+        if db_category is None:
+            db_category = DB_CATEGORY_MAPPING["any"].get(category, -1)  # Return an invalid value if no match is found
+        # the block and item lookup tables only change with a reset, so the result can be kept
+        if category in self._stat_categories and self._stat_categories_size < STAT_CATEGORY_CACHE_SIZE:
+            if item not in self._stat_categories[category]:
+                self._stat_categories[category][item] = db_category
+                self._stat_categories_size += 1
+        return db_category
 
     def check_item_for_block(self, item):
         item = item.replace("minecraft:", "")
-        query = f"SELECT EXISTS (SELECT 1 FROM block_lookup WHERE blocks = %s)"
-        self.cursor.execute(query, (item,))
-        result = self.cursor.fetchone()[0]
+        result = self._execute_prepared("block_exists", (item,)).fetchone()[0]
         return result
         
     def check_item_for_item(self, item):
         item = item.replace("minecraft:", "")
-
-        query = f"SELECT EXISTS (SELECT 1 FROM item_lookup WHERE items = %s)"
-        self.cursor.execute(query, (item,))
-        result = self.cursor.fetchone()[0]
+        result = self._execute_prepared("item_exists", (item,)).fetchone()[0]
         return result
 
        
@@ -1333,7 +2425,13 @@ class DatabaseManager:
         return logins
 
 if __name__ == "__main__":
+    # python -m database.databaseManagerV2 [rebuild-leaderboards|reconcile-totals [server_id]]
+    import sys
     db = DatabaseManager()
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-leaderboards":
+        print(f"Differing entries: {db.rebuild_leaderboards(int(sys.argv[2]) if len(sys.argv) > 2 else None)}")
+    elif len(sys.argv) > 1 and sys.argv[1] == "reconcile-totals":
+        print(f"Repaired totals: {db.reconcile_server_stat_totals(int(sys.argv[2]) if len(sys.argv) > 2 else None)}")
 
 
 # TODO: Insert player kills from 'other' to 'mobs' -> player
\ No newline at end of file
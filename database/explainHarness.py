@@ -0,0 +1,176 @@
+"""
+Runs EXPLAIN (ANALYZE, BUFFERS) for the queries of the DatabaseManager on a synthetic dataset
+and fails if one of them reads a big table with a sequential scan.
+
+The dataset is created inside a transaction that is rolled back at the end, so the database is left untouched.
+Run from the project root:
+    python -m database.explainHarness [servers] [players] [objects_per_player]
+"""
+from datetime import date, datetime, timedelta
+import json
+import sys
+
+from .databaseManagerV2 import (DatabaseManager, PREPARED_STATEMENTS, QUERIES, ALL_OBJECTS, LEADERBOARD_SIZE,
+                                SERVER_TOTALS)
+
+DEFAULT_SERVERS = 200
+DEFAULT_PLAYERS = 10000
+DEFAULT_OBJECTS_PER_PLAYER = 40
+
+# Tables that are small by design; a sequential scan on them is fine.
+SEQ_SCAN_ALLOWED = {"ban_reasons", "stats_category_mapping", "item_group_patterns"}
+
+# name -> parameters of the queries in QUERIES
+QUERY_PARAMETERS = {
+    "get_player_id_from_mojang_uuid_and_subdomain": lambda p: (p["uuid"], p["subdomain"]),
+    "get_mojang_uuid_from_player_id": lambda p: (p["player_id"],),
+    "get_mojang_uuid_from_player_name": lambda p: (p["name"],),
+    "get_player_name_from_mojang_uuid": lambda p: (p["uuid"],),
+    "get_player_name_from_player_id": lambda p: (p["player_id"],),
+    "get_prefix_id_by_player_id": lambda p: (p["player_id"],),
+    "get_ban_reason_from_player_id": lambda p: (p["player_id"],),
+    "get_server_id_from_subdomain": lambda p: (p["subdomain"],),
+    "get_all_player_ids_from_subdomain": lambda p: (p["subdomain"],),
+    "get_all_mojang_uuids_from_subdomain": lambda p: (p["subdomain"],),
+    "get_online_status_by_player_uuid_and_subdomain": lambda p: (p["uuid"], p["subdomain"]),
+    "get_ban_start_and_ban_end_by_player_id": lambda p: (p["player_id"],),
+    "get_web_access_permission_from_player_id": lambda p: (p["player_id"],),
+    "get_server_information_dict": lambda p: (p["subdomain"].lower(),),
+    "get_all_armor_stats": lambda p: (p["player_id"],),
+    "get_all_custom_stats": lambda p: (p["player_id"],),
+    "verify_player_login": lambda p: (p["player_id"],),
+    "get_leaderboard": lambda p: (p["server_id"], 17, p["all_objects"], LEADERBOARD_SIZE),
+    "get_server_stat_totals": lambda p: (p["server_id"], [total[0] for total in SERVER_TOTALS.values()],
+                                         [total[1] for total in SERVER_TOTALS.values()]),
+    "get_stats_sync_state": lambda p: (p["server_id"],),
+    "get_daily_playtime": lambda p: (p["player_id"], date.today() - timedelta(days=7), date.today() + timedelta(days=1)),
+    "get_player_sessions": lambda p: (p["player_id"], datetime.now() - timedelta(days=7), datetime.now()),
+}
+
+# name -> parameters of the statements in PREPARED_STATEMENTS
+PREPARED_PARAMETERS = {
+    "player_id_by_uuid_and_server_id": lambda p: (p["uuid"], p["server_id"]),
+    "server_id_by_player_id": lambda p: (p["player_id"],),
+    "server_id_by_auth_key": lambda p: (p["server_key"],),
+    "update_player_status": lambda p: (True, p["uuid"], p["server_id"]),
+    "online_status_by_player_id": lambda p: (p["player_id"],),
+    "online_player_count_by_subdomain": lambda p: (p["subdomain"],),
+    "first_seen_by_player_id": lambda p: (p["player_id"],),
+    "last_seen_by_player_id": lambda p: (p["player_id"],),
+    "action_value_by_object_and_player_id": lambda p: (p["object"], p["player_id"]),
+    "block_exists": lambda p: ("stone",),
+    "item_exists": lambda p: ("apple",),
+    "swap_stats_digest": lambda p: (p["player_id"], "harness"),
+    "ingest_player_stats": lambda p: (p["player_id"], json.dumps({"stats": {"minecraft:mined": {"minecraft:stone": 5}}})),
+    "upsert_player_stats": lambda p: (p["player_id"], [p["object"]], [1], [12345]),
+}
+
+
+def create_synthetic_dataset(cursor, servers, players, objects_per_player):
+    data = {"servers": servers, "players": players, "objects": objects_per_player}
+    cursor.execute("""
+        INSERT INTO server_admins (username, email, password, email_verified)
+        SELECT 'harness-admin-' || i, 'harness-' || i || '@example.com', 'x', true
+        FROM generate_series(1, %(servers)s) i;
+
+        INSERT INTO servers (owner_id, subdomain, mc_server_domain, server_description_short,
+                             server_description_long, server_name, server_key)
+        SELECT id, 'harness-' || id, 'harness-' || id || '.example.com', '', '', 'harness server ' || id, lpad(id::text, 64, 'h')
+        FROM server_admins WHERE username LIKE 'harness-admin-%%';
+
+        INSERT INTO player (uuid, name)
+        SELECT uuid_generate_v4(), 'harness_player_' || i FROM generate_series(1, %(players)s) i;
+
+        INSERT INTO player_server_info (mojang_uuid, server_id, online, first_seen, last_seen, web_access_permissions)
+        SELECT p.uuid, s.id, random() < 0.1, NOW(), NOW(), 3
+        FROM (SELECT uuid, row_number() OVER () AS n FROM player WHERE name LIKE 'harness_player_%%') p
+        JOIN (SELECT id, row_number() OVER (ORDER BY id) - 1 AS n FROM servers WHERE subdomain LIKE 'harness-%%') s
+        ON s.n = p.n %% %(servers)s;
+
+        INSERT INTO actions (player_id, category, object, value)
+        SELECT psi.player_id, o %% 22, 'minecraft:harness_object_' || o, (random() * 1000)::integer + 1
+        FROM player_server_info psi
+        JOIN servers s ON s.id = psi.server_id AND s.subdomain LIKE 'harness-%%'
+        CROSS JOIN generate_series(1, %(objects)s) o;
+
+        INSERT INTO leaderboards (server_id, category, object, player_id, value)
+        SELECT psi.server_id, 17, '*', psi.player_id, (random() * 1000)::integer
+        FROM player_server_info psi
+        JOIN servers s ON s.id = psi.server_id AND s.subdomain LIKE 'harness-%%';
+
+        INSERT INTO server_stat_totals (server_id, category, object, total)
+        SELECT id, 17, '*', 1000 FROM servers WHERE subdomain LIKE 'harness-%%';
+
+        INSERT INTO sessions (player_id, server_id, session_start, session_end)
+        SELECT psi.player_id, psi.server_id, NOW() - d * INTERVAL '1 day', NOW() - d * INTERVAL '1 day' + INTERVAL '1 hour'
+        FROM player_server_info psi
+        JOIN servers s ON s.id = psi.server_id AND s.subdomain LIKE 'harness-%%'
+        CROSS JOIN generate_series(1, 14) d;
+
+        INSERT INTO daily_playtime (player_id, day, server_id, seconds)
+        SELECT psi.player_id, CURRENT_DATE - d, psi.server_id, 3600
+        FROM player_server_info psi
+        JOIN servers s ON s.id = psi.server_id AND s.subdomain LIKE 'harness-%%'
+        CROSS JOIN generate_series(1, 14) d;
+
+        ANALYZE;
+    """, data)
+    cursor.execute("""
+        SELECT psi.player_id, psi.mojang_uuid, psi.server_id, s.subdomain, s.server_key, p.name
+        FROM player_server_info psi
+        JOIN servers s ON s.id = psi.server_id
+        JOIN player p ON p.uuid = psi.mojang_uuid
+        WHERE s.subdomain LIKE 'harness-%%'
+        ORDER BY psi.player_id LIMIT 1;
+    """)
+    player_id, uuid, server_id, subdomain, server_key, name = cursor.fetchone()
+    return {"player_id": player_id, "uuid": uuid, "server_id": server_id, "subdomain": subdomain,
+            "server_key": server_key, "name": name, "object": "minecraft:harness_object_1", "all_objects": ALL_OBJECTS}
+
+
+def collect_seq_scans(plan, found=None):
+    """
+    Returns the tables that are read with a sequential scan somewhere in the plan.
+    """
+    found = [] if found is None else found
+    if plan["Node Type"] == "Seq Scan" and plan["Relation Name"] not in SEQ_SCAN_ALLOWED:
+        found.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        collect_seq_scans(child, found)
+    return found
+
+
+def explain(cursor, name, statement, parameters):
+    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters)
+    result = cursor.fetchone()[0]
+    result = json.loads(result) if isinstance(result, str) else result
+    plan = result[0]["Plan"]
+    seq_scans = collect_seq_scans(plan)
+    buffers = plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0)
+    status = "SEQ SCAN on " + ", ".join(seq_scans) if seq_scans else "ok"
+    print(f"{name:<50} {plan['Actual Total Time']:>9.3f} ms {buffers:>7} buffers  {status}")
+    return not seq_scans
+
+
+def run_harness(servers=DEFAULT_SERVERS, players=DEFAULT_PLAYERS, objects_per_player=DEFAULT_OBJECTS_PER_PLAYER):
+    db = DatabaseManager()
+    cursor = db.conn.cursor()
+    try:
+        print(f"Creating synthetic dataset: {servers} servers, {players} players, {objects_per_player} objects per player")
+        parameters = create_synthetic_dataset(cursor, servers, players, objects_per_player)
+        passed = True
+        for name, query in QUERIES.items():
+            passed &= explain(cursor, name, query, QUERY_PARAMETERS[name](parameters))
+        for name, (parameter_types, statement) in PREPARED_STATEMENTS.items():
+            cursor.execute(f"PREPARE harness_{name} ({parameter_types}) AS {statement}")
+            arguments = PREPARED_PARAMETERS[name](parameters)
+            passed &= explain(cursor, name, f"EXECUTE harness_{name} ({', '.join(['%s'] * len(arguments))})", arguments)
+    finally:
+        db.conn.rollback()
+        cursor.execute("DEALLOCATE ALL")
+    print("All plans use indexes" if passed else "Plan regression: sequential scans found")
+    return passed
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_harness(*[int(arg) for arg in sys.argv[1:]]) else 1)
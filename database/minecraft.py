@@ -1,8 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
 from colorlogx import get_logger
 logger = get_logger("minecraftApi")
 
+NAME_LOOKUP_WORKERS = 8  # parallel requests when many usernames are looked up at once
+NAME_LOOKUP_TIMEOUT = 5  # seconds to wait for the player api before the lookup counts as failed
+
 
 class Minecraft:
     def __init__(self):
@@ -17,7 +22,7 @@ class Minecraft:
         """
         URL = f"https://playerdb.co/api/player/minecraft/{uuid}"
         try:
-            response = requests.get(URL)
+            response = requests.get(URL, timeout=NAME_LOOKUP_TIMEOUT)
             if response.status_code == 200:
                 data = response.json()
                 user_name = data['data']['player']['username']
@@ -29,5 +34,13 @@ class Minecraft:
             logger.error("Error in get_player_name_from_uuid: " + str(e))
             user_name = -1
         return user_name
-    
-    
\ No newline at end of file
+
+    def get_player_names_from_mojang_uuids_online(self, uuids):
+        """
+        Looks up many usernames with NAME_LOOKUP_WORKERS parallel requests.
+
+        :param uuids: UUIDs of the players.
+        :return: dict: {uuid: username}, -1 for failed lookups like get_player_name_from_mojang_uuid_online.
+        """
+        with ThreadPoolExecutor(max_workers=NAME_LOOKUP_WORKERS) as executor:
+            return dict(zip(uuids, executor.map(self.get_player_name_from_mojang_uuid_online, uuids)))
@@ -0,0 +1,116 @@
+import json
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from colorlogx import get_logger
+import logging
+from .databaseManagerV2 import DB_CONNECTION_PARAMS, ONLINE_PLAYERS_CHANNEL
+
+RECONNECT_DELAY = 5  # seconds
+
+logger = get_logger("notifications", logging.DEBUG)
+
+
+class NotificationListener(threading.Thread):
+    """
+    Listens on postgres NOTIFY channels with an own connection and passes every notification to a callback.
+    on_connect is called after every (re)connect, once LISTEN is active, so the caller can reload its state
+    without missing a notification.
+    """
+
+    def __init__(self, channels, callback, on_connect=None):
+        super().__init__(daemon=True)
+        self.channels = channels
+        self.callback = callback
+        self.on_connect = on_connect
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                logger.error(f"Notification listener on {self.channels} failed. Reconnecting in {RECONNECT_DELAY} seconds. Error: {e}")
+                time.sleep(RECONNECT_DELAY)
+
+    def _listen(self):
+        conn = psycopg2.connect(**DB_CONNECTION_PARAMS)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            for channel in self.channels:
+                cursor.execute(f"LISTEN {channel};")
+            logger.info(f"Listening on {self.channels}")
+            if self.on_connect:
+                self.on_connect()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        self.callback(notify.channel, notify.payload)
+                    except Exception as e:
+                        logger.error(f"Handling notification {notify.payload} on {notify.channel} failed. Error: {e}")
+        finally:
+            conn.close()
+
+
+class OnlinePlayerCache:
+    """
+    In memory copy of the online players of every server for the web app.
+    Loaded once from the database and then kept up to date with the notifications the socket publishes.
+    """
+
+    def __init__(self):
+        self._online = {}  # server_id -> set of mojang uuids
+        self._lock = threading.Lock()
+        self._listener = NotificationListener([ONLINE_PLAYERS_CHANNEL], self._handle_notification, self._load_snapshot)
+
+    def start(self):
+        self._listener.start()
+
+    def _load_snapshot(self):
+        conn = psycopg2.connect(**DB_CONNECTION_PARAMS)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT server_id, mojang_uuid FROM player_server_info WHERE online;")
+            online = {}
+            for server_id, mojang_uuid in cursor.fetchall():
+                online.setdefault(server_id, set()).add(str(mojang_uuid).lower())
+        finally:
+            conn.close()
+        with self._lock:
+            self._online = online
+        logger.info(f"Loaded online players of {len(online)} servers")
+
+    def _handle_notification(self, channel, payload):
+        change = json.loads(payload)
+        with self._lock:
+            if change.get("reset"):
+                if "server_id" in change:
+                    self._online.pop(change["server_id"], None)
+                else:
+                    self._online = {}
+                return
+            players = self._online.setdefault(change["server_id"], set())
+            if change["online"]:
+                players.add(change["uuid"].lower())
+            else:
+                players.discard(change["uuid"].lower())
+
+    def get_online_count(self, server_id):
+        with self._lock:
+            return len(self._online.get(server_id, ()))
+
+    def is_online(self, server_id, mojang_uuid):
+        with self._lock:
+            return str(mojang_uuid).lower() in self._online.get(server_id, ())
+
+    def get_online_players(self, server_id):
+        with self._lock:
+            return set(self._online.get(server_id, ()))
@@ -173,13 +173,8 @@ ALTER TABLE public.player_server_info
   ON UPDATE NO ACTION;
 
 
-CREATE INDEX player_uuid_idx ON public.player(uuid);
-CREATE INDEX player_server_info_player_uuid_idx ON public.player_server_info(mojang_uuid);
-CREATE INDEX servers_id_idx ON public."servers" (id);
 CREATE INDEX ON banned_players(banned_player_id);
 CREATE INDEX ON banned_players(moderator_id);
-CREATE INDEX ON actions(player_id);
-CREATE INDEX ON player_server_info(server_id);
 CREATE UNIQUE INDEX block_lookup_index ON public.block_lookup(blocks);
 CREATE UNIQUE INDEX item_lookup_index ON public.item_lookup(items);
 
@@ -0,0 +1,17 @@
+-- Append-only history of per-sync stat deltas.
+-- Partitioned by month; partitions are created on demand by the DatabaseManager.
+CREATE TABLE IF NOT EXISTS public.actions_history(
+  player_id uuid NOT NULL,
+  category integer NOT NULL,
+  "object" text NOT NULL,
+  delta integer NOT NULL,
+  "value" integer NOT NULL,
+  recorded_at timestamp without time zone NOT NULL
+) PARTITION BY RANGE (recorded_at);
+
+CREATE INDEX IF NOT EXISTS actions_history_player_object_idx
+  ON public.actions_history (player_id, "object", recorded_at);
+
+COMMENT ON TABLE public.actions_history IS
+  'Append-only history of stat changes. "delta" is the difference to the previous value, "value" the new value.
+One partition per month (actions_history_yYYYYmMM), old partitions can be compacted or dropped.';
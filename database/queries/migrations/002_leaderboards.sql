@@ -0,0 +1,17 @@
+-- Top-N boards per server, category and object. Maintained incrementally by the stats ingest.
+-- object '*' holds the sum over all objects of a category (e.g. all mined blocks).
+CREATE TABLE IF NOT EXISTS public.leaderboards(
+  server_id integer NOT NULL REFERENCES public."servers" (id),
+  category integer NOT NULL,
+  "object" text NOT NULL,
+  player_id uuid NOT NULL REFERENCES public.player_server_info (player_id),
+  "value" bigint NOT NULL,
+  CONSTRAINT leaderboards_pkey PRIMARY KEY(server_id, category, "object", player_id)
+);
+
+CREATE INDEX IF NOT EXISTS leaderboards_board_value_idx
+  ON public.leaderboards (server_id, category, "object", "value" DESC);
+
+COMMENT ON TABLE public.leaderboards IS
+  'Holds only the best LEADERBOARD_SIZE players of every (server_id, category, object) board.
+Can be recomputed from the actions table with DatabaseManager.rebuild_leaderboards()';
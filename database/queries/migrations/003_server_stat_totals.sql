@@ -0,0 +1,12 @@
+-- Server wide sums of the actions table, updated with the deltas of every stats ingest.
+-- object '*' holds the sum over all objects of a category.
+CREATE TABLE IF NOT EXISTS public.server_stat_totals(
+  server_id integer NOT NULL REFERENCES public."servers" (id),
+  category integer NOT NULL,
+  "object" text NOT NULL,
+  total bigint NOT NULL DEFAULT 0,
+  CONSTRAINT server_stat_totals_pkey PRIMARY KEY(server_id, category, "object")
+);
+
+COMMENT ON TABLE public.server_stat_totals IS
+  'Rollup of the actions table per server. Checked and repaired by DatabaseManager.reconcile_server_stat_totals()';
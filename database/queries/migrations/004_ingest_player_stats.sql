@@ -0,0 +1,75 @@
+-- Server side stats ingest. The mapping tables are refilled from the constants in
+-- databaseManagerV2.py on every start, so python and postgres classify items the same way.
+CREATE TABLE IF NOT EXISTS public.stats_category_mapping(
+  item_group text NOT NULL,
+  json_category text NOT NULL,
+  category integer NOT NULL,
+  CONSTRAINT stats_category_mapping_pkey PRIMARY KEY(item_group, json_category)
+);
+
+CREATE TABLE IF NOT EXISTS public.item_group_patterns(
+  pattern text NOT NULL,
+  item_group text NOT NULL,
+  CONSTRAINT item_group_patterns_pkey PRIMARY KEY(item_group, pattern)
+);
+
+-- Expands the raw stats json of the plugin, classifies every entry and upserts it into actions.
+-- Returns the changed counters with their delta, like the python ingest path.
+CREATE OR REPLACE FUNCTION public.ingest_player_stats(p_player_id uuid, p_stats jsonb)
+RETURNS TABLE ("object" text, category integer, "value" integer, delta integer)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+BEGIN
+  RETURN QUERY
+  WITH entries AS (
+    SELECT s.key AS json_category, e.key AS object, (e.value #>> '{}')::integer AS value
+    FROM jsonb_each(p_stats -> 'stats') AS s
+    CROSS JOIN LATERAL jsonb_each(s.value) AS e
+    WHERE jsonb_typeof(s.value) = 'object'
+    AND s.key IN (SELECT m.json_category FROM stats_category_mapping m)
+  ),
+  classified AS (
+    SELECT en.json_category, en.object, en.value,
+      CASE
+        WHEN EXISTS (SELECT 1 FROM item_group_patterns p
+                     WHERE p.item_group = 'tool' AND strpos(en.object, p.pattern) > 0) THEN 'tool'
+        WHEN EXISTS (SELECT 1 FROM item_group_patterns p
+                     WHERE p.item_group = 'armor' AND strpos(en.object, p.pattern) > 0) THEN 'armor'
+        WHEN EXISTS (SELECT 1 FROM block_lookup b
+                     WHERE b.blocks = replace(en.object, 'minecraft:', '')) THEN 'block'
+        WHEN EXISTS (SELECT 1 FROM item_lookup i
+                     WHERE i.items = replace(en.object, 'minecraft:', '')) THEN 'item'
+        ELSE 'unknown'
+      END AS item_group
+    FROM entries en
+    WHERE en.value <> 0
+  ),
+  mapped AS (
+    SELECT c.object, COALESCE(g.category, a.category, -1) AS category, c.value
+    FROM classified c
+    LEFT JOIN stats_category_mapping g ON g.item_group = c.item_group AND g.json_category = c.json_category
+    LEFT JOIN stats_category_mapping a ON a.item_group = 'any' AND a.json_category = c.json_category
+  ),
+  incoming AS (
+    SELECT DISTINCT ON (m.object, m.category) m.object, m.category, m.value
+    FROM mapped m
+  ),
+  previous AS (
+    SELECT a.object, a.category, a.value
+    FROM actions a
+    JOIN incoming i ON a.object = i.object AND a.category = i.category
+    WHERE a.player_id = p_player_id
+  ),
+  changed AS (
+    INSERT INTO actions (player_id, object, category, value)
+    SELECT p_player_id, i.object, i.category, i.value FROM incoming i
+    ON CONFLICT (player_id, object, category)
+    DO UPDATE SET "value" = EXCLUDED.value
+    WHERE actions.value IS DISTINCT FROM EXCLUDED.value
+    RETURNING actions.object, actions.category, actions.value
+  )
+  SELECT c.object, c.category, c.value, c.value - COALESCE(p.value, 0)
+  FROM changed c
+  LEFT JOIN previous p ON p.object = c.object AND p.category = c.category;
+END;
+$$;
@@ -0,0 +1,29 @@
+-- Indexes for the queries the DatabaseManager actually runs. Checked by database/explainHarness.py.
+
+-- Redundant indexes from older versions of initDBv2.sql
+DROP INDEX IF EXISTS public.player_uuid_idx;                    -- same as player_pkey
+DROP INDEX IF EXISTS public.servers_id_idx;                     -- same as servers_pkey
+DROP INDEX IF EXISTS public.player_server_info_player_uuid_idx; -- same as player_server_info_mojang_uuid_key
+DROP INDEX IF EXISTS public.player_server_info_server_id_idx;   -- prefix of player_server_info_server_player_unique
+DROP INDEX IF EXISTS public.actions_player_id_idx;              -- prefix of unique_action
+
+-- get_all_*_stats: player_id = ? AND category IN (...)
+-- "value" is deliberately not included: indexing it would turn every counter update into a non-HOT update.
+-- Lookups by (player_id, object) use the unique_action index.
+CREATE INDEX IF NOT EXISTS actions_player_category_idx
+  ON public.actions (player_id, category);
+
+-- get_player_id_from_mojang_uuid_and_server_id: index only scan, none of the columns are ever updated
+CREATE INDEX IF NOT EXISTS player_server_info_uuid_server_idx
+  ON public.player_server_info (mojang_uuid, server_id) INCLUDE (player_id);
+
+-- No partial index on "online": every !JOIN and !QUIT flips the flag, which would turn the status updates
+-- into non-HOT updates. Online counts per server use player_server_info_server_player_unique.
+
+-- get_server_information_dict: LOWER(subdomain) = ?
+CREATE INDEX IF NOT EXISTS servers_lower_subdomain_idx
+  ON public."servers" (LOWER(subdomain));
+
+-- get_mojang_uuid_from_player_name
+CREATE INDEX IF NOT EXISTS player_name_idx
+  ON public.player ("name");
@@ -0,0 +1,26 @@
+-- Play sessions, written once when the session is closed (the socket keeps the open ones in memory).
+CREATE TABLE IF NOT EXISTS public.sessions(
+  id bigserial PRIMARY KEY,
+  player_id uuid NOT NULL REFERENCES public.player_server_info (player_id),
+  server_id integer NOT NULL REFERENCES public."servers" (id),
+  session_start timestamp without time zone NOT NULL,
+  session_end timestamp without time zone NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS sessions_player_start_idx
+  ON public.sessions (player_id, session_start);
+
+-- Seconds played per player and day, updated in the same transaction as the sessions are inserted.
+-- Sessions over midnight are split between the days.
+CREATE TABLE IF NOT EXISTS public.daily_playtime(
+  player_id uuid NOT NULL REFERENCES public.player_server_info (player_id),
+  "day" date NOT NULL,
+  server_id integer NOT NULL REFERENCES public."servers" (id),
+  seconds integer NOT NULL DEFAULT 0,
+  CONSTRAINT daily_playtime_pkey PRIMARY KEY(player_id, "day")
+);
+
+COMMENT ON TABLE public.sessions IS
+  'Closed play sessions of the players, one row per !JOIN/!QUIT pair';
+COMMENT ON TABLE public.daily_playtime IS
+  'Rollup of the sessions table per player and day';
@@ -0,0 +1,4 @@
+-- Digest of the last stats json of a player, so unchanged resyncs can be skipped,
+-- and the time it was last received, so the socket only requests stats that are not fresh.
+ALTER TABLE public.player_server_info ADD COLUMN IF NOT EXISTS stats_digest text;
+ALTER TABLE public.player_server_info ADD COLUMN IF NOT EXISTS stats_synced_at timestamp without time zone;
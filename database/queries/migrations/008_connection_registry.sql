@@ -0,0 +1,14 @@
+-- Which socket process holds the TCP connection of a server, so commands for a server reach the right process.
+CREATE TABLE IF NOT EXISTS public.connection_registry(
+  server_id integer NOT NULL REFERENCES public."servers" (id),
+  node_id text NOT NULL,
+  worker_pid integer NOT NULL,
+  connected_at timestamp without time zone NOT NULL DEFAULT NOW(),
+  CONSTRAINT connection_registry_pkey PRIMARY KEY(server_id)
+);
+
+CREATE INDEX IF NOT EXISTS connection_registry_node_worker_idx
+  ON public.connection_registry (node_id, worker_pid);
+
+COMMENT ON TABLE public.connection_registry IS
+  'One row per connected server, written by the socket worker that accepted the connection';
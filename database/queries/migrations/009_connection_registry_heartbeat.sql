@@ -0,0 +1,3 @@
+-- Liveness of the registry entries. Every socket worker refreshes the heartbeat of its servers;
+-- entries of nodes that stopped refreshing are reaped by the other nodes.
+ALTER TABLE public.connection_registry ADD COLUMN IF NOT EXISTS heartbeat timestamp without time zone NOT NULL DEFAULT NOW();
@@ -0,0 +1,235 @@
+"""
+Benchmarks for the socket protocol. They run on a local socketpair, no server or database is needed.
+Run from the project root:
+    python -m mc_socket.benchmark send [messages]
+    python -m mc_socket.benchmark recv [messages] [stats_kib]
+    python -m mc_socket.benchmark compression [rounds]
+    python -m mc_socket.benchmark idle [connections] [seconds]
+"""
+import glob
+import json
+import select
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+from .heartbeat import HeartbeatScheduler
+from .protocol import HEADER, FrameReader, MessageConnection, decompress, frame, split_message, supported_codecs
+
+SAMPLE_STATS_FILES = "sampleData/*-*-*-*-*.json"
+
+
+class CountingSocket:
+    """
+    Wraps a socket and counts the calls that write to it.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def send(self, data):
+        self.calls += 1
+        return self.sock.send(data)
+
+    def sendall(self, data):
+        self.calls += 1
+        return self.sock.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def legacy_send_msg(msg, client):
+    """
+    The send path before MessageConnection: header and payload with two separate send calls.
+    """
+    message = msg.encode('utf-8')
+    send_len = str(len(message)).encode('utf-8')
+    send_len += b' ' * (HEADER - len(send_len))
+    client.send(send_len)
+    client.send(message)
+
+
+def legacy_receive(sock):
+    """
+    The receive path before FrameReader: a fresh bytearray per message, decoded and split as str.
+
+    Returns:
+    tuple: (uuid, stats) of a !STATS message
+    """
+    data_len = int(sock.recv(HEADER).decode('utf-8').strip())
+    data = bytearray()
+    while len(data) < data_len:
+        packet = sock.recv(data_len - len(data))
+        if not packet:
+            raise ConnectionError("Connection closed by peer")
+        data.extend(packet)
+    data = data.decode('utf-8')
+    _, value = data.split("~")
+    return value.split("|")
+
+
+def framed_receive(reader):
+    """
+    The receive path of the socket: split the messages of one read without copying, copy only the json body.
+
+    Returns:
+    list: [(uuid, stats),] of the !STATS messages
+    """
+    result = []
+    for message in reader.read():
+        _, value = split_message(message)
+        separator = bytes(value[:64]).find(b"|")
+        result.append((str(value[:separator], "utf-8"), bytes(value[separator + 1:])))
+    return result
+
+
+def drain(sock):
+    while sock.recv(1 << 16):
+        pass
+
+
+def benchmark_send(messages=100000):
+    """
+    Sends heartbeats with the old and the new send path and compares write calls and time per message.
+    """
+    for mode in ("legacy", "queued"):
+        writer, reader = socket.socketpair()
+        drainer = threading.Thread(target=drain, args=(reader,), daemon=True)
+        drainer.start()
+        counting = CountingSocket(writer)
+        start = time.perf_counter()
+        if mode == "legacy":
+            for _ in range(messages):
+                legacy_send_msg("!heartbeat", counting)
+        else:
+            conn = MessageConnection(counting, ("benchmark", 0), queue_size=messages)
+            for _ in range(messages):
+                conn.send("!heartbeat")
+            conn.close()  # waits for the queue to be written and closes the socket
+        elapsed = time.perf_counter() - start
+        if mode == "legacy":
+            writer.close()
+        drainer.join()
+        reader.close()
+        print(f"{mode:>10}: {counting.calls / messages:6.3f} write calls and {elapsed / messages * 1e6:6.2f} µs per message ({messages} messages)")
+
+
+def benchmark_recv(messages=50, stats_kib=2048):
+    """
+    Receives big !STATS messages with the old and the new receive path and compares time and peak memory per message.
+    """
+    stats = json.dumps({"stats": {"minecraft:custom": {f"minecraft:object_{i}": i for i in range(stats_kib * 1024 // 30)}}})
+    data = frame(f"!STATS~4ebe5f6f-c231-4315-9d60-097c48cc6d30|{stats}") * messages
+    for mode in ("legacy", "framed"):
+        writer, reader = socket.socketpair()
+        threading.Thread(target=writer.sendall, args=(data,), daemon=True).start()
+        frames = FrameReader(reader)
+        received = 0
+        tracemalloc.start()
+        start = time.perf_counter()
+        while received < messages:
+            if mode == "legacy":
+                legacy_receive(reader)
+                received += 1
+            else:
+                received += len(framed_receive(frames))
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()  # includes the receive buffer of the framed path
+        tracemalloc.stop()
+        writer.close()
+        reader.close()
+        print(f"{mode:>10}: {elapsed / messages * 1000:7.2f} ms per message, peak {peak / 1024 / 1024:6.2f} MiB "
+              f"for {len(stats) / 1024 / 1024:.2f} MiB messages ({messages} messages)")
+
+
+def benchmark_compression(rounds=200):
+    """
+    Compares the bytes on the wire and the cpu time of protocol v1 and the v2 codecs for the stats in sampleData.
+    """
+    payloads = []
+    for path in sorted(glob.glob(SAMPLE_STATS_FILES)):
+        with open(path, "r") as stats_file:
+            stats = json.dumps(json.load(stats_file))
+        payloads.append(f"!STATS~{path.split('/')[-1][:-5]}|{stats}".encode("utf-8"))
+    raw = sum(len(payload) for payload in payloads) / len(payloads)
+    for codec in [None, "none"] + supported_codecs():
+        start = time.perf_counter()
+        for _ in range(rounds):
+            frames = [frame(payload, codec) for payload in payloads]
+        compress_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for data in frames:
+                decompress(data[5:], codec) if codec else data[HEADER:]
+        decompress_time = time.perf_counter() - start
+        wire = sum(len(data) for data in frames) / len(frames)
+        count = rounds * len(payloads)
+        print(f"{codec or 'v1':>10}: {wire:9.0f} bytes on the wire per payload ({wire / raw * 100:5.1f} %), "
+              f"{compress_time / count * 1e6:8.1f} µs to frame, {decompress_time / count * 1e6:8.1f} µs to unpack")
+
+
+class CountingHeartbeatScheduler(HeartbeatScheduler):
+    wakeups = 0
+
+    def _process_due_slots(self):
+        CountingHeartbeatScheduler.wakeups += 1
+        super()._process_due_slots()
+
+
+def legacy_idle_loop(sock, stop, wakeups):
+    """
+    The connection loop before HeartbeatScheduler: a 1 second select and the deadline checks, per connection.
+    """
+    heartbeat_send_time = time.time()
+    while not stop.is_set():
+        select.select([sock], [], [], 1)
+        wakeups.append(1)
+        current_time = time.time()
+        if current_time - heartbeat_send_time > 5:
+            legacy_send_msg("!heartbeat", sock)
+            heartbeat_send_time = current_time
+
+
+def benchmark_idle(connections=1000, seconds=10):
+    """
+    Compares the cpu time of idle connections with per connection deadline checks and with the timer wheel.
+    """
+    for mode in ("legacy", "wheel"):
+        pairs = [socket.socketpair() for _ in range(connections)]
+        stop = threading.Event()
+        wakeups = []
+        if mode == "legacy":
+            for server_side, _ in pairs:
+                threading.Thread(target=legacy_idle_loop, args=(server_side, stop, wakeups), daemon=True).start()
+        else:
+            heartbeats = CountingHeartbeatScheduler(timeout=seconds * 2)
+            heartbeats.start()
+            for server_side, _ in pairs:
+                conn = MessageConnection(server_side, ("benchmark", 0))
+                heartbeats.register(conn)
+                heartbeats.beat(conn)  # stay connected for the whole run
+        start = time.process_time()
+        wakeups.clear()
+        CountingHeartbeatScheduler.wakeups = 0
+        time.sleep(seconds)
+        cpu = time.process_time() - start
+        stop.set()
+        count = len(wakeups) if mode == "legacy" else CountingHeartbeatScheduler.wakeups
+        print(f"{mode:>10}: {cpu / seconds * 100:6.2f} % cpu and {count / seconds:7.1f} timer wakeups per second "
+              f"for {connections} idle connections ({seconds} seconds)")
+        for server_side, client_side in pairs:
+            server_side.close()
+            client_side.close()
+
+
+if __name__ == "__main__":
+    benchmarks = {"send": benchmark_send, "recv": benchmark_recv, "compression": benchmark_compression,
+                  "idle": benchmark_idle}
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(f"usage: python -m mc_socket.benchmark [{'|'.join(benchmarks)}] [messages]")
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
@@ -0,0 +1,130 @@
+"""
+Local control channel between the web app and the socket process.
+
+A Unix domain socket with one JSON object per line in both directions:
+    request:  {"action": "push_pin", "server_id": 1, "uuid": "...", "pin": 123456}
+    response: {"ok": true, "result": ...} or {"ok": false, "error": "..."}
+Connections are kept open, so a request costs one round trip on the local socket.
+"""
+import json
+import os
+import queue
+import select
+import socket
+import threading
+
+from colorlogx import get_logger
+
+CONTROL_SOCKET_PATH = "/tmp/mcconnect-control.sock"
+CONTROL_TIMEOUT = 2  # seconds the web app waits for an answer
+CONTROL_POOL_SIZE = 4  # idle connections the web app keeps open
+
+logger = get_logger("control")
+
+
+class ControlServer(threading.Thread):
+    """
+    Serves the control requests of local processes.
+    handlers maps an action to a callable that gets the remaining fields of the request as keyword arguments
+    and returns a json serializable result. Exceptions are returned as errors.
+    """
+
+    def __init__(self, handlers, path=CONTROL_SOCKET_PATH):
+        super().__init__(daemon=True)
+        self.handlers = handlers
+        self.path = path
+
+    def run(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left over from a previous run
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o660)
+        server.listen()
+        logger.info(f"Control channel is listening on {self.path}")
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn, conn.makefile("rwb") as stream:
+            for line in stream:
+                stream.write(json.dumps(self._handle(line)).encode("utf-8") + b"\n")
+                stream.flush()
+
+    def _handle(self, line):
+        try:
+            request = json.loads(line)
+            action = request.pop("action")
+            handler = self.handlers.get(action)
+            if handler is None:
+                return {"ok": False, "error": f"Unknown action {action}"}
+            return {"ok": True, "result": handler(**request)}
+        except Exception as e:
+            logger.error(f"Control request {line!r} failed. Error: {e}")
+            return {"ok": False, "error": str(e)}
+
+
+class ControlClient:
+    """
+    Sends control requests to the socket process over a pool of open connections. Thread safe.
+    """
+
+    def __init__(self, path=CONTROL_SOCKET_PATH, pool_size=CONTROL_POOL_SIZE, timeout=CONTROL_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock, sock.makefile("rwb")
+
+    def _take(self):
+        """
+        Returns a pooled connection that is still open, or a new one. A pooled connection that became readable
+        while idle was closed by the socket process (e.g. a restart) and is dropped before anything is written.
+        """
+        while True:
+            try:
+                sock, stream = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            if not select.select([sock], [], [], 0)[0]:
+                return sock, stream
+            stream.close()
+            sock.close()
+        try:
+            return self._connect()
+        except OSError as e:
+            raise ConnectionError(f"Control channel {self.path} is not reachable: {e}")
+
+    def request(self, action, **params):
+        """
+        Returns:
+        The result of the action. Raises ConnectionError if the socket process is not reachable
+        and RuntimeError if the action failed. A request that was sent is never sent again, its
+        action (e.g. push_pin) may have been executed even if the answer did not arrive in time.
+        """
+        data = json.dumps({"action": action, **params}).encode("utf-8") + b"\n"
+        sock, stream = self._take()
+        try:
+            stream.write(data)
+            stream.flush()
+            line = stream.readline()
+            if not line:
+                raise ConnectionError("Control channel closed the connection")
+        except OSError as e:  # includes the timeout
+            stream.close()
+            sock.close()
+            raise ConnectionError(f"Control request {action} failed: {e}")
+        try:
+            self._pool.put_nowait((sock, stream))
+        except queue.Full:
+            stream.close()
+            sock.close()
+        response = json.loads(line)
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+        return response["result"]
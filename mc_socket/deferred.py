@@ -0,0 +1,60 @@
+from colorlogx import get_logger
+
+DEFERRED_STATS_MAX_PLAYERS = 50000  # players whose stats are held while the database is unavailable, over all shards
+DEFERRED_STATS_BATCH_SIZE = 200  # players written with one update_player_stats_batch once it is back
+DEFERRED_STATS_RETRY_INTERVAL = 1  # seconds between two checks of the circuit breaker
+
+logger = get_logger("deferred")
+
+
+class DeferredStats:
+    """
+    Holds the stats an ingest shard received while the circuit breaker of the database was open, until the
+    shard writes them once it closed again. Every stats message is a full snapshot of a player, so only the
+    latest one per player is kept, and newer stats the shard writes first replace the deferred ones.
+    Stats that do not fit anymore are dropped; the resync after the next reconnect requests them again
+    because their stats_synced_at is old.
+    Only used by the thread of its shard.
+    """
+
+    def __init__(self, max_players=DEFERRED_STATS_MAX_PLAYERS):
+        self.max_players = max_players
+        self.counters = {"deferred": 0, "dropped": 0, "written": 0}
+        self._pending = {}  # (server_id, mojang_uuid) -> raw stats json
+
+    def put(self, server_id, mojang_uuid, stats):
+        """
+        Returns:
+        bool: False if the stats were dropped because too many players are waiting.
+        """
+        key = (server_id, mojang_uuid.lower())
+        if key not in self._pending and len(self._pending) >= self.max_players:
+            self.counters["dropped"] += 1
+            return False
+        self._pending[key] = stats
+        self.counters["deferred"] += 1
+        return True
+
+    def discard(self, server_id, mojang_uuids):
+        for mojang_uuid in mojang_uuids:
+            self._pending.pop((server_id, mojang_uuid.lower()), None)
+
+    def take(self, batch_size=DEFERRED_STATS_BATCH_SIZE):
+        """
+        Removes up to batch_size stats of one server.
+
+        Returns:
+        tuple: (server_id, {mojang_uuid: raw stats json})
+        """
+        server_id = next(iter(self._pending))[0]
+        batch = {}
+        for key in list(self._pending):
+            if key[0] == server_id:
+                batch[key[1]] = self._pending.pop(key)
+                if len(batch) >= batch_size:
+                    break
+        self.counters["written"] += len(batch)
+        return server_id, batch
+
+    def __len__(self):
+        return len(self._pending)
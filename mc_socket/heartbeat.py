@@ -0,0 +1,105 @@
+import math
+import threading
+import time
+
+from colorlogx import get_logger
+
+HEARTBEAT_INTERVAL = 5  # seconds between two !heartbeat to a connection
+HEARTBEAT_TIMEOUT = 7  # seconds without !BEAT after which a connection is closed
+FIRST_BEAT_TIMEOUT = 2  # seconds a new connection has to answer the first !heartbeat
+HEARTBEAT_TICK = 0.5  # resolution of the timer wheel; deadlines are handled in batches of one tick
+
+logger = get_logger("heartbeat")
+
+
+class HeartbeatScheduler(threading.Thread):
+    """
+    Owns the heartbeat deadlines of all connections in one hashed timer wheel.
+    Every connection sits in the slot of its next deadline. Once per tick the due slot is processed:
+    expired connections are closed without waiting for their writers, the others get their !heartbeat and move
+    to the slot of their next deadline.
+    A !BEAT only moves the expiry of the connection forward, the wheel is not touched until the slot is due.
+    Without connections the thread sleeps until the next one is registered.
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT, tick=HEARTBEAT_TICK):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self._slots = [set() for _ in range(math.ceil(max(interval, timeout) / tick) + 1)]
+        self._deadlines = {}  # conn -> [send_at, expires_at]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._last_tick = self._tick_of(time.monotonic())
+
+    def _tick_of(self, timestamp):
+        return int(timestamp / self.tick)
+
+    def _schedule(self, conn, deadline):
+        """Puts a connection into the slot of a deadline. Needs self._lock."""
+        tick = max(self._tick_of(deadline), self._last_tick + 1)
+        self._slots[tick % len(self._slots)].add(conn)
+
+    def register(self, conn):
+        """
+        Starts the heartbeat of a new connection: the first !heartbeat is sent with the next tick.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._deadlines[conn] = [now, now + FIRST_BEAT_TIMEOUT]
+            self._schedule(conn, now)
+        self._wakeup.set()
+
+    def unregister(self, conn):
+        with self._lock:
+            self._deadlines.pop(conn, None)  # the slot entry is dropped when its tick is processed
+
+    def beat(self, conn):
+        """
+        Called for every !BEAT (and other signs of life) of a connection.
+        """
+        deadlines = self._deadlines.get(conn)
+        if deadlines:
+            deadlines[1] = time.monotonic() + self.timeout
+
+    def run(self):
+        while True:
+            if not self._deadlines:
+                self._wakeup.wait()
+                self._wakeup.clear()
+            time.sleep(max(0, (self._last_tick + 1) * self.tick - time.monotonic()))
+            self._process_due_slots()
+
+    def _process_due_slots(self):
+        now = time.monotonic()
+        expired, due = [], []
+        with self._lock:
+            current_tick = self._tick_of(now)
+            for tick in range(self._last_tick + 1, min(current_tick, self._last_tick + len(self._slots)) + 1):
+                self._last_tick = tick
+                slot = self._slots[tick % len(self._slots)]
+                connections = list(slot)
+                slot.clear()
+                for conn in connections:
+                    deadlines = self._deadlines.get(conn)
+                    if deadlines is None:
+                        continue
+                    if deadlines[1] <= now:
+                        del self._deadlines[conn]
+                        expired.append(conn)
+                        continue
+                    if deadlines[0] <= now:
+                        due.append(conn)
+                        deadlines[0] = now + self.interval
+                    self._schedule(conn, min(deadlines))
+            self._last_tick = current_tick
+
+        for conn in due:
+            try:
+                conn.send("!heartbeat")
+            except ConnectionError:
+                pass  # the connection thread notices the closed connection
+        for conn in expired:
+            logger.info(f"{conn.addr} has not sent a heartbeat within {self.timeout} seconds. Disconnecting...")
+            conn.close(flush=False)  # nothing is left to tell a dead peer, do not hold up the next tick
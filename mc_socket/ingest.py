@@ -0,0 +1,338 @@
+import collections
+import heapq
+import itertools
+import json
+import queue
+import threading
+import time
+import uuid
+import zlib
+
+import psycopg2
+
+from colorlogx import get_logger
+from database.circuitBreaker import DatabaseUnavailableError
+from mc_socket.deferred import DeferredStats, DEFERRED_STATS_MAX_PLAYERS, DEFERRED_STATS_RETRY_INTERVAL
+
+STATS_INGEST_SHARDS = 4  # ingest threads per socket worker, each with its own database connection
+STATS_INGEST_QUEUE_SIZE = 256  # stats messages waiting to be dispatched
+STATS_INGEST_SERVER_QUEUED = 64  # stats messages of one server waiting or held back in the dispatcher and the shards
+STATS_SHARD_QUEUE_SIZE = 256  # dispatched messages waiting per shard; a full shard blocks the dispatcher
+STATS_COALESCE_WINDOW = 0.5  # seconds the stats of a player are held so newer stats can replace them; 0 writes right away
+STATS_WRITE_BATCH_SIZE = 200  # players of one server written with one update_player_stats_batch
+SHARD_CONNECT_RETRY_DELAY = 1  # seconds before a shard retries to create its database manager, doubled every attempt
+SHARD_CONNECT_MAX_RETRY_DELAY = 30  # seconds
+
+logger = get_logger("ingest")
+
+
+def parse_stats_message(command, payload):
+    """
+    Parameters:
+    command (str): !STATS or !STATSBATCH
+    payload (bytes): The part of the message behind the "~".
+
+    Returns:
+    dict: {mojang_uuid: raw stats json}, None if the message is invalid. Players of a !STATSBATCH with an invalid
+    uuid are left out.
+    """
+    if command == "!STATS":
+        separator = payload[:64].find(b"|")  # uuid|json
+        if separator == -1:
+            return None
+        mojang_uuid = _canonical_uuid(payload[:separator].decode("utf-8", "replace"))
+        return {mojang_uuid: payload[separator + 1:]} if mojang_uuid else None
+    try:
+        players = json.loads(payload)  # {uuid: stats,}
+    except ValueError:
+        return None
+    if not isinstance(players, dict):
+        return None
+    stats_by_uuid = {}
+    for mojang_uuid, stats in players.items():
+        canonical_uuid = _canonical_uuid(mojang_uuid)
+        if canonical_uuid is None:
+            logger.warning(f"Skipping the stats of invalid uuid {mojang_uuid!r}")
+            continue
+        stats_by_uuid[canonical_uuid] = json.dumps(stats)
+    return stats_by_uuid
+
+
+def _canonical_uuid(value):
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        return None
+
+
+class StatsIngestShard(threading.Thread):
+    """
+    Writes the stats of the players hashed to it, in the order they were dispatched, with its own
+    database connection. While the database is unavailable the stats are kept in its DeferredStats
+    and written between the next messages once the circuit breaker closed.
+    The stats of a player are held for STATS_COALESCE_WINDOW after they arrived. Stats of the same player
+    arriving within the window replace them (the plugin sends the same stats once per world when the
+    worlds are saved), so only the latest ones are parsed and written.
+    """
+
+    def __init__(self, index, db_manager_factory, max_deferred_players, queue_size=STATS_SHARD_QUEUE_SIZE,
+                 coalesce_window=STATS_COALESCE_WINDOW, release=None):
+        """
+        Parameters:
+        release (callable, optional): release(server_id) is called for every message taken from the queue.
+        """
+        super().__init__(daemon=True)
+        self.index = index
+        self.release = release
+        self.db_manager_factory = db_manager_factory
+        self.coalesce_window = coalesce_window
+        self.db_manager = None  # created in the shard thread
+        self.deferred = DeferredStats(max_deferred_players)
+        self.counters = {"messages": 0, "players": 0, "failed": 0, "coalesced": 0, "busy_seconds": 0.0}
+        self._queue = queue.Queue(queue_size)
+        # (server_id, mojang_uuid) -> [due at, raw stats json], in the order they are due
+        self._pending = collections.OrderedDict()
+
+    def put(self, server_id, stats_by_uuid):
+        self._queue.put((server_id, stats_by_uuid))
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def pending(self):
+        return len(self._pending)
+
+    def run(self):
+        db_manager = self.db_manager = self._create_db_manager()
+        while True:
+            try:
+                try:
+                    server_id, stats_by_uuid = self._queue.get(timeout=self._next_timeout())
+                except queue.Empty:
+                    pass
+                else:
+                    if self.release:
+                        self.release(server_id)
+                    self._hold(server_id, stats_by_uuid)
+                    self.counters["messages"] += 1
+                self._write_due(db_manager)
+                if self.deferred and db_manager.is_available():
+                    server_id, stats_by_uuid = self.deferred.take()
+                    logger.info(f"Shard {self.index} writes {len(stats_by_uuid)} deferred stats of server {server_id}, {len(self.deferred)} players left")
+                    self._write(db_manager, server_id, stats_by_uuid)
+            except Exception as e:  # the shard must not die, its queue would block the dispatcher
+                logger.error(f"Shard {self.index} failed. Error: {e}")
+
+    def _create_db_manager(self):
+        """
+        Retries until the database manager could be created, e.g. while the database is unreachable at startup.
+        Messages queue up meanwhile and block the dispatcher once the queue is full.
+        """
+        delay = SHARD_CONNECT_RETRY_DELAY
+        while True:
+            try:
+                return self.db_manager_factory()
+            except Exception as e:
+                logger.error(f"Shard {self.index} could not connect to the database, retrying in {delay} seconds. Error: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, SHARD_CONNECT_MAX_RETRY_DELAY)
+
+    def _next_timeout(self):
+        timeouts = []
+        if self._pending:
+            timeouts.append(max(0, next(iter(self._pending.values()))[0] - time.monotonic()))
+        if self.deferred:
+            timeouts.append(DEFERRED_STATS_RETRY_INTERVAL)
+        return min(timeouts) if timeouts else None
+
+    def _hold(self, server_id, stats_by_uuid):
+        due_at = time.monotonic() + self.coalesce_window
+        self.deferred.discard(server_id, stats_by_uuid)  # superseded by these stats
+        for mojang_uuid, stats in stats_by_uuid.items():
+            key = (server_id, mojang_uuid.lower())
+            if key in self._pending:
+                self._pending[key][1] = stats  # keeps its place and due time
+                self.counters["coalesced"] += 1
+            else:
+                self._pending[key] = [due_at, stats]
+
+    def _write_due(self, db_manager):
+        now = time.monotonic()
+        due = {}  # server_id -> {mojang_uuid: raw stats json}
+        while self._pending and next(iter(self._pending.values()))[0] <= now:
+            (server_id, mojang_uuid), (_, stats) = self._pending.popitem(last=False)
+            due.setdefault(server_id, {})[mojang_uuid] = stats
+        for server_id, stats_by_uuid in due.items():
+            mojang_uuids = list(stats_by_uuid)
+            for i in range(0, len(mojang_uuids), STATS_WRITE_BATCH_SIZE):
+                self._write(db_manager, server_id, {mojang_uuid: stats_by_uuid[mojang_uuid]
+                                                    for mojang_uuid in mojang_uuids[i:i + STATS_WRITE_BATCH_SIZE]})
+
+    def _write(self, db_manager, server_id, stats_by_uuid):
+        started = time.monotonic()
+        try:
+            self._write_batch(db_manager, server_id, stats_by_uuid)
+        except Exception as e:  # one invalid payload rolls back the whole batch, so only that one may be lost
+            logger.error(f"Writing the stats of {len(stats_by_uuid)} players of server {server_id} failed, writing them one by one. Error: {e}")
+            for mojang_uuid, stats in stats_by_uuid.items():
+                try:
+                    self._write_batch(db_manager, server_id, {mojang_uuid: stats})
+                except Exception as e:
+                    self.counters["failed"] += 1
+                    logger.error(f"Dropping the stats of {mojang_uuid} of server {server_id}. Error: {e}")
+        self.counters["busy_seconds"] += time.monotonic() - started
+
+    def _write_batch(self, db_manager, server_id, stats_by_uuid):
+        """
+        Writes the stats in one transaction, or defers them while the database is unavailable.
+        Raises the errors of invalid stats.
+        """
+        try:
+            if not db_manager.is_available():
+                raise DatabaseUnavailableError("Circuit breaker is open")
+            written = db_manager.update_player_stats_batch(server_id, stats_by_uuid)
+        except (DatabaseUnavailableError, psycopg2.OperationalError, psycopg2.InterfaceError):
+            dropped = [mojang_uuid for mojang_uuid, stats in stats_by_uuid.items() if not self.deferred.put(server_id, mojang_uuid, stats)]
+            if dropped:
+                logger.warning(f"Dropped the stats of {len(dropped)} players of server {server_id}, too many stats are deferred")
+            return
+        self.counters["players"] += written  # committed with changed stats, not the skipped or unchanged ones
+
+
+class StatsIngestDispatcher(threading.Thread):
+    """
+    Writes the bulk stats messages so they do not hold up the control messages of the connection threads.
+    The connection threads only split off the command and queue the payload here, !JOIN, !QUIT, !AUTH
+    and !BEAT are handled right away. The dispatcher parses the messages and hashes every (server_id, uuid)
+    to one of the StatsIngestShards, so the stats of one player are always written by the same shard in the
+    order they were received, while different players are written in parallel over several connections.
+    A !STATSBATCH is therefore committed in one transaction per shard it touches, not as a whole.
+    Messages of a server over its rate limits are held back here until the delay returned by
+    ConnectionLimiter.admit passed, in the order they were received, so the connection thread keeps reading.
+    Every server may have STATS_INGEST_SERVER_QUEUED messages waiting in the dispatcher and the shards,
+    a message of a server over its share is dropped right away. The other servers are never blocked by it.
+    """
+
+    def __init__(self, db_manager_factory, send, shards=STATS_INGEST_SHARDS, queue_size=STATS_INGEST_QUEUE_SIZE,
+                 server_queued=STATS_INGEST_SERVER_QUEUED):
+        """
+        Parameters:
+        db_manager_factory (callable): Creates the DatabaseManager of a shard, called in the shard thread.
+        send (callable): send(msg, conn) answers invalid messages.
+        """
+        super().__init__(daemon=True)
+        self.send = send
+        self.server_queued = server_queued
+        self.shards = [StatsIngestShard(index, db_manager_factory, DEFERRED_STATS_MAX_PLAYERS // shards,
+                                        release=self._release)
+                       for index in range(shards)]
+        self.counters = {"dropped": 0, "throttled": 0}
+        self._queue = queue.Queue(queue_size)
+        self._queued = collections.Counter()  # server_id -> messages waiting in the dispatcher and the shards
+        self._lock = threading.Lock()
+        self._held = []  # heap of (due at, sequence, server_id, conn, command, payload), only used by the dispatcher
+        self._held_until = {}  # server_id -> due time of its last held message
+        self._sequence = itertools.count()
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+        super().start()
+
+    def put(self, server_id, conn, command, payload, delay=0):
+        """
+        Queues one stats message without blocking.
+
+        Parameters:
+        payload (bytes): A copy of the message behind the "~", not a memoryview into the read buffer.
+        delay (float, optional): Seconds the message is held back before it is dispatched.
+
+        Returns:
+        bool: False if the server or the queue had no room, the message was dropped.
+        """
+        with self._lock:
+            if self._queued[server_id] >= self.server_queued:
+                self.counters["dropped"] += 1
+                return False
+            self._queued[server_id] += 1
+        try:
+            self._queue.put_nowait((server_id, conn, command, payload, time.monotonic() + delay))
+        except queue.Full:
+            self._release(server_id)
+            self.counters["dropped"] += 1
+            return False
+        return True
+
+    def _release(self, server_id, count=1):
+        with self._lock:
+            self._queued[server_id] -= count
+            if self._queued[server_id] <= 0:
+                del self._queued[server_id]
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def shard_of(self, server_id, mojang_uuid):
+        return zlib.crc32(f"{server_id}:{mojang_uuid.lower()}".encode()) % len(self.shards)
+
+    def run(self):
+        while True:
+            timeout = max(0, self._held[0][0] - time.monotonic()) if self._held else None
+            try:
+                server_id, conn, command, payload, due = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                due = max(due, self._held_until.get(server_id, 0))  # behind the held messages of the server
+                if due > time.monotonic():
+                    self._held_until[server_id] = due
+                    heapq.heappush(self._held, (due, next(self._sequence), server_id, conn, command, payload))
+                    self.counters["throttled"] += 1
+                else:
+                    self._dispatch(server_id, conn, command, payload)
+            while self._held and self._held[0][0] <= time.monotonic():
+                due, _, server_id, conn, command, payload = heapq.heappop(self._held)
+                if self._held_until.get(server_id) == due:
+                    del self._held_until[server_id]
+                self._dispatch(server_id, conn, command, payload)
+
+    def _dispatch(self, server_id, conn, command, payload):
+        stats_by_uuid = parse_stats_message(command, payload)
+        if not stats_by_uuid:
+            self._release(server_id)
+        if stats_by_uuid is None:
+            try:
+                self.send("error|005", conn)
+            except ConnectionError:
+                pass
+            return
+        logger.debug(f"Dispatching {len(payload)} bytes of stats of {len(stats_by_uuid)} players of server {server_id}")
+        by_shard = {}
+        for mojang_uuid, stats in stats_by_uuid.items():
+            by_shard.setdefault(self.shard_of(server_id, mojang_uuid), {})[mojang_uuid] = stats
+        if by_shard:
+            self._release(server_id, 1 - len(by_shard))  # released again by every shard that takes its part
+        for index, shard_stats in by_shard.items():
+            self.shards[index].put(server_id, shard_stats)
+
+    def get_state(self):
+        """
+        Returns:
+        dict: The queue depth and counters of every shard and the skew, the players written by the busiest
+        shard relative to the average (1.0 is an even spread).
+        """
+        shards = [{"shard": shard.index, "queued": shard.qsize(), "pending": shard.pending(),
+                   "circuit": shard.db_manager.get_circuit_state()["state"] if shard.db_manager else None,
+                   "deferred": {"pending": len(shard.deferred), **shard.deferred.counters}, **shard.counters}
+                  for shard in self.shards]
+        players = [shard["players"] for shard in shards]
+        average = sum(players) / len(players)
+        with self._lock:
+            servers_queued = dict(self._queued)
+        return {"queued": self.qsize(),
+                "held": len(self._held),
+                "servers_queued": servers_queued,
+                **self.counters,
+                "skew": round(max(players) / average, 2) if average else 1.0,
+                "max_shard_queued": max(shard["queued"] for shard in shards),
+                "shards": shards}
@@ -0,0 +1,93 @@
+import time
+
+from colorlogx import get_logger
+
+# license_type -> limits of one server connection. Byte bursts have to be at least max_message_size.
+RATE_LIMITS = {
+    0: {"messages_per_second": 50, "message_burst": 200, "bytes_per_second": 512 * 1024,
+        "byte_burst": 8 * 1024 * 1024, "max_message_size": 8 * 1024 * 1024, "send_queue_size": 500},
+    1: {"messages_per_second": 200, "message_burst": 1000, "bytes_per_second": 2 * 1024 * 1024,
+        "byte_burst": 32 * 1024 * 1024, "max_message_size": 32 * 1024 * 1024, "send_queue_size": 2000},
+    2: {"messages_per_second": 1000, "message_burst": 5000, "bytes_per_second": 8 * 1024 * 1024,
+        "byte_burst": 64 * 1024 * 1024, "max_message_size": 64 * 1024 * 1024, "send_queue_size": 5000},
+}
+DEFAULT_LICENSE_TYPE = 0  # limits of license types without an entry in RATE_LIMITS
+UNAUTHENTICATED_MAX_MESSAGE_SIZE = 4 * 1024  # until !AUTH succeeded
+MAX_THROTTLE_DELAY = 2  # seconds a control message may be over the limit; control messages over it are dropped
+
+logger = get_logger("limits")
+
+
+def get_rate_limits(license_type):
+    return RATE_LIMITS.get(license_type, RATE_LIMITS[DEFAULT_LICENSE_TYPE])
+
+
+class TokenBucket:
+    """
+    Refills `rate` tokens per second up to `burst`. Not thread safe, every connection thread owns its buckets.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """
+        Returns the seconds until `amount` tokens (at most a full burst) are available.
+        """
+        self._refill()
+        return max(0, (min(amount, self.burst) - self.tokens) / self.rate)
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= amount  # may become negative for amounts above the burst, the debt is paid by later refills
+
+
+class ConnectionLimiter:
+    """
+    Rate limits on the messages and bytes one server sends, plus counters of what was throttled or dropped.
+    The connection thread is never delayed, so control messages are handled while bulk messages wait.
+    Bulk messages over the limit are held back by the StatsIngestDispatcher for the returned delay;
+    control messages are dropped instead if they would have to wait more than MAX_THROTTLE_DELAY.
+    """
+
+    def __init__(self, server_id, license_type):
+        self.server_id = server_id
+        self.license_type = license_type
+        self.limits = get_rate_limits(license_type)
+        self.messages = TokenBucket(self.limits["messages_per_second"], self.limits["message_burst"])
+        self.bytes = TokenBucket(self.limits["bytes_per_second"], self.limits["byte_burst"])
+        self.counters = {"messages": 0, "bytes": 0, "throttled": 0, "throttle_seconds": 0.0, "dropped": 0,
+                         "slow_consumer_disconnects": 0}
+
+    def admit(self, size, delay=True):
+        """
+        Parameters:
+        delay (bool): True for bulk messages, which are held back until the server is within its limits again.
+        False for latency sensitive messages; they are never delayed, only dropped, and the tokens
+        they use delay the following bulk messages instead.
+
+        Returns:
+        float: The seconds the message has to be held back before it is processed, 0 to process it right away,
+        None if it has to be dropped.
+        """
+        wait = max(self.messages.wait_time(1), self.bytes.wait_time(size))
+        if wait > MAX_THROTTLE_DELAY and not delay:
+            self.counters["dropped"] += 1
+            logger.warning(f"Dropping a message of {size} bytes from server {self.server_id}, rate limit exceeded")
+            return None
+        if wait and delay:
+            self.counters["throttled"] += 1
+            self.counters["throttle_seconds"] += wait
+        self.messages.consume(1)
+        self.bytes.consume(size)
+        self.counters["messages"] += 1
+        self.counters["bytes"] += size
+        return wait if delay else 0
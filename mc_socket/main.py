@@ -1,31 +1,56 @@
+import json
 import os
-import select
+import signal
 import socket
 import sys
 import threading
 import time
 import traceback
+import uuid
 
 # Projekt-Root ermitteln (eine Ebene über dem aktuellen Script)
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
-from database.databaseManagerV2 import DatabaseManager
+from database.circuitBreaker import DatabaseUnavailableError
+from database.databaseManagerV2 import DatabaseManager, SOCKET_COMMANDS_CHANNEL, STATS_HISTORY_ENABLED
+from database.notifications import NotificationListener
 from colorlogx import get_logger
 from database.minecraft import Minecraft
+from mc_socket.control import ControlServer
+from mc_socket.heartbeat import HeartbeatScheduler
+from mc_socket.ingest import StatsIngestDispatcher
+from mc_socket.limits import ConnectionLimiter, UNAUTHENTICATED_MAX_MESSAGE_SIZE
+from mc_socket.presence import OnlinePlayerRegistry, StatusWriteBuffer
+from mc_socket.protocol import FrameReader, MessageConnection, negotiate, split_message
+from mc_socket.resync import ResyncScheduler
 
 logger = get_logger("socket")
-db_manager = DatabaseManager()
+# created per worker process by init_worker(), so no connection or thread is shared across a fork
+db_manager = None
+status_buffer = None
+heartbeats = None
+online_players = None
+resync_scheduler = None
+stats_ingest = None
 
 
-
-HEADER = 10
 PORT = 9991
+ROLLUP_RECONCILE_INTERVAL = 3600  # seconds
+SOCKET_WORKERS = 1  # more than 1 forks worker processes that all accept on PORT with SO_REUSEPORT
+WORKER_RESTART_DELAY = 1  # seconds before a crashed worker is started again
+NODE_ID = socket.gethostname()  # has to be unique per socket node sharing the database
+REGISTRY_HEARTBEAT_INTERVAL = 10  # seconds between two heartbeats of the connection registry entries
+REGISTRY_STALE_AFTER = 30  # seconds without heartbeat after which an entry is reaped
+BULK_COMMANDS = ("!STATS", "!STATSBATCH")  # written by the ingest shards, behind the other messages
+SOCKET_COMMANDS = ("!loginPin~", "!sendPlayerStats~", "!sendAllPlayerStats")  # messages other processes may route to a server
 SERVER = "0.0.0.0"
 ADDR = (SERVER, PORT)
 
 active_connections = {}
+rate_limiters = {}  # server_id -> ConnectionLimiter, kept across reconnects so a reconnect does not refill the buckets
+pending_releases = {}  # server_id -> unregistered, disconnects that could not be written to the database yet
 
 """
 Reserved characters:
@@ -41,158 +66,367 @@ Error codes:
 003: Update player status failed
 004: Invalid command
 005: Invalid request
+006: Rate limit exceeded, the message was dropped
+007: Database unavailable, try again later
 
 Success codes:
 100: Auth successful
 101: updated player status successfully
+
+Commands:
+!STATSBATCH~{"<uuid>": <stats json>, ...} writes the stats of many players,
+!STATS~<uuid>|<stats json> the stats of one player.
+A !STATSBATCH is not atomic: its players are spread over the ingest shards and written in one transaction
+per shard, so if one shard fails the players of the other shards are still written. The stats of every
+single player are always written completely or not at all.
+
+Protocol v2:
+A client sends "!AUTH~<key>|v2:zstd,zlib" (codecs in the order it prefers). If the server answers
+"success|100|v2:<codec>" every following message in both directions has a 5 byte binary header
+(payload length as 4 byte big endian, codec id: 0 none, 1 zlib, 2 zstd) and bigger payloads are compressed.
+Clients that send only the key keep the 10 byte ascii header.
+
+Limits:
+Every server may send a number of messages and bytes per second depending on its license type (mc_socket/limits.py).
+Bulk messages over the limit are held back by the StatsIngestDispatcher until the server is within its limits
+again, while the connection keeps reading; other messages are dropped with 006 if they would have to wait too long.
+!BEAT is never limited.
+Messages above the maximum size of the license (4 KiB before !AUTH) and a send queue the server
+does not read fast enough close the connection.
+
+Priorities:
+!STATS and !STATSBATCH are bulk messages. The connection thread queues them for the StatsIngestDispatcher,
+which spreads them by (server, uuid) over shards with their own database connections, and handles
+everything else right away. A stats message of a server that already has too many stats messages
+waiting is dropped with 006. Stats of a player that arrive within STATS_COALESCE_WINDOW replace each other,
+only the latest ones are written. Only bulk
+messages are delayed by the rate limits. Outgoing stats requests of a resync are sent only when no other
+message (login pin, acknowledgement, heartbeat) is waiting.
+
+Degraded mode:
+While the circuit breaker of the database is open (see database/circuitBreaker.py) !JOIN and !QUIT are
+acknowledged from memory and written later, stats are held by the ingest shards until the database
+is back, and !AUTH is answered with 007. Heartbeats do not depend on the database.
 """
 
-def send_msg(msg, client):
-    message = msg.encode('utf-8')
-    msg_len = len(message)
-    send_len = str(msg_len).encode('utf-8')
-    send_len += b' ' * (HEADER - len(send_len))
-    logger.debug(f"Sending message: '{msg}' to client: {client}")
-    client.send(send_len)
-    client.send(message)
+def send_msg(msg, client, bulk=False):
+    client.send(msg, bulk)
 
-def execute_command(data, conn, addr, server_id):
-    try:
-        command, value = data.split("~")
-    except ValueError:
-        logger.error(f"005 for {data}")
-        send_msg("error|005", conn)
-        return
-    if command == "!JOIN":
-        logger.debug("Join registered")
-        if db_manager.update_player_status_from_mojang_uuid_and_server_id(value, server_id, "online"):
-            send_msg("success|101", conn)
-        else:
-            send_msg("error|003", conn)
-    elif command == "!QUIT":
-        if db_manager.update_player_status_from_mojang_uuid_and_server_id(value, server_id, "offline"):
-            send_msg("success|101", conn)
-        else:
-            send_msg("error|003", conn)
-    elif command == "!STATS":
-        try:
-            uuid, stats = value.split("|")
-        except ValueError:
+def execute_command(command, value, conn, addr, server_id, delay=0):
+    """
+    Parameters:
+    command (str): The part of the message in front of the "~".
+    value (memoryview): The rest of the message, only valid until the next message is read.
+    delay (float, optional): Seconds a bulk message is held back by the rate limits.
+    """
+    if command in ("!JOIN", "!QUIT"):
+        mojang_uuid = parse_uuid(value)
+        if mojang_uuid is None:  # would make the whole status batch fail in the database
             send_msg("error|005", conn)
             return
-        print(f"Following stats are provided for uuid: {uuid}:\n\n{stats}\n\n")
-        player_id = db_manager.get_player_id_from_mojang_uuid_and_server_id(uuid, server_id)
-        if not player_id:
-            db_manager.add_player(uuid)
-            player_id = db_manager.add_player_server_info(server_id, uuid)
-        db_manager.update_player_stats(player_id,stats)
+        if command == "!JOIN":
+            logger.debug("Join registered")
+            online_players.join(server_id, mojang_uuid)
+        else:
+            online_players.quit(server_id, mojang_uuid)
+        send_msg("success|101", conn)
+    elif command in BULK_COMMANDS:
+        logger.debug(f"Queued {len(value)} bytes of {command} ({stats_ingest.qsize()} stats messages waiting)")
+        if not stats_ingest.put(server_id, conn, command, bytes(value), delay):
+            send_msg("error|006", conn)
     else:
         send_msg("error|004", conn)
 
 
-def request_all_stats(conn):
-    send_msg("!sendAllPlayerStats", conn)
-    
+def parse_uuid(value):
+    """
+    Returns:
+    str: The uuid in its canonical lower case form, None if value is not a uuid.
+    """
+    try:
+        return str(uuid.UUID(str(value, "utf-8").strip()))
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def get_rate_limiter(server_id):
+    license_type = db_manager.get_license_type_from_server_id(server_id)
+    limiter = rate_limiters.get(server_id)
+    if limiter is None or limiter.license_type != license_type:
+        limiter = rate_limiters[server_id] = ConnectionLimiter(server_id, license_type)
+    return limiter
+
+
+def is_connected(server_id, conn):
+    return active_connections.get(server_id) is conn
+
 
-def handle_client_connection(conn, addr):
+def handle_client_connection(sock, addr):
     logger.info(f"{addr} connected to the socket.")
+    conn = MessageConnection(sock, addr)
+    reader = FrameReader(sock, max_message_size=UNAUTHENTICATED_MAX_MESSAGE_SIZE)
+    heartbeats.register(conn)  # sends the heartbeats and closes the connection if the beats stop
     connected = True
-    heartbeat_received_time = time.time() - 5
-    heartbeat_send_time = time.time() - 5
     server_id = None
+    limiter = None
     unauthorized_beat_count = 0
         
     while connected and unauthorized_beat_count < 5:
         try:
-            ready_to_read, _, _ = select.select([conn], [], [], 1)
-            
-            if ready_to_read:
-                data_len = conn.recv(HEADER).decode('utf-8').strip()                
-                if data_len:
-                    data_len = int(data_len)
-                    logger.debug("data_len: %d", data_len)
-                    
-                    data = bytearray()  # Use bytearray to accumulate received data
-                    while len(data) < data_len:
-                        packet = conn.recv(data_len - len(data))
-                        if not packet:
-                            break  # Connection closed
-                        data.extend(packet)
-                    
-                    data = data.decode('utf-8')
-                    logger.debug("Received message: %s", data)
-                    logger.debug(f"[{addr}] {data}")
-
-                    
-                    if data == "!BEAT":
-                        heartbeat_received_time = time.time()
-                        unauthorized_beat_count += 1 if not server_id else 0
-                        continue
-                    elif not server_id:
-                        if "!AUTH~" in data:
-                            _, value = data.split("~")
-                            server = db_manager.get_server_id_by_auth_key(value)
-                            if server:
-                                server_id = server
-                                logger.info(f"{addr} connected to server {server_id}")
-                                active_connections[server_id] = conn
-                                send_msg("success|100", conn)
-                                request_all_stats(conn)
+            for message in reader.read():  # blocks until data arrives or the connection is closed
+                command, value = split_message(message)
+                logger.debug(f"[{addr}] {command} ({len(message)} bytes)")
+
+                if command == "!BEAT":
+                    heartbeats.beat(conn)
+                    unauthorized_beat_count += 1 if not server_id else 0
+                    continue
+                elif not server_id:
+                    if command == "!AUTH" and value is not None:
+                        key, codec = negotiate(str(value, "utf-8"))
+                        try:
+                            server = db_manager.get_server_id_by_auth_key(key)
+                            server_limiter = get_rate_limiter(server) if server else None
+                        except Exception as e:  # the breaker is open or the database failed
+                            logger.error(f"Authenticating {addr} failed. Error: {e}")
+                            send_msg("error|007", conn)
+                            continue
+                        if server:
+                            previous = active_connections.get(server)
+                            active_connections[server] = conn
+                            try:
+                                db_manager.register_connection(server, NODE_ID, os.getpid())
+                            except DatabaseUnavailableError:  # registry_heartbeat registers it once the database is back
+                                logger.warning(f"Could not register the connection of server {server}, the database is unavailable")
+                            except Exception as e:  # not registered anywhere, the server has to authenticate again
+                                logger.error(f"Registering the connection of server {server} failed. Error: {e}")
+                                if active_connections.get(server) is conn:
+                                    if previous is None:
+                                        active_connections.pop(server, None)
+                                    else:
+                                        active_connections[server] = previous
+                                send_msg("error|007", conn)
                                 continue
-                            send_msg("error|001", conn)
+                            server_id = server
+                            logger.info(f"{addr} connected to server {server_id} (protocol {'v2, ' + codec if codec else 'v1'})")
+                            limiter = server_limiter
+                            reader.max_message_size = limiter.limits["max_message_size"]
+                            conn.queue_size = limiter.limits["send_queue_size"]
+                            if codec:
+                                conn.upgrade(codec, f"success|100|v2:{codec}")  # still v1, the client switches on this answer
+                                reader.upgrade()
+                            else:
+                                send_msg("success|100", conn)
+                            resync_scheduler.schedule(server_id, conn)
                             continue
-                        send_msg("error|002", conn)
-                        heartbeat_received_time = time.time()
-                        continue  
-                    elif data == "!DISCONNECT":
-                        connected = False
+                        send_msg("error|001", conn)
                         continue
-                    elif "~" in data:
-                        execute_command(data, conn, addr, server_id)
-                    else:
-                        send_msg("error|005", conn)
-                    
-            current_time = time.time()
-            if current_time - heartbeat_send_time > 5:
-                send_msg("!heartbeat", conn)
-                heartbeat_send_time = current_time
-            if current_time - heartbeat_received_time > 7:
-                logger.info(f"{addr} has not sent heartbeat within 7 seconds. Disconnecting...")
-                connected = False
+                    send_msg("error|002", conn)
+                    heartbeats.beat(conn)
+                    continue  
+                elif command == "!DISCONNECT":
+                    connected = False
+                    break
+                delay = limiter.admit(len(message), delay=command in BULK_COMMANDS)  # held back by the ingest, not here
+                if delay is None:
+                    send_msg("error|006", conn)
+                elif value is not None:
+                    try:
+                        execute_command(command, value, conn, addr, server_id, delay)
+                    except ConnectionError:
+                        raise
+                    except Exception as e:  # keep handling the other messages of this read
+                        logger.error(f"Handling {command} of {addr} failed. Error: {e}\n{traceback.format_exc()}")
+                else:
+                    send_msg("error|005", conn)
                 
-        except BrokenPipeError:
-            logger.error(f"{addr} got a broken pipe error! Disconnecting...")
+        except OSError as e:  # includes the socket being closed by the heartbeat scheduler
+            logger.error(f"{addr} got a connection error: {e}! Disconnecting...")
             connected = False
         except Exception as e:
             logger.error(f"Error occured with client {addr}. Error: {e}\n{traceback.print_exc()}")
-    if server_id != None:
+    heartbeats.unregister(conn)
+    if conn.overflowed and limiter is not None:
+        limiter.counters["slow_consumer_disconnects"] += 1
+    if server_id != None and active_connections.get(server_id) is conn:  # the server may already have reconnected
         active_connections.pop(server_id, None)
+        release_server(server_id)
     conn.close()
     logger.info(f"{addr} disconnected.")
 
+def release_server(server_id, unregistered=False):
+    """
+    Removes the registry entry of a disconnected server and sets its players offline.
+    If the database is unavailable registry_heartbeat tries again later.
+    """
+    pending_releases.pop(server_id, None)
+    try:
+        if not unregistered:
+            if not db_manager.unregister_connection(server_id, NODE_ID, os.getpid()):  # reconnected to another worker
+                return
+            unregistered = True
+        online_players.clear_server(server_id)
+    except Exception as e:
+        logger.error(f"Releasing server {server_id} failed, retrying later. Error: {e}")
+        pending_releases[server_id] = unregistered
+
 def login_watcher():  # no waiting, no perma checking; instead webserver can send socket to here to trigger it
     logger.info("Login watcher started")
     while True:
         time.sleep(5)
-        logins = db_manager.get_all_logins()  # not implemented; wont be in future
-        for login in logins:
-            pin = login[0]
-            player_id = login[1]
-            server_id = db_manager.get_server_id_from_player_id(player_id)  # does not exist, needs to be implemented
-            player_uuid = db_manager.get_player_uuid_from_player_id(player_id)
-            if server_id:
-                conn = active_connections.get(server_id)
-                if conn:
-                    send_msg(f"!loginPin~{player_uuid}~{pin}", conn)  # TODO: send msg only once except player leaves and rejoins
+        try:
+            logins = db_manager.get_all_logins()  # not implemented; wont be in future
+            for login in logins:
+                pin = login[0]
+                player_id = login[1]
+                server_id = db_manager.get_server_id_from_player_id(player_id)
+                player_uuid = db_manager.get_mojang_uuid_from_player_id(player_id)
+                if server_id:
+                    conn = active_connections.get(server_id)
+                    if conn:
+                        send_msg(f"!loginPin~{player_uuid}~{pin}", conn)  # TODO: send msg only once except player leaves and rejoins
+                    elif db_manager.get_connection_owner(server_id):
+                        continue  # another worker holds the connection and pushes the pin
+                    else:
+                        logger.error(f"No connection for server id: {server_id}")
+                        db_manager.delete_login_entry(player_id)
                 else:
-                    logger.error(f"No connection for server id: {server_id}")
+                    logger.error(f"No server id: {server_id}")
                     db_manager.delete_login_entry(player_id)
+        except Exception as e:  # e.g. the breaker is open; the pins are pushed once the database is back
+            logger.error(f"Pushing the login pins failed. Error: {e}")
+
+def registry_heartbeat():
+    """
+    Refreshes the connection registry entries of this worker and restores entries that were reaped
+    while the connection was still alive (e.g. after the database was unreachable for a while).
+    """
+    while True:
+        time.sleep(REGISTRY_HEARTBEAT_INTERVAL)
+        for server_id, unregistered in list(pending_releases.items()):
+            if server_id in active_connections:  # reconnected to this worker in the meantime
+                pending_releases.pop(server_id, None)
             else:
-                logger.error(f"No server id: {server_id}")
-                db_manager.delete_login_entry(player_id)
+                release_server(server_id, unregistered)
+        try:
+            registered = set(db_manager.refresh_connections(NODE_ID, os.getpid()))
+            for server_id in set(active_connections) - registered:
+                logger.warning(f"Registry entry of server {server_id} is missing. Registering again")
+                db_manager.register_connection(server_id, NODE_ID, os.getpid())
+        except Exception as e:
+            logger.error(f"Refreshing the connection registry failed. Error: {e}")
+
+def registry_reaper():
+    """
+    Removes the registry entries of nodes and workers that stopped refreshing them and sets their players offline.
+    """
+    logger.info("Registry reaper started")
+    while True:
+        time.sleep(REGISTRY_STALE_AFTER)
+        try:
+            db_manager.reap_stale_connections(REGISTRY_STALE_AFTER)
+        except Exception as e:
+            logger.error(f"Reaping the connection registry failed. Error: {e}")
+
+def handle_socket_command(channel, payload):
+    """
+    Sends a message that another process routed to a server over SOCKET_COMMANDS_CHANNEL,
+    if this worker holds the connection of the server.
+    """
+    command = json.loads(payload)
+    if command["node_id"] != NODE_ID or command["worker_pid"] != os.getpid():
+        return
+    conn = active_connections.get(command["server_id"])
+    if conn is None:
+        logger.warning(f"Dropping routed command for server {command['server_id']}, it is not connected anymore")
+        return
+    if command.get("action") == "resync":
+        resync_scheduler.schedule(command["server_id"], conn)
+        return
+    if not command["message"].startswith(SOCKET_COMMANDS):
+        logger.error(f"Refusing routed command {command['message']!r} for server {command['server_id']}")
+        return
+    send_msg(command["message"], conn)
+
+def route_to_server(server_id, message=None, action="send"):
+    """
+    Executes a command for a server in this worker if it holds the connection, otherwise routes it
+    to the worker that does.
+
+    Returns:
+    bool: False if the server is not connected.
+    """
+    conn = active_connections.get(server_id)
+    if conn is None:
+        return db_manager.send_command_to_server(server_id, message, action)
+    if action == "resync":
+        resync_scheduler.schedule(server_id, conn)
+    else:
+        send_msg(message, conn)
+    return True
+
+# actions of the local control channel (see mc_socket/control.py)
+CONTROL_HANDLERS = {
+    "push_pin": lambda server_id, uuid, pin: route_to_server(server_id, f"!loginPin~{uuid}~{pin}"),
+    "refresh_player": lambda server_id, uuid: route_to_server(server_id, f"!sendPlayerStats~{uuid}"),
+    "resync_server": lambda server_id: route_to_server(server_id, action="resync"),
+    "rate_limits": lambda: [{"server_id": server_id, "license_type": limiter.license_type, **limiter.counters}
+                            for server_id, limiter in list(rate_limiters.items())],  # of worker 0 only
+    "circuit_state": lambda: db_manager.get_circuit_state(),  # the shards report theirs in ingest_state
+    "ingest_state": lambda: stats_ingest.get_state(),
+    "list_servers": lambda: [{"server_id": server_id, "node_id": node_id, "worker_pid": worker_pid,
+                              "connected_at": connected_at.isoformat(), "heartbeat": heartbeat.isoformat()}
+                             for server_id, node_id, worker_pid, connected_at, heartbeat in db_manager.get_connected_servers()],
+}
+
+def rollup_reconciler():
+    """
+    Periodically verifies the server totals against the actions table and repairs drift, and creates the
+    stats history partitions of the coming months.
+    Uses its own database connection so the full scan does not block the ingest.
+    """
+    logger.info("Rollup reconciler started")
+    reconcile_db_manager = None
+    while True:
+        time.sleep(ROLLUP_RECONCILE_INTERVAL)
+        try:
+            reconcile_db_manager = reconcile_db_manager or DatabaseManager()
+            if STATS_HISTORY_ENABLED:
+                reconcile_db_manager.ensure_stats_history_partitions()
+            reconcile_db_manager.reconcile_server_stat_totals()
+        except Exception as e:
+            logger.error(f"Reconciling the server totals failed. Error: {e}")
+
+def init_worker():
+    """
+    Creates the database connection and the background threads of this process.
+    """
+    global db_manager, status_buffer, heartbeats, online_players, resync_scheduler, stats_ingest
+    db_manager = DatabaseManager()
+    status_buffer = StatusWriteBuffer(db_manager)
+    heartbeats = HeartbeatScheduler()
+    online_players = OnlinePlayerRegistry(db_manager, status_buffer)
+    resync_scheduler = ResyncScheduler(db_manager, online_players, send_msg, is_connected)
+    stats_ingest = StatsIngestDispatcher(DatabaseManager, send_msg)
+    status_buffer.start()
+    stats_ingest.start()
+    heartbeats.start()
+    resync_scheduler.start()
+    logger.info("Starting login watcher...")
+    threading.Thread(target=login_watcher).start()
+    threading.Thread(target=registry_heartbeat, daemon=True).start()
+    NotificationListener([SOCKET_COMMANDS_CHANNEL], handle_socket_command).start()
 
-def start_server():
+def create_server_socket(reuse_port=False):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind(ADDR)
     server.listen()
+    return server
+
+def start_server(server):
     logger.debug(f"[LISTENING] Server is listening on {SERVER}:{PORT}")
     while True:
         conn, addr = server.accept()
@@ -200,16 +434,86 @@ def start_server():
         thread.start()
         logger.debug(f"Active connections: {threading.active_count() - 2}")
 
-if __name__ == "__main__":
-    logger.info(f"Socket is starting...\nADDR:{ADDR}")
+def run_worker(index, reuse_port):
+    """
+    Serves connections in this process. Worker 0 also runs the rollup reconciler, the registry reaper
+    and the control channel for the web app.
+    """
     try:
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind(ADDR)
+        server = create_server_socket(reuse_port)
     except Exception as e:
         logger.error(f"Error starting server: {e}")
         sys.exit(1)
-    logger.info("Socket established successfully")
-    logger.info("Starting login watcher...")
-    threading.Thread(target=login_watcher).start()
-    start_server()
+    logger.info(f"Socket established successfully (worker {index}, pid {os.getpid()})")
+    init_worker()
+    if index == 0:
+        logger.info("Starting rollup reconciler...")
+        threading.Thread(target=rollup_reconciler, daemon=True).start()
+        threading.Thread(target=registry_reaper, daemon=True).start()
+        ControlServer(CONTROL_HANDLERS).start()
+    start_server(server)
+
+def cleanup_worker(pid):
+    """
+    Sets the players of the servers a crashed worker was connected to offline and removes its registry entries.
+    """
+    cleanup_db_manager = DatabaseManager()
+    try:
+        for server_id in cleanup_db_manager.remove_connections_of_worker(NODE_ID, pid):
+            cleanup_db_manager.set_all_players_offline_by_server_id(server_id)
+    finally:
+        cleanup_db_manager.conn.close()
+
+def supervise(workers):
+    """
+    Forks the workers and starts them again when they exit. The supervisor itself holds no database
+    connection and no threads while it forks.
+    """
+    children = {}  # pid -> worker index
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            try:
+                run_worker(index, reuse_port=True)
+            finally:
+                os._exit(1)
+        children[pid] = index
+        logger.info(f"Started worker {index} with pid {pid}")
+
+    def stop(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        spawn(index)
+    while True:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        logger.error(f"Worker {index} (pid {pid}) exited with status {status}. Restarting...")
+        try:
+            cleanup_worker(pid)
+        except Exception as e:
+            logger.error(f"Cleaning up after worker {index} failed. Error: {e}")
+        time.sleep(WORKER_RESTART_DELAY)
+        spawn(index)
+
+if __name__ == "__main__":
+    logger.info(f"Socket is starting...\nADDR:{ADDR}")
+    startup_db_manager = DatabaseManager()
+    # no server is connected to this node yet; servers of other nodes keep their players
+    for server_id in startup_db_manager.remove_connections_of_worker(NODE_ID):
+        startup_db_manager.set_all_players_offline_by_server_id(server_id)
+    startup_db_manager.reap_stale_connections(REGISTRY_STALE_AFTER)
+    startup_db_manager.conn.close()
+    if SOCKET_WORKERS > 1:
+        supervise(SOCKET_WORKERS)
+    else:
+        run_worker(0, reuse_port=False)
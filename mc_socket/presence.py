@@ -0,0 +1,154 @@
+import threading
+import time
+from datetime import datetime
+
+import psycopg2
+
+from colorlogx import get_logger
+from database.circuitBreaker import DatabaseUnavailableError
+
+STATUS_FLUSH_WINDOW = 0.1  # seconds status changes are collected before they are written
+
+logger = get_logger("presence")
+
+
+class StatusWriteBuffer(threading.Thread):
+    """
+    Collects online status changes for STATUS_FLUSH_WINDOW and writes them with one statement.
+    Changes of the same player are coalesced, the last one wins.
+    """
+
+    def __init__(self, db_manager, window=STATUS_FLUSH_WINDOW):
+        super().__init__(daemon=True)
+        self.db_manager = db_manager
+        self.window = window
+        self._pending = {}  # (server_id, mojang_uuid) -> (online, seen_at)
+        self._sessions = []  # [(server_id, mojang_uuid, session_start, session_end),]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def put(self, server_id, mojang_uuid, online, seen_at=None):
+        with self._lock:
+            self._pending[(server_id, mojang_uuid)] = (online, seen_at or datetime.now())
+        self._wakeup.set()
+
+    def close_sessions(self, sessions):
+        """
+        Queues closed sessions, they are written together with the next batch of status changes.
+
+        Parameters:
+        sessions (list): [(server_id, mojang_uuid, session_start, session_end),]
+        """
+        with self._lock:
+            self._sessions.extend(sessions)
+        self._wakeup.set()
+
+    def mark_server_offline(self, server_id):
+        """
+        Turns the pending changes of a server into offline changes, so a late flush can not set a player of a
+        disconnected server online again.
+        """
+        with self._lock:
+            for key, (online, seen_at) in self._pending.items():
+                if key[0] == server_id:
+                    self._pending[key] = (False, seen_at)
+
+    def run(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.window)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            sessions, self._sessions = self._sessions, []
+        if not batch and not sessions:
+            return
+        changes = [(server_id, mojang_uuid, online, seen_at) for (server_id, mojang_uuid), (online, seen_at) in batch.items()]
+        try:
+            self.db_manager.update_player_statuses(changes, sessions)
+        except (DatabaseUnavailableError, psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            logger.error(f"Writing {len(batch)} status changes and {len(sessions)} sessions failed, retrying with the next batch. Error: {e}")
+            with self._lock:
+                for key, change in batch.items():
+                    self._pending.setdefault(key, change)  # newer changes win
+                self._sessions[:0] = sessions
+            self._wakeup.set()
+            if isinstance(e, DatabaseUnavailableError):  # the changes stay in memory until the database is back
+                time.sleep(e.retry_after)
+        except Exception as e:  # an invalid row would fail every retry, so find it by writing the rows one by one
+            logger.error(f"Writing {len(batch)} status changes and {len(sessions)} sessions failed, writing them one by one. Error: {e}")
+            self._write_one_by_one(changes, sessions)
+
+    def _write_one_by_one(self, changes, sessions):
+        rows = [([change], []) for change in changes] + [([], [session]) for session in sessions]
+        for row_changes, row_sessions in rows:
+            try:
+                self.db_manager.update_player_statuses(row_changes, row_sessions)
+            except Exception as e:
+                logger.error(f"Dropping status change {row_changes} / session {row_sessions}. Error: {e}")
+
+
+class OnlinePlayerRegistry:
+    """
+    Authoritative set of the online players of every connected server, fed by !JOIN, !QUIT and disconnects.
+    Every change is also written to the database through the StatusWriteBuffer, which publishes it to the web app
+    (see database/notifications.py).
+    The open play sessions are only held here; a session is written once, when the player quits or the server
+    disconnects. Sessions that are open when the socket stops are lost.
+    """
+
+    def __init__(self, db_manager, status_buffer):
+        self.db_manager = db_manager
+        self.status_buffer = status_buffer
+        self._online = {}  # server_id -> {mojang uuid: session start}
+        self._lock = threading.Lock()
+
+    def join(self, server_id, mojang_uuid):
+        mojang_uuid = mojang_uuid.lower()
+        now = datetime.now()
+        with self._lock:
+            self._online.setdefault(server_id, {}).setdefault(mojang_uuid, now)  # a repeated !JOIN keeps the session
+        self.status_buffer.put(server_id, mojang_uuid, True, now)
+
+    def quit(self, server_id, mojang_uuid):
+        mojang_uuid = mojang_uuid.lower()
+        now = datetime.now()
+        with self._lock:
+            session_start = self._online.get(server_id, {}).pop(mojang_uuid, None)
+        if session_start:
+            self.status_buffer.close_sessions([(server_id, mojang_uuid, session_start, now)])
+        self.status_buffer.put(server_id, mojang_uuid, False, now)
+
+    def clear_server(self, server_id):
+        """
+        Sets every player of a disconnected server offline and closes their sessions.
+
+        Returns:
+        set: The uuids of the players that were online.
+        """
+        now = datetime.now()
+        with self._lock:
+            players = self._online.pop(server_id, {})
+        self.status_buffer.close_sessions([(server_id, mojang_uuid, session_start, now)
+                                           for mojang_uuid, session_start in players.items()])
+        for mojang_uuid in players:
+            self.status_buffer.put(server_id, mojang_uuid, False, now)  # keeps last_seen
+        self.status_buffer.mark_server_offline(server_id)
+        self.db_manager.set_all_players_offline_by_server_id(server_id)
+        logger.info(f"Cleared {len(players)} online players of server {server_id}")
+        return set(players)
+
+    def get_online_players(self, server_id):
+        with self._lock:
+            return set(self._online.get(server_id, ()))
+
+    def is_online(self, server_id, mojang_uuid):
+        with self._lock:
+            return mojang_uuid.lower() in self._online.get(server_id, ())
+
+    def get_online_count(self, server_id):
+        with self._lock:
+            return len(self._online.get(server_id, ()))
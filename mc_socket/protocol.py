@@ -0,0 +1,312 @@
+import collections
+import socket
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, v2 clients fall back to zlib
+    zstandard = None
+
+from colorlogx import get_logger
+
+HEADER = 10  # bytes of the ascii length header in front of every message
+PROTOCOL_V1 = 1  # ascii length header, uncompressed; every connection starts with it
+PROTOCOL_V2 = 2  # binary header (length, codec) with compressed bodies, negotiated with !AUTH~key|v2:codec,...
+V2_HEADER = struct.Struct("!IB")  # payload length (4 bytes, big endian), codec id (1 byte)
+CODEC_IDS = {"none": 0, "zlib": 1, "zstd": 2}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+COMPRESS_MIN_SIZE = 256  # smaller v2 payloads are sent uncompressed
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+SEND_QUEUE_SIZE = 1000  # messages a connection may have queued before it is considered dead
+SEND_BATCH_SIZE = 64  # queued messages that are written with one sendall
+RECV_BUFFER_SIZE = 64 * 1024  # initial size of the receive buffer, it grows for bigger messages
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+COMMAND_MAX_LENGTH = 32  # the command and its "~" have to be within the first bytes of a message
+
+logger = get_logger("protocol")
+
+
+def supported_codecs():
+    return ["zstd", "zlib"] if zstandard else ["zlib"]
+
+
+def negotiate(auth_value):
+    """
+    Splits the value of !AUTH into the license key and the protocol the client asked for.
+    v1 clients send only the key, v2 clients append "|v2:" and the codecs they support in the order they prefer.
+
+    Returns:
+    tuple: (key, codec) codec is None for protocol v1, otherwise the first codec both sides support.
+    """
+    key, _, capabilities = auth_value.partition("|")
+    if not capabilities.startswith("v2"):
+        return key, None
+    offered = capabilities[3:].split(",") if capabilities.startswith("v2:") else []
+    codec = next((codec for codec in offered if codec in supported_codecs()), "none")
+    return key, codec
+
+
+def compress(payload, codec):
+    if codec == "zlib":
+        return zlib.compress(payload, ZLIB_LEVEL)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+    return payload
+
+
+def decompress(payload, codec, max_size=MAX_MESSAGE_SIZE):
+    """
+    Decompresses a v2 payload. Raises ConnectionError for corrupt payloads and payloads that would grow
+    beyond max_size, the stream can not be read any further after either.
+    """
+    try:
+        if codec == "zlib":
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(payload, max_size)
+            if decompressor.unconsumed_tail:
+                raise ConnectionError(f"Decompressed message is bigger than {max_size} bytes")
+            return data
+        if codec == "zstd":
+            if zstandard is None:
+                raise ConnectionError("zstd is not available")
+            # stream_reader ignores the content size in the frame header, so a forged size can not allocate more
+            data = zstandard.ZstdDecompressor().stream_reader(payload).read(max_size + 1)
+            if len(data) > max_size:
+                raise ConnectionError(f"Decompressed message is bigger than {max_size} bytes")
+            return data
+    except zlib.error as e:
+        raise ConnectionError(f"Corrupt zlib payload: {e}")
+    except Exception as e:
+        if zstandard is not None and isinstance(e, zstandard.ZstdError):
+            raise ConnectionError(f"Corrupt zstd payload: {e}")
+        raise
+    return payload
+
+
+def frame(msg, codec=None):
+    """
+    Returns header and payload of a message as one buffer.
+    For protocol v1 (codec None) the header is the payload length in ascii, padded with spaces to HEADER bytes.
+    For protocol v2 it is V2_HEADER and payloads from COMPRESS_MIN_SIZE on are compressed with the codec.
+    """
+    payload = msg.encode("utf-8") if isinstance(msg, str) else msg
+    if codec is not None:
+        codec = codec if len(payload) >= COMPRESS_MIN_SIZE else "none"
+        payload = compress(payload, codec)
+        return V2_HEADER.pack(len(payload), CODEC_IDS[codec]) + payload
+    header = b"%-10d" % len(payload)
+    if len(header) != HEADER:
+        raise ValueError(f"Message of {len(payload)} bytes is too long for the header")
+    return header + payload
+
+
+def split_message(message):
+    """
+    Splits a received message "command~value" without copying the value.
+
+    Parameters:
+    message (memoryview): One message as returned by FrameReader.read().
+
+    Returns:
+    tuple: (command, value) command as str, value as memoryview or None if the message has no "~".
+           command is None if the message is too long to be a command without a value.
+    """
+    head = bytes(message[:COMMAND_MAX_LENGTH])
+    separator = head.find(b"~")
+    if separator == -1:
+        return (head.decode("utf-8") if len(message) <= COMMAND_MAX_LENGTH else None), None
+    return head[:separator].decode("utf-8"), message[separator + 1:]
+
+
+class FrameReader:
+    """
+    Reads the messages of one connection into a reusable buffer with recv_into.
+    The messages are returned as memoryviews into that buffer, so they are only valid until the next read().
+    Starts with protocol v1; upgrade() switches to v2 for everything received afterwards.
+    Messages longer than max_message_size close the connection before they are buffered.
+    """
+
+    def __init__(self, sock, buffer_size=RECV_BUFFER_SIZE, max_message_size=MAX_MESSAGE_SIZE):
+        self.sock = sock
+        self.max_message_size = max_message_size
+        self.protocol = PROTOCOL_V1
+        self._header_size = HEADER
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first byte that is not parsed yet
+        self._end = 0  # end of the received bytes
+
+    def upgrade(self):
+        """
+        Switches to protocol v2. The client may only send v2 messages after it received the answer to !AUTH,
+        so nothing of v2 can be in the buffer yet.
+        """
+        self.protocol = PROTOCOL_V2
+        self._header_size = V2_HEADER.size
+
+    def read(self):
+        """
+        Receives once and returns all messages that are complete.
+        Raises ConnectionError if the peer closed the connection.
+
+        Returns:
+        list: [memoryview,] the payloads of the complete messages
+        """
+        self._make_room()
+        received = self.sock.recv_into(self._view[self._end:])
+        if not received:
+            raise ConnectionError("Connection closed by peer")
+        self._end += received
+
+        messages = []
+        while self._end - self._start >= self._header_size:
+            length = self._message_length()
+            if self._end - self._start < self._header_size + length:
+                break
+            payload_start = self._start + self._header_size
+            payload = self._view[payload_start:payload_start + length]
+            if self.protocol == PROTOCOL_V2:
+                codec = CODEC_NAMES.get(self._view[self._start + V2_HEADER.size - 1])
+                if codec is None:
+                    raise ConnectionError(f"Unknown codec {self._view[self._start + V2_HEADER.size - 1]}")
+                if codec != "none":
+                    payload = memoryview(decompress(payload, codec, self.max_message_size))
+            messages.append(payload)
+            self._start = payload_start + length
+        return messages
+
+    def _message_length(self):
+        if self.protocol == PROTOCOL_V2:
+            length = V2_HEADER.unpack_from(self._view, self._start)[0]
+        else:
+            try:
+                length = int(bytes(self._view[self._start:self._start + HEADER]))
+            except ValueError:
+                raise ConnectionError(f"Invalid header {bytes(self._view[self._start:self._start + HEADER])}")
+        if not 0 <= length <= self.max_message_size:
+            raise ConnectionError(f"Invalid message length {length}")
+        return length
+
+    def _make_room(self):
+        """
+        Moves the unparsed bytes to the front of the buffer, or into a bigger buffer if the next message
+        does not fit. Only called once the messages of the last read() are handled.
+        """
+        pending = self._end - self._start
+        needed = self._header_size + (self._message_length() if pending >= self._header_size else 0)
+        if needed > len(self._buffer):
+            buffer = bytearray(max(needed, 2 * len(self._buffer)))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer, self._view = buffer, memoryview(buffer)
+        elif self._start and (not pending or self._start + needed > len(self._buffer)):
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            return
+        self._start, self._end = 0, pending
+
+
+class MessageConnection:
+    """
+    Socket of one connected server with a bounded outgoing queue.
+    send() can be called from any thread; one writer thread per connection frames the queued messages
+    and writes them with sendall, several queued messages at once. Every message is queued together with the
+    codec of the moment it was queued, so the protocol switch of upgrade() happens at one point of the queue.
+    Bulk messages (stats requests of a resync) are only written when no other message is waiting,
+    so login pins, acknowledgements and heartbeats do not queue behind them.
+    """
+
+    def __init__(self, sock, addr, queue_size=SEND_QUEUE_SIZE):
+        self.sock = sock
+        self.addr = addr
+        self.queue_size = queue_size
+        self.codec = None  # None while the connection speaks protocol v1
+        self.closed = False
+        self.overflowed = False  # closed because the peer did not read fast enough
+        self.sent_messages = 0
+        self.send_calls = 0
+        self._queue = collections.deque()
+        self._bulk_queue = collections.deque()
+        self._condition = threading.Condition()
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, msg, bulk=False):
+        """
+        Queues a message. Raises ConnectionError if the connection is closed or the peer does not read
+        fast enough to keep both queues together below queue_size, in which case the connection is closed.
+        """
+        with self._condition:
+            if self.closed:
+                raise ConnectionError(f"Connection to {self.addr} is closed")
+            if len(self._queue) + len(self._bulk_queue) >= self.queue_size:
+                overflow = self.overflowed = True
+            else:
+                overflow = False
+                (self._bulk_queue if bulk else self._queue).append((msg, self.codec))
+                self._condition.notify()
+        if overflow:
+            logger.error(f"Send queue of {self.addr} is full. Closing the connection")
+            self.close()
+            raise ConnectionError(f"Send queue of {self.addr} is full")
+
+    def upgrade(self, codec, msg):
+        """
+        Queues msg as the last message of protocol v1 and sends every following message with protocol v2
+        and the negotiated codec. Queued bulk messages are moved in front of msg, they are still v1.
+        """
+        with self._condition:
+            if self.closed:
+                raise ConnectionError(f"Connection to {self.addr} is closed")
+            self._queue.extend(self._bulk_queue)
+            self._bulk_queue.clear()
+            self._queue.append((msg, self.codec))
+            self.codec = codec
+            self._condition.notify()
+
+    def _write(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._bulk_queue and not self.closed:
+                    self._condition.wait()
+                if not self._queue and not self._bulk_queue:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), SEND_BATCH_SIZE))]
+                batch += [self._bulk_queue.popleft() for _ in range(min(len(self._bulk_queue), SEND_BATCH_SIZE - len(batch)))]
+            try:
+                self.sock.sendall(b"".join([frame(msg, codec) for msg, codec in batch]))
+            except OSError as e:
+                logger.error(f"Sending to {self.addr} failed. Error: {e}")
+                self.close()
+                return
+            self.send_calls += 1
+            self.sent_messages += len(batch)
+
+    def close(self, flush=True):
+        """
+        Stops accepting messages. Already queued messages are still written if the socket is alive,
+        afterwards the socket is shut down. flush=False shuts the socket down right away, which makes
+        a writer blocked on a dead peer fail at once instead of waiting up to a second for it.
+        """
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            self._condition.notify()
+        if not flush:
+            self._shutdown()
+        if threading.current_thread() is not self._writer:
+            self._writer.join(timeout=1)
+        self._shutdown()
+        self.sock.close()
+
+    def _shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
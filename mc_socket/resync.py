@@ -0,0 +1,80 @@
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from colorlogx import get_logger
+from database.circuitBreaker import DatabaseUnavailableError
+
+RESYNC_MAX_CONCURRENT_SERVERS = 2  # servers that are resynced at the same time over all connections
+RESYNC_BATCH_SIZE = 20  # players requested with one batch of !sendPlayerStats
+RESYNC_BATCH_INTERVAL = 1  # seconds between two batches of one server
+RESYNC_FRESH_AGE = 3600  # seconds; players whose stats are younger are not requested
+
+logger = get_logger("resync")
+
+
+class ResyncScheduler:
+    """
+    Requests the stats of the players of (re)connected servers without flooding the database.
+    Servers are queued and at most RESYNC_MAX_CONCURRENT_SERVERS are resynced at once. Instead of one
+    !sendAllPlayerStats the players are requested one by one with !sendPlayerStats in paced batches,
+    online players first. Players whose stats were received within RESYNC_FRESH_AGE are skipped.
+    """
+
+    def __init__(self, db_manager, online_players, send, is_connected, workers=RESYNC_MAX_CONCURRENT_SERVERS):
+        """
+        Parameters:
+        send (callable): send(msg, conn, bulk) sends one message to a server.
+        is_connected (callable): is_connected(server_id, conn) tells if conn is still the connection of the server.
+        """
+        self.db_manager = db_manager
+        self.online_players = online_players
+        self.send = send
+        self.is_connected = is_connected
+        self.workers = workers
+        self._queue = queue.Queue()
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def schedule(self, server_id, conn):
+        logger.info(f"Queued resync of server {server_id} ({self._queue.qsize()} servers waiting)")
+        self._queue.put((server_id, conn))
+
+    def _work(self):
+        while True:
+            server_id, conn = self._queue.get()
+            try:
+                self._resync(server_id, conn)
+            except DatabaseUnavailableError as e:
+                logger.warning(f"Resync of server {server_id} postponed, the database is unavailable")
+                time.sleep(e.retry_after)
+                self._queue.put((server_id, conn))
+            except Exception as e:
+                logger.error(f"Resync of server {server_id} failed. Error: {e}")
+
+    def _resync(self, server_id, conn):
+        if not self.is_connected(server_id, conn):
+            return
+        players = self.db_manager.get_stats_sync_state(server_id)
+        if not players:  # first connect of the server, the socket does not know any player yet
+            logger.info(f"Server {server_id} has no known players, requesting all stats")
+            self.send("!sendAllPlayerStats", conn, bulk=True)
+            return
+
+        fresh_after = datetime.now() - timedelta(seconds=RESYNC_FRESH_AGE)
+        online = self.online_players.get_online_players(server_id)
+        stale = [str(mojang_uuid).lower() for mojang_uuid, synced_at in players if not synced_at or synced_at < fresh_after]
+        stale.sort(key=lambda mojang_uuid: mojang_uuid not in online)
+        logger.info(f"Resyncing {len(stale)} of {len(players)} players of server {server_id}")
+
+        for i in range(0, len(stale), RESYNC_BATCH_SIZE):
+            if not self.is_connected(server_id, conn):
+                logger.info(f"Server {server_id} disconnected, aborting resync")
+                return
+            for mojang_uuid in stale[i:i + RESYNC_BATCH_SIZE]:
+                self.send(f"!sendPlayerStats~{mojang_uuid}", conn, bulk=True)
+            time.sleep(RESYNC_BATCH_INTERVAL)
+        logger.info(f"Resync of server {server_id} finished")
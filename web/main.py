@@ -1,5 +1,8 @@
+import collections
+from datetime import datetime
 import os
 import sys
+import threading
 import time
 from urllib.parse import urlparse
 import secrets
@@ -24,21 +27,65 @@ if DATABASE_DIR not in sys.path:
     sys.path.insert(0, DATABASE_DIR)
 
 # Imports aus dem database-Paket
+from database.circuitBreaker import DatabaseUnavailableError
 from database.databaseManagerV2 import DatabaseManager
 from database.logger import get_logger
 from database.minecraft import Minecraft
+from database.notifications import OnlinePlayerCache
+from mc_socket.control import ControlClient
 
 # Flask setup
-from flask import Flask, render_template, render_template_string, request, Response, redirect, session, flash, jsonify, abort
+from flask import Flask, render_template, render_template_string, request, Response, redirect, session, flash, jsonify, abort, g
 from flask_cors import CORS
 
 app = Flask(__name__)
 CORS(app)
 
+PLAYER_LIST_REFRESH_INTERVAL = 30  # seconds
+STALE_READ_CACHE_SIZE = 10000  # results of database reads kept to be served while the database is unavailable
+
+
+class StaleReadCache:
+    """
+    Keeps the last result of every database read. While the database is unavailable (circuit breaker open or
+    the connection busy for too long) the last result is returned instead, together with the time it was read.
+    """
+
+    def __init__(self, size=STALE_READ_CACHE_SIZE):
+        self.size = size
+        self._results = collections.OrderedDict()  # (method name, args) -> (result, read at), least recently used first
+        self._lock = threading.Lock()
+
+    def read(self, method, *args):
+        """
+        Returns:
+        tuple: (result, read at) where read at is None if the result is fresh.
+        Raises DatabaseUnavailableError if the database is unavailable and nothing is cached.
+        """
+        key = (method.__name__, args)
+        try:
+            result = method(*args)
+        except DatabaseUnavailableError:
+            with self._lock:
+                if key not in self._results:
+                    raise
+                self._results.move_to_end(key)
+                return self._results[key]
+        with self._lock:
+            self._results[key] = (result, datetime.now())
+            self._results.move_to_end(key)
+            if len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return result, None
+
 
 logger = get_logger("webServer")
 db_manager = DatabaseManager()
 minecraft = Minecraft()
+online_players = OnlinePlayerCache()
+socket_control = ControlClient()
+stale_reads = StaleReadCache()
+online_players.start()
 
 app = Flask(__name__, subdomain_matching=True)
 CORS(app, resources={r"/api/*": {"origins": CURRENT_DOMAIN}})
@@ -48,6 +95,19 @@ CORS(app, resources={r"/api/*": {"origins": CURRENT_DOMAIN}})
 #         if request.host != CURRENT_DOMAIN.split(":")[0]:
 #             return jsonify({"error": "Blocked"}), 403
         
+def cached_read(method, *args):
+    """
+    Reads through the StaleReadCache and remembers the oldest stale result of the request for the stale marker.
+    """
+    result, read_at = stale_reads.read(method, *args)
+    if read_at and (g.get("stale_since") is None or read_at < g.stale_since):
+        g.stale_since = read_at
+    return result
+
+@app.errorhandler(DatabaseUnavailableError)
+def database_unavailable(e):
+    return "Die Datenbank ist gerade nicht erreichbar. Bitte versuche es später erneut.", 503, {"Retry-After": str(int(e.retry_after) or 1)}
+
 logger.info('Application started')
 app.config.from_pyfile("config.py")
 app.config.from_pyfile("instance/config.py")
@@ -59,7 +119,7 @@ def inject_loginVar():
     subdomain = host_parts[0] if len(host_parts) > 2 else None
     if subdomain == "mc":
         return dict()  
-    server_information = db_manager.get_server_information_dict(subdomain)
+    server_information = cached_read(db_manager.get_server_information_dict, subdomain)
     logger.debug("Server information: %s" % str(server_information))
     if server_information is None:
         logger.debug("Server not found, aborting with 404...")
@@ -73,13 +133,15 @@ def inject_loginVar():
     logger.debug("UUID: %s" % uuid)
     
     if isinstance(uuid, str):
-        name = db_manager.get_player_name_from_uuid(uuid)
+        name = cached_read(db_manager.get_player_name_from_uuid, uuid)
         loginVar = (f"{name}<br> <a id=logoutLink onclick=\"logout()\" style=\"cursor: "
                     "pointer;font-size:20px;\">Logout</a>")
         
-        permission_level = db_manager.get_web_access_permission_from_player_id(player_id)
+        permission_level = cached_read(db_manager.get_web_access_permission_from_player_id, player_id)
     
+    stale_since = g.get("stale_since")
     return dict(loginVar=loginVar, 
+                stale_since=stale_since.strftime("%d.%m.%Y %H:%M") if stale_since else None,
                 perm=permission_level,
                 uuid_profile=uuid, 
                 name=name,
@@ -101,7 +163,12 @@ def subdomain_index_route(subdomain):
     """
     print("RETURN INDEX FOR: " + subdomain)
     print(session.get("uuid"), session.get("id"))
-    return render_template("index-subpage.html")
+    server_totals = {}
+    server_id = cached_read(db_manager.get_server_id_from_subdomain, subdomain)
+    if server_id:
+        server_totals = dict(cached_read(db_manager.get_server_stat_totals, server_id))
+        server_totals["play_time"] = db_manager.format_time(server_totals["play_time"] / 20)
+    return render_template("index-subpage.html", server_totals=server_totals)
 @app.route('/')
 def main_index_route():
     """
@@ -165,19 +232,19 @@ def player_overview_route(subdomain):
     user_name = request.args.get('player')
 
     if user_name:
-        uuid = db_manager.get_mojang_uuid_from_player_name(user_name)
-        player_id = db_manager.get_player_id_from_mojang_uuid_and_subdomain(uuid, subdomain)
-        status = db_manager.get_online_status_by_player_id(player_id)
+        uuid = cached_read(db_manager.get_mojang_uuid_from_player_name, user_name)
+        player_id = cached_read(db_manager.get_player_id_from_mojang_uuid_and_subdomain, uuid, subdomain)
+        status = cached_read(db_manager.get_online_status_by_player_id, player_id)
         
-        armor_stats = db_manager.get_all_armor_stats(player_id)
-        tool_stats = db_manager.get_all_tools_stats(player_id)
-        item_stats = db_manager.get_all_items_stats(player_id)
-        block_stats = db_manager.get_all_blocks_stats(player_id)
-        mob_stats = db_manager.get_all_mobs_stats(player_id)
-        custom_stats = db_manager.get_all_custom_stats(player_id)
+        armor_stats = cached_read(db_manager.get_all_armor_stats, player_id)
+        tool_stats = cached_read(db_manager.get_all_tools_stats, player_id)
+        item_stats = cached_read(db_manager.get_all_items_stats, player_id)
+        block_stats = cached_read(db_manager.get_all_blocks_stats, player_id)
+        mob_stats = cached_read(db_manager.get_all_mobs_stats, player_id)
+        custom_stats = cached_read(db_manager.get_all_custom_stats, player_id)
         
         enddate, startdate = "", ""
-        banned = db_manager.get_ban_reason_from_player_id(player_id)
+        banned = cached_read(db_manager.get_ban_reason_from_player_id, player_id)
         if banned:
             start, end = get_ban_start_and_ban_end_by_player_id(player_id)
             startdate, enddate = start.strftime("%d.%m.%Y %H:%M"), end.strftime(("%d.%m.%Y %H:%M"))
@@ -188,16 +255,17 @@ def player_overview_route(subdomain):
     all_users = []
     all_status = []
     combined_users_data = []
-    all_uuids = db_manager.get_all_mojang_uuids_from_subdomain(subdomain)
+    all_uuids = cached_read(db_manager.get_all_mojang_uuids_from_subdomain, subdomain)
+    server_id = cached_read(db_manager.get_server_id_from_subdomain, subdomain)
 
     for uuid in all_uuids:
-        user_name = db_manager.get_player_name_from_mojang_uuid(uuid)
+        user_name = cached_read(db_manager.get_player_name_from_mojang_uuid, uuid)
         if user_name is None:
             print(f"No username found for UUID: {uuid}")
             continue  # Skip processing if no username found
 
         all_users.append(user_name)
-        status = "online" if db_manager.get_online_status_by_player_uuid_and_subdomain(uuid, subdomain) else "offline"
+        status = "online" if online_players.is_online(server_id, uuid) else "offline"
         print(f"Status from user: {user_name} with UUID: {uuid} is: {status}")
         all_status.append(status)
         combined_users_data.append([user_name, uuid])
@@ -233,6 +301,10 @@ def minecraft_login_api(subdomain):
                     "info": "Please log into the server and try again. You must be online to progress"}
         secret_pin = secrets.SystemRandom().randrange(100000, 999999)
         db_manager.add_login_entry_from_player_id(player_id, secret_pin)
+        try:  # push the pin right away; the login watcher of the socket picks it up otherwise
+            socket_control.request("push_pin", server_id=db_manager.get_server_id_from_subdomain(subdomain), uuid=uuid, pin=secret_pin)
+        except (ConnectionError, RuntimeError) as e:
+            logger.warning(f"Pushing the login pin failed: {e}")
         session["login_in_progress_uuid"] = uuid  # set session cookie for the next step in the login process
         return {"response": "success", "status": "success", "info": ""}
 
@@ -263,9 +335,11 @@ def minecraft_login_api(subdomain):
 
 @app.route('/api/player_count', subdomain='<subdomain>')
 def stream_player_count(subdomain):
+    server_id = db_manager.get_server_id_from_subdomain(subdomain)
+
     def generate():
         while True:
-            online_count = db_manager.get_online_player_count_from_subdomain(subdomain)
+            online_count = online_players.get_online_count(server_id)
             yield f"data: {online_count}\n\n"
             time.sleep(1)
 
@@ -273,13 +347,15 @@ def stream_player_count(subdomain):
 
 @app.route('/api/status', subdomain='<subdomain>')
 def stream_status(subdomain):
-    # could be more efficient witth only one db call and return the whole list instead of just uuids
+    server_id = db_manager.get_server_id_from_subdomain(subdomain)
+
     def generate():
+        all_uuids, uuids_loaded = [], 0
         while True:
-            all_uuids = db_manager.get_all_mojang_uuids_from_subdomain(subdomain)
-            data = []
-            for uuid in all_uuids:
-                data.append("online" if db_manager.get_online_status_by_player_uuid_and_subdomain(uuid, subdomain) else "offline")
+            if time.time() - uuids_loaded > PLAYER_LIST_REFRESH_INTERVAL:  # the player list only grows when new players join
+                all_uuids, uuids_loaded = db_manager.get_all_mojang_uuids_from_subdomain(subdomain), time.time()
+            online = online_players.get_online_players(server_id)
+            data = ["online" if str(uuid).lower() in online else "offline" for uuid in all_uuids]
             yield f"data: {data}\n\n"
             time.sleep(1)
 
@@ -288,28 +364,39 @@ def stream_status(subdomain):
 @app.route('/api/player_info/<path:path>', subdomain='<subdomain>')
 def stream_player_info(path,subdomain):
     player_name = path
-    uuid = db_manager.get_mojang_uuid_from_player_name(player_name)
-    player_id = db_manager.get_player_id_from_mojang_uuid_and_server_id(uuid, subdomain)
-    first_seen = db_manager.get_first_seen_by_player_id(player_id).strftime("%d.%m.%Y")
+    uuid = cached_read(db_manager.get_mojang_uuid_from_player_name, player_name)
+    player_id = cached_read(db_manager.get_player_id_from_mojang_uuid_and_subdomain, uuid, subdomain)
+    server_id = cached_read(db_manager.get_server_id_from_subdomain, subdomain)
+    first_seen = cached_read(db_manager.get_first_seen_by_player_id, player_id)
+    first_seen = first_seen.strftime("%d.%m.%Y") if first_seen else "-"
 
     def generate():
         last_update = 99
+        stale_since = None
         
         while True:
-            status = "online" if db_manager.get_online_status_by_player_id(player_id) else "offline"
+            status = "online" if online_players.is_online(server_id, uuid) else "offline"
             if 10 - last_update <= 0:
                 last_update = 0
-                death_count = db_manager.get_value_from_unique_object_from_action_table_with_player_id("minecraft:deaths", player_id)
+                try:
+                    reads = [stale_reads.read(db_manager.get_value_from_unique_object_from_action_table_with_player_id, object_name, player_id)
+                             for object_name in ("minecraft:deaths", "minecraft:time_since_death", "minecraft:play_time")]
+                    reads.append(stale_reads.read(db_manager.get_last_seen_by_player_id, player_id))
+                except DatabaseUnavailableError:  # nothing cached yet, try again with the next update
+                    last_update = 10
+                    time.sleep(1)
+                    continue
+                (death_count, _), (death_time, _), (play_time, _), (last_seen, _) = reads
+                read_at = [read_at for _, read_at in reads if read_at]
+                stale_since = min(read_at).strftime("%d.%m.%Y %H:%M") if read_at else None
                 death_count = death_count if death_count else 0
-                last_seen = db_manager.get_last_seen_by_player_id(player_id).strftime("%d.%m.%Y")
-                death_time = db_manager.get_value_from_unique_object_from_action_table_with_player_id("minecraft:time_since_death", player_id)
-                play_time = db_manager.get_value_from_unique_object_from_action_table_with_player_id("minecraft:play_time", player_id)
+                last_seen = last_seen.strftime("%d.%m.%Y") if last_seen else "-"
                 death_time = db_manager.format_time(death_time / 20)
                 play_time = db_manager.format_time(play_time / 20)
                 
             last_update += 1
             
-            data = [uuid, status, death_count, first_seen, last_seen, death_time, play_time]
+            data = [uuid, status, death_count, first_seen, last_seen, death_time, play_time, stale_since or ""]
             yield f"data: {data}\n\n"
             time.sleep(1)  
 